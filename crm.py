@@ -32,6 +32,57 @@ import json
 if "drive_creds" not in st.session_state:
     st.session_state.drive_creds = None
 
+# Parámetro de la URL con el token de sesión firmado (ver validar_token_sesion)
+SESSION_PARAM = "s"
+# `state` de OAuth: nonce aleatorio de un solo uso guardado en el servidor. Nunca es un token
+# de sesión; al volver de Google la sesión se busca por el nonce y solo si es el mismo navegador.
+OAUTH_STATE_TTL_S = 15 * 60
+
+@st.cache_resource(show_spinner=False)
+def _estados_oauth() -> dict:
+    """{nonce: {"token", "huella", "ts"}} compartido entre sesiones del proceso."""
+    return {}
+
+def _huella_navegador() -> str:
+    """Huella de la cookie XSRF de Streamlit ('' si no hay): liga el nonce al navegador."""
+    import hashlib
+    try:
+        cookie = st.context.cookies.get("_streamlit_xsrf")
+    except Exception:
+        cookie = None
+    if not isinstance(cookie, str) or not cookie:
+        return ""
+    return hashlib.sha256(cookie.encode("utf-8")).hexdigest()
+
+def nonce_oauth() -> str:
+    """Nonce `state` de esta sesión; recuerda en el servidor el token de sesión actual."""
+    import secrets, time
+    estados = _estados_oauth()
+    ahora = time.time()
+    for n, reg in list(estados.items()):
+        if ahora - reg["ts"] > OAUTH_STATE_TTL_S:
+            estados.pop(n, None)
+    nonce = st.session_state.get("oauth_state")
+    if not nonce:
+        nonce = st.session_state["oauth_state"] = secrets.token_urlsafe(24)
+    estados[nonce] = {"token": st.query_params.get(SESSION_PARAM, ""), "huella": _huella_navegador(), "ts": ahora}
+    return nonce
+
+def consumir_nonce_oauth(nonce: str | None) -> dict | None:
+    """Registro del nonce (una sola vez) si existe y está vigente; None si no."""
+    import time
+    reg = _estados_oauth().pop(nonce or "", None)
+    if reg is None or time.time() - reg["ts"] > OAUTH_STATE_TTL_S:
+        return None
+    return reg
+
+def _limpiar_query_params():
+    """Limpia la URL (código de OAuth, `state`, errores) conservando el token de sesión."""
+    token = st.query_params.get(SESSION_PARAM)
+    st.query_params.clear()
+    if token:
+        st.query_params[SESSION_PARAM] = token
+
 CLIENT_ID = st.secrets["GOOGLE_CLIENT_ID"]
 CLIENT_SECRET = st.secrets["GOOGLE_CLIENT_SECRET"]
 REDIRECT_URI = st.secrets["REDIRECT_URI"]
@@ -52,6 +103,7 @@ if not st.session_state.drive_creds:
         f"&redirect_uri={REDIRECT_URI}"
         f"&scope=https://www.googleapis.com/auth/drive.file%20https://www.googleapis.com/auth/drive.metadata.readonly"
         f"&access_type=offline&prompt=consent"
+        f"&state={nonce_oauth()}"
     )
     st.sidebar.markdown("---")
     st.sidebar.markdown("### 📂 Conexión a Google Drive")
@@ -67,7 +119,7 @@ else:
         st.session_state.drive_creds = None
         if "processed_auth_code" in st.session_state:
             del st.session_state.processed_auth_code
-        st.query_params.clear()
+        _limpiar_query_params()
         st.sidebar.success("Google Drive desconectado")
         st.rerun()
 
@@ -78,7 +130,10 @@ if "code" in query_params and not st.session_state.drive_creds:
     
     # Solo procesar si no hemos procesado este código antes
     if "processed_auth_code" not in st.session_state or st.session_state.processed_auth_code != code:
+        estado_oauth = consumir_nonce_oauth(query_params.get("state"))
         try:
+            if estado_oauth is None:
+                raise ValueError("state de OAuth desconocido o vencido")
             # Configuración del cliente OAuth2 actualizada
             client_config = {
                 "web": {
@@ -101,9 +156,13 @@ if "code" in query_params and not st.session_state.drive_creds:
             # Guardar credenciales y marcar el código como procesado
             st.session_state.drive_creds = flow.credentials
             st.session_state.processed_auth_code = code
+            # Recuperar la sesión que había antes de ir a Google (solo en el mismo navegador)
+            huella = _huella_navegador()
+            if estado_oauth["token"] and huella and estado_oauth["huella"] == huella:
+                st.query_params[SESSION_PARAM] = estado_oauth["token"]
             
             # Limpiar el código de la URL para evitar reprocessing
-            st.query_params.clear()
+            _limpiar_query_params()
             # Usar función simple sin dependencias
             if f"shown_drive_auth" not in st.session_state:
                 st.success("✅ Autenticación exitosa con Google Drive")
@@ -114,7 +173,7 @@ if "code" in query_params and not st.session_state.drive_creds:
             # Quitar mensajes molestos antes del login
             # st.error(f"❌ Error en la autenticación: {str(e)}")
             # Limpiar el código problemático
-            st.query_params.clear()
+            _limpiar_query_params()
             st.session_state.processed_auth_code = None
             # st.sidebar.error("Error de autenticación. Intenta conectar nuevamente.")
 
@@ -122,7 +181,7 @@ if "code" in query_params and not st.session_state.drive_creds:
 if "error" in query_params:
     error = query_params["error"]
     # Quitar mensaje molesto: st.sidebar.error(f"❌ Error de autorización: {error}")
-    st.query_params.clear()
+    _limpiar_query_params()
 
 # CSS personalizado para look profesional con tema claro Kapitaliza
 st.markdown("""
@@ -503,11 +562,14 @@ import difflib
 import unicodedata
 import time
 
+import numpy as np
 import pandas as pd
 import gspread
 from gspread_dataframe import get_as_dataframe, set_with_dataframe
 from google.oauth2.service_account import Credentials
 import shutil
+import tempfile
+import threading
 import altair as alt
 from google.auth.transport.requests import Request
 
@@ -515,6 +577,22 @@ from google.auth.transport.requests import Request
 
 # === FUNCIONES PROFESIONALES DEL CRM ===
 
+# Estado compartido entre reruns y sesiones (las variables globales del script se reinician en cada rerun)
+@st.cache_resource(show_spinner=False)
+def _estado_compartido(nombre: str) -> dict:
+    """Diccionario persistente en el proceso del servidor, identificado por nombre."""
+    return {}
+
+def _cache_guardar(cache: dict, clave, valor, max_items: int = 8):
+    """Guarda en una caché compartida descartando las entradas más antiguas."""
+    cache[clave] = valor
+    try:
+        while len(cache) > max_items:
+            cache.pop(next(iter(cache)))
+    except Exception:
+        pass
+    return valor
+
 # Función para mostrar loading personalizado
 def show_loading(message="Procesando..."):
     """Muestra un loading spinner más profesional"""
@@ -635,40 +713,72 @@ def render_kpi_card(label: str, value: any, delta: str = None, icon: str = "📊
     """
     st.markdown(card_html, unsafe_allow_html=True)
 
+# === MOTOR DE ANÁLISIS FINANCIERO ===
+# Los montos se parsean una sola vez por versión de datos y se reutilizan en KPIs, tablas y presentación
+_MONTOS_CACHE = _estado_compartido("montos")
+_ANALISIS_CACHE = _estado_compartido("analisis_financiero")
+
+def version_datos(df: pd.DataFrame, columnas: list | None = None, orden: bool = True) -> str:
+    """
+    Huella del contenido (e índice) de un DataFrame; cambia cuando cambian los datos.
+    Con orden=False se ignoran el índice y el orden de las filas (útil entre recargas).
+    """
+    if df is None or df.empty:
+        return "vacio"
+    sub = df if columnas is None else df[[c for c in columnas if c in df.columns]]
+    hashes = pd.util.hash_pandas_object(sub, index=orden)
+    if orden:
+        h = hashlib.sha1(hashes.values.tobytes())
+    else:
+        h = hashlib.sha1(f"{len(sub)}:{int(hashes.values.sum())}".encode("utf-8"))
+    h.update("|".join(map(str, sub.columns)).encode("utf-8"))
+    return h.hexdigest()
+
+def montos_a_numero(serie: pd.Series) -> pd.Series:
+    """Convierte una columna de montos en texto ('$1,200.50') a float de forma vectorizada; inválidos = 0."""
+    limpia = serie.astype(str).str.replace(r'[,$\s]', '', regex=True)
+    return pd.to_numeric(limpia, errors="coerce").fillna(0.0)
+
+def montos_numericos(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Columnas numéricas de montos alineadas al índice de df (solo lectura):
+    monto_propuesta_num, monto_final_num y monto_analisis
+    (monto_final para DISPERSADO, monto_propuesta para el resto).
+    """
+    clave = version_datos(df, ["estatus", "monto_propuesta", "monto_final"])
+    cacheado = _MONTOS_CACHE.get(clave)
+    if cacheado is not None:
+        return cacheado
+    return _cache_guardar(_MONTOS_CACHE, clave, _calcular_montos(df))
+
+def _calcular_montos(df: pd.DataFrame) -> pd.DataFrame:
+    """Cálculo sin caché de montos_numericos (para subconjuntos pequeños)."""
+    num = pd.DataFrame(index=df.index)
+    num["monto_propuesta_num"] = montos_a_numero(df["monto_propuesta"]) if "monto_propuesta" in df.columns else 0.0
+    num["monto_final_num"] = montos_a_numero(df["monto_final"]) if "monto_final" in df.columns else 0.0
+    estatus = df["estatus"] if "estatus" in df.columns else pd.Series("", index=df.index)
+    num["monto_analisis"] = num["monto_final_num"].where(estatus == "DISPERSADO", num["monto_propuesta_num"])
+    return num
+
 def calcular_analisis_financiero(df: pd.DataFrame) -> dict:
     """Calcula métricas financieras del portfolio de clientes"""
-    import re
-    
-    def limpiar_monto(monto_str):
-        """Convierte string de monto a float, manejando diferentes formatos"""
-        if pd.isna(monto_str) or str(monto_str).strip() == "":
-            return 0.0
-        
-        # Convertir a string y limpiar
-        monto_clean = str(monto_str).strip()
-        
-        # Remover símbolos de moneda y espacios
-        monto_clean = re.sub(r'[,$\s]', '', monto_clean)
-        
-        # Intentar convertir a float
-        try:
-            return float(monto_clean)
-        except (ValueError, TypeError):
-            return 0.0
-    
-    # Limpiar y convertir montos
-    df_temp = df.copy()
-    df_temp['monto_propuesta_num'] = df_temp['monto_propuesta'].apply(limpiar_monto)
-    df_temp['monto_final_num'] = df_temp['monto_final'].apply(limpiar_monto)
+    clave = version_datos(df, ["estatus", "monto_propuesta", "monto_final"])
+    cacheado = _ANALISIS_CACHE.get(clave)
+    if cacheado is not None:
+        return cacheado
+
+    # Montos ya convertidos (vectorizado y en caché)
+    df_temp = montos_numericos(df)[['monto_propuesta_num', 'monto_final_num']].copy()
+    df_temp['estatus'] = df['estatus']
+    es_dispersado = df_temp['estatus'] == 'DISPERSADO'
     
     # Calcular métricas
     total_propuesto = df_temp['monto_propuesta_num'].sum()
-    total_dispersado = df_temp[df_temp['estatus'] == 'DISPERSADO']['monto_final_num'].sum()
+    total_dispersado = df_temp.loc[es_dispersado, 'monto_final_num'].sum()
     
     # Promedios
     promedio_propuesto = df_temp['monto_propuesta_num'].mean() if len(df_temp) > 0 else 0
-    dispersados_df = df_temp[df_temp['estatus'] == 'DISPERSADO']
-    promedio_dispersado = dispersados_df['monto_final_num'].mean() if len(dispersados_df) > 0 else 0
+    promedio_dispersado = df_temp.loc[es_dispersado, 'monto_final_num'].mean() if es_dispersado.any() else 0
     
     # Efectividad de conversión
     tasa_conversion_financiera = (total_dispersado / total_propuesto * 100) if total_propuesto > 0 else 0
@@ -679,17 +789,195 @@ def calcular_analisis_financiero(df: pd.DataFrame) -> dict:
         'monto_final_num': ['sum', 'mean']
     }).round(2)
     
-    return {
+    return _cache_guardar(_ANALISIS_CACHE, clave, {
         'total_propuesto': total_propuesto,
         'total_dispersado': total_dispersado,
         'promedio_propuesto': promedio_propuesto,
         'promedio_dispersado': promedio_dispersado,
         'tasa_conversion_financiera': tasa_conversion_financiera,
         'montos_por_estatus': montos_por_estatus,
-        'clientes_con_monto': len(df_temp[df_temp['monto_propuesta_num'] > 0]),
-        'dispersados_con_monto': len(df_temp[(df_temp['estatus'] == 'DISPERSADO') & (df_temp['monto_final_num'] > 0)])
+        'clientes_con_monto': int((df_temp['monto_propuesta_num'] > 0).sum()),
+        'dispersados_con_monto': int((es_dispersado & (df_temp['monto_final_num'] > 0)).sum())
+    })
+
+# --- Cubo de KPIs materializado ---
+# Agregados por (estatus, sucursal, asesor, fuente, mes); las gráficas y KPIs son rebanadas del cubo
+CUBO_DIMENSIONES = ["estatus", "sucursal", "asesor", "fuente", "mes"]
+CUBO_MEDIDAS = ["clientes", "monto_propuesta", "monto_final", "monto_analisis", "con_propuesta", "con_final", "con_analisis"]
+CUBO_COLUMNAS_ORIGEN = ["id", "estatus", "sucursal", "asesor", "fuente", "fecha_ingreso", "monto_propuesta", "monto_final"]
+_CUBO_CACHE = _estado_compartido("cubo_kpi")
+
+def _cubo_filas(df: pd.DataFrame, usar_cache: bool = True) -> pd.DataFrame:
+    """Una fila por cliente con dimensiones normalizadas, fecha parseada y medidas numéricas."""
+    def _dim(col: str, vacio: str) -> pd.Series:
+        if col not in df.columns:
+            return pd.Series(vacio, index=df.index)
+        s = df[col].fillna("").astype(str).str.strip()
+        return s.mask(s == "", vacio)
+
+    num = montos_numericos(df) if usar_cache else _calcular_montos(df)
+    asesor = _dim("asesor", "(Sin asesor)")
+    fecha = parse_dates_flexible(df["fecha_ingreso"]) if "fecha_ingreso" in df.columns else pd.Series(pd.NaT, index=df.index)
+    return pd.DataFrame({
+        "id": df["id"].astype(str) if "id" in df.columns else "",
+        "estatus": _dim("estatus", "(Sin estatus)"),
+        "sucursal": _dim("sucursal", "(Sin sucursal)"),
+        "asesor": asesor.mask(asesor.str.casefold() == "(sin asesor)", "(Sin asesor)"),
+        "fuente": _dim("fuente", "(Sin fuente)"),
+        "fecha": fecha,
+        "mes": fecha.dt.strftime("%Y-%m").fillna(""),
+        "clientes": 1,
+        "monto_propuesta": num["monto_propuesta_num"],
+        "monto_final": num["monto_final_num"],
+        "monto_analisis": num["monto_analisis"],
+        "con_propuesta": (num["monto_propuesta_num"] > 0).astype(int),
+        "con_final": (num["monto_final_num"] > 0).astype(int),
+        "con_analisis": (num["monto_analisis"] > 0).astype(int),
+    }, index=df.index).reset_index(drop=True)
+
+def _agregar_cubo(filas: pd.DataFrame) -> pd.DataFrame:
+    cubo = filas.groupby(CUBO_DIMENSIONES, as_index=False, sort=False)[CUBO_MEDIDAS].sum()
+    return cubo[cubo["clientes"] != 0].reset_index(drop=True)
+
+def _clave_cubo(df: pd.DataFrame) -> str:
+    return version_datos(df, CUBO_COLUMNAS_ORIGEN, orden=False)
+
+def _datos_cubo(df: pd.DataFrame) -> dict:
+    clave = _clave_cubo(df)
+    datos = _CUBO_CACHE.get(clave)
+    if datos is None:
+        filas = _cubo_filas(df)
+        datos = _cache_guardar(_CUBO_CACHE, clave, {"filas": filas, "cubo": _agregar_cubo(filas)}, max_items=4)
+    return datos
+
+def cubo_kpi(df: pd.DataFrame) -> pd.DataFrame:
+    """Cubo de KPIs (solo lectura) para el DataFrame de clientes; se construye una vez por versión."""
+    return _datos_cubo(df)["cubo"]
+
+def filas_kpi(df: pd.DataFrame) -> pd.DataFrame:
+    """Filas normalizadas del cubo (con fecha parseada y mes) para filtros por rango de fechas."""
+    return _datos_cubo(df)["filas"]
+
+def cubo_conteo(cubo: pd.DataFrame, dimension: str, medida: str = "clientes") -> pd.DataFrame:
+    """Rebanada del cubo: total de `medida` por `dimension`, de mayor a menor."""
+    res = cubo.groupby(dimension, as_index=False)[medida].sum()
+    res = res[res[medida] > 0].sort_values(medida, ascending=False).reset_index(drop=True)
+    return res.rename(columns={medida: "cantidad"}) if medida == "clientes" else res
+
+def _ids_cambiados(df_anterior: pd.DataFrame, df_nuevo: pd.DataFrame, columnas: list) -> set | None:
+    """IDs agregados, eliminados o con cambios en `columnas` (None si los IDs no son únicos)."""
+    if df_anterior["id"].duplicated().any() or df_nuevo["id"].duplicated().any():
+        return None
+    cols = [c for c in columnas if c != "id"]
+    a = _ensure_columns(df_anterior, ["id"] + cols).set_index("id")
+    b = _ensure_columns(df_nuevo, ["id"] + cols).set_index("id")
+    comunes = a.index.intersection(b.index)
+    distintos = (a.loc[comunes, cols] != b.loc[comunes, cols]).any(axis=1)
+    return set(comunes[distintos.values]) | set(a.index.difference(b.index)) | set(b.index.difference(a.index))
+
+def actualizar_cubo_kpi(df_anterior: pd.DataFrame, df_nuevo: pd.DataFrame) -> bool:
+    """
+    Actualiza el cubo en caché de forma incremental: resta la contribución de los clientes
+    que cambiaron y suma la nueva. Si no hay cubo para df_anterior no hace nada (se construye al usarse).
+    """
+    try:
+        if df_anterior is None or df_nuevo is None or "id" not in df_anterior.columns or "id" not in df_nuevo.columns:
+            return False
+        previo = _CUBO_CACHE.get(_clave_cubo(df_anterior))
+        if previo is None:
+            return False
+        ids = _ids_cambiados(df_anterior, df_nuevo, CUBO_COLUMNAS_ORIGEN)
+        if ids is None or len(ids) > max(50, len(df_nuevo) // 2):
+            return False  # muchos cambios: sale más barato reconstruir
+        filas_ant = previo["filas"]
+        if ids:
+            salen = filas_ant[filas_ant["id"].isin(ids)]
+            entran = _cubo_filas(df_nuevo[df_nuevo["id"].astype(str).isin(ids)], usar_cache=False)
+            filas = pd.concat([filas_ant[~filas_ant["id"].isin(ids)], entran], ignore_index=True)
+            delta = pd.concat([previo["cubo"], salen.assign(**{m: -salen[m] for m in CUBO_MEDIDAS}), entran])
+            previo = {"filas": filas, "cubo": _agregar_cubo(delta[CUBO_DIMENSIONES + CUBO_MEDIDAS])}
+        _cache_guardar(_CUBO_CACHE, _clave_cubo(df_nuevo), previo, max_items=4)
+        return True
+    except Exception:
+        return False
+
+# --- Modelo de retorno esperado y riesgo ---
+# Pesos por estatus: catálogo configurable en data/modelo_riesgo.json (ver load_modelo_riesgo)
+MODELO_PESOS = ["prob_conversion", "factor_retorno", "riesgo_pct"]
+MODELO_RIESGO_DEFAULT = {
+    "estatus": {
+        "DISPERSADO":                 {"prob_conversion": 1.00, "factor_retorno": 1.00, "riesgo_pct": 5},
+        "APROB. CON PROPUESTA":       {"prob_conversion": 0.75, "factor_retorno": 0.85, "riesgo_pct": 20},
+        "PROPUESTA":                  {"prob_conversion": 0.75, "factor_retorno": 0.85, "riesgo_pct": 20},
+        "PEND. ACEPT. CLIENTE":       {"prob_conversion": 0.65, "factor_retorno": 0.80, "riesgo_pct": 30},
+        "PENDIENTE CLIENTE":          {"prob_conversion": 0.65, "factor_retorno": 0.80, "riesgo_pct": 30},
+        "PEND. DOC. PARA EVALUACION": {"prob_conversion": 0.45, "factor_retorno": 0.70, "riesgo_pct": 45},
+        "PENDIENTE DOC":              {"prob_conversion": 0.45, "factor_retorno": 0.70, "riesgo_pct": 45},
+        "EN ONBOARDING":              {"prob_conversion": 0.55, "factor_retorno": 0.75, "riesgo_pct": 40},
+        "RECH. CLIENTE CANCELA":      {"prob_conversion": 0.10, "factor_retorno": 0.00, "riesgo_pct": 90},
+        "RECH. SOBREENDEUDAMIENTO":   {"prob_conversion": 0.05, "factor_retorno": 0.00, "riesgo_pct": 95},
+    },
+    # Estatus de rechazo (RECH*/REC*) que no estén en la tabla
+    "rechazo": {"prob_conversion": 0.05, "factor_retorno": 0.00, "riesgo_pct": 95},
+    # Cualquier otro estatus desconocido
+    "default": {"prob_conversion": 0.50, "factor_retorno": 0.50, "riesgo_pct": 50},
+}
+
+def pesos_por_estatus(estatus: pd.Series, modelo: dict | None = None) -> pd.DataFrame:
+    """Pesos del modelo para cada estatus (map vectorizado; RECH*/REC* desconocidos usan 'rechazo')."""
+    modelo = modelo or MODELO_RIESGO_DEFAULT
+    estatus = pd.Series(estatus, dtype=str).reset_index(drop=True)
+    tabla = pd.DataFrame.from_dict(modelo.get("estatus", {}), orient="index")
+    es_rechazo = estatus.str.startswith(("RECH", "REC"))
+    pesos = pd.DataFrame(index=estatus.index)
+    for campo in MODELO_PESOS:
+        valores = estatus.map(tabla[campo]) if campo in tabla.columns else pd.Series(float("nan"), index=estatus.index)
+        respaldo = es_rechazo.map({True: modelo.get("rechazo", {}).get(campo), False: modelo.get("default", {}).get(campo)})
+        pesos[campo] = valores.fillna(respaldo).astype(float)
+    return pesos
+
+def modelo_financiero(df: pd.DataFrame, modelo: dict | None = None) -> dict:
+    """
+    Retorno esperado, exposición ponderada por riesgo y valor del pipeline por estatus.
+    Trabaja sobre los agregados del cubo (clientes con monto > 0), no sobre cada fila.
+    """
+    por_estatus = cubo_kpi(df).groupby("estatus", as_index=False)[["con_analisis", "monto_analisis"]].sum()
+    tabla = por_estatus[por_estatus["con_analisis"] > 0].rename(columns={"con_analisis": "clientes", "monto_analisis": "monto"}).reset_index(drop=True)
+    tabla = pd.concat([tabla, pesos_por_estatus(tabla["estatus"], modelo)], axis=1)
+    return _totales_modelo(tabla)
+
+def _totales_modelo(tabla: pd.DataFrame) -> dict:
+    tabla = tabla.copy()
+    tabla["monto_esperado"] = tabla["monto"] * tabla["prob_conversion"]
+    tabla["retorno_esperado"] = tabla["monto"] * tabla["factor_retorno"]
+    tabla["exposicion_riesgo"] = tabla["monto"] * tabla["riesgo_pct"] / 100
+    tabla["pipeline"] = (tabla["estatus"] != "DISPERSADO") & ~tabla["estatus"].str.startswith(("RECH", "REC"))
+    n = tabla["clientes"].sum()
+    return {
+        "tabla": tabla,
+        "total_cartera": tabla["monto"].sum(),
+        "total_monto_esperado": tabla["monto_esperado"].sum(),
+        "total_retorno": tabla["retorno_esperado"].sum(),
+        "exposicion_riesgo": tabla["exposicion_riesgo"].sum(),
+        "valor_pipeline": tabla.loc[tabla["pipeline"], "monto_esperado"].sum(),
+        "prom_riesgo": (tabla["riesgo_pct"] * tabla["clientes"]).sum() / n if n else 0,
+        "prom_conversion": (tabla["prob_conversion"] * tabla["clientes"]).sum() / n * 100 if n else 0,
     }
 
+def sensibilidad_modelo(resultado: dict, estatus: str, campo: str, valores) -> pd.DataFrame:
+    """
+    Recalcula los totales del modelo variando el peso `campo` de un estatus.
+    Solo reescala una fila de la tabla agregada por valor, por lo que es apto para uso interactivo.
+    """
+    tabla = resultado["tabla"]
+    filas = []
+    for v in valores:
+        t = tabla.copy()
+        t.loc[t["estatus"] == estatus, campo] = float(v)
+        tot = _totales_modelo(t[["estatus", "clientes", "monto"] + MODELO_PESOS])
+        filas.append({campo: float(v), **{k: tot[k] for k in ("total_monto_esperado", "total_retorno", "exposicion_riesgo", "valor_pipeline", "prom_riesgo")}})
+    return pd.DataFrame(filas)
+
 def formatear_monto(monto: float) -> str:
     """Formatea un monto para mostrar en pesos mexicanos"""
     if monto == 0:
@@ -702,44 +990,135 @@ def formatear_monto(monto: float) -> str:
         return f"${monto:,.0f}"
 
 
-def generar_presentacion_dashboard(df_cli: pd.DataFrame) -> bytes:
-    """Genera una presentación PowerPoint completa del dashboard con gráficas"""
+# --- Gráficas de la presentación (especificación + caché + render en paralelo) ---
+_GRAFICAS_CACHE = _estado_compartido("graficas_pptx")
+
+def spec_grafica(tipo: str, figsize: tuple, **datos) -> dict:
+    """
+    Describe una gráfica con datos ya agregados (listas de etiquetas/valores).
+    tipo: 'pastel' | 'barras_h' | 'barras'. La clave (tipo, hash) identifica la imagen en caché.
+    """
+    # Normalizar a tipos nativos (numpy -> float) para que el hash sea estable
+    datos = {k: ([x if isinstance(x, str) else float(x) for x in v] if isinstance(v, (list, tuple)) else v)
+             for k, v in datos.items()}
+    huella = hashlib.sha1(repr((tuple(figsize), sorted(datos.items()))).encode("utf-8")).hexdigest()
+    return {"tipo": tipo, "figsize": tuple(figsize), "datos": datos, "clave": (tipo, huella)}
+
+def _etiqueta_valor(valor: float, formato: str) -> str:
+    return formatear_monto(valor) if formato == "monto" else str(int(valor))
+
+def renderizar_grafica(spec: dict) -> bytes:
+    """
+    Dibuja una especificación a PNG (dpi=150). Usa la API orientada a objetos de matplotlib
+    (Figure + FigureCanvasAgg) en lugar de pyplot, para poder ejecutarse en hilos.
+    """
+    from io import BytesIO
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=spec["figsize"])
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    d = spec["datos"]
+    tipo = spec["tipo"]
+
+    if tipo == "pastel":
+        if sum(d["valores"]) > 0:
+            ax.pie(d["valores"], labels=d["etiquetas"], autopct='%1.1f%%', colors=d["colores"], startangle=90)
+            ax.axis('equal')
+    elif tipo == "barras_h":
+        bars = ax.barh(d["etiquetas"], d["valores"], color=d["color"])
+        ax.set_xlabel(d["eje"], fontsize=11)
+        ax.set_title(d["titulo"], fontsize=13, fontweight='bold')
+        if d.get("invertir"):
+            ax.invert_yaxis()
+        for bar, valor in zip(bars, d["valores"]):
+            ax.text(bar.get_width(), bar.get_y() + bar.get_height()/2,
+                   f' {_etiqueta_valor(valor, d["formato"])}',
+                   va='center', fontsize=10, fontweight='bold')
+    elif tipo == "barras":
+        bars = ax.bar(d["etiquetas"], d["valores"], color=d["colores"], alpha=0.7, edgecolor='black')
+        ax.set_ylabel(d["eje"], fontsize=11)
+        ax.set_title(d["titulo"], fontsize=13, fontweight='bold')
+        for bar, valor in zip(bars, d["valores"]):
+            ax.text(bar.get_x() + bar.get_width()/2., bar.get_height(),
+                   _etiqueta_valor(valor, d["formato"]),
+                   ha='center', va='bottom', fontsize=11, fontweight='bold')
+
+    fig.tight_layout()
+    img_stream = BytesIO()
+    fig.savefig(img_stream, format='png', dpi=150, bbox_inches='tight')
+    return img_stream.getvalue()
+
+def renderizar_graficas(specs: dict) -> dict:
+    """
+    Renderiza varias gráficas {nombre: spec} -> {nombre: png}.
+    Las que ya están en caché (misma clave) no se vuelven a dibujar; el resto se
+    dibuja en paralelo con un pool de hilos.
+    """
+    imagenes = {n: _GRAFICAS_CACHE.get(sp["clave"]) for n, sp in specs.items()}
+    pendientes = [n for n, img in imagenes.items() if img is None]
+    if pendientes:
+        try:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(4, len(pendientes))) as executor:
+                resultados = list(executor.map(lambda n: renderizar_grafica(specs[n]), pendientes))
+        except ImportError:
+            resultados = [renderizar_grafica(specs[n]) for n in pendientes]
+        for n, img in zip(pendientes, resultados):
+            imagenes[n] = img
+            _cache_guardar(_GRAFICAS_CACHE, specs[n]["clave"], img, max_items=64)
+    return imagenes
+
+
+# --- Plantilla de la presentación ---
+PPTX_PLANTILLA = None  # ruta explícita de la plantilla (opcional); tiene prioridad sobre las rutas conocidas
+PPTX_PLANTILLA_CANDIDATAS = [
+    Path("assets/presentation_template.pptx"),
+    Path("data/presentation_template.pptx"),
+]
+_PLANTILLA_CACHE = _estado_compartido("plantilla_pptx")
+
+def plantilla_pptx() -> bytes | None:
+    """
+    Bytes de la plantilla .pptx (ruta configurada o primera candidata existente).
+    Se lee una sola vez y se vuelve a leer solo si cambia la ruta, el mtime o el tamaño.
+    Retorna None si no hay plantilla.
+    """
+    rutas = ([Path(PPTX_PLANTILLA)] if PPTX_PLANTILLA else []) + PPTX_PLANTILLA_CANDIDATAS
+    for ruta in rutas:
+        try:
+            info = ruta.stat()
+        except OSError:
+            continue
+        firma = (str(ruta), info.st_mtime_ns, info.st_size)
+        if _PLANTILLA_CACHE.get("firma") != firma:
+            try:
+                _PLANTILLA_CACHE.update(firma=firma, datos=ruta.read_bytes())
+            except OSError:
+                continue
+        return _PLANTILLA_CACHE["datos"]
+    _PLANTILLA_CACHE.clear()
+    return None
+
+
+def generar_presentacion_dashboard(df_cli: pd.DataFrame, modelo: dict | None = None) -> bytes:
+    """
+    Genera una presentación PowerPoint completa del dashboard con gráficas.
+    modelo: pesos del modelo financiero (load_modelo_riesgo); por defecto MODELO_RIESGO_DEFAULT.
+    """
     from pptx import Presentation
     from pptx.util import Inches, Pt
     from pptx.enum.text import PP_ALIGN
     from pptx.dml.color import RGBColor
     from io import BytesIO
-    import matplotlib.pyplot as plt
-    import matplotlib
-    matplotlib.use('Agg')  # Backend sin GUI
-    
-    # Crear presentación — intentar cargar plantilla .pptx si existe
-    from pathlib import Path as _Path
-
-    template_path = None
-    # Rutas recomendadas donde podrías haber subido la plantilla
-    candidates = [
-        Path("assets/presentation_template.pptx"),
-        Path("data/presentation_template.pptx")
-    ]
-    for c in candidates:
-        if c.exists():
-            template_path = c
-            break
-
-    # Si no hay plantilla en rutas conocidas, buscar el primer .pptx en el repo
-    if template_path is None:
-        repo_root = Path(__file__).parent
-        for p in repo_root.rglob("*.pptx"):
-            # evitar archivos temporales o la propia salida si existiera
-            if ".git" in str(p) or "site-packages" in str(p):
-                continue
-            template_path = p
-            break
+    
+    # Crear presentación — clonar la plantilla en memoria si existe
+    template_bytes = plantilla_pptx()
 
     try:
-        if template_path is not None:
-            prs = Presentation(str(template_path))
+        if template_bytes is not None:
+            prs = Presentation(BytesIO(template_bytes))
         else:
             prs = Presentation()
             prs.slide_width = Inches(10)
@@ -768,6 +1147,54 @@ def generar_presentacion_dashboard(df_cli: pd.DataFrame) -> bytes:
     # Análisis financiero
     analisis_financiero = calcular_analisis_financiero(df_cli)
     total_presupuesto = analisis_financiero['total_propuesto']
+    resultado_modelo = modelo_financiero(df_cli, modelo)
+    sucursal_counts = df_cli["sucursal"].fillna("Sin sucursal").value_counts()
+    asesor_counts = df_cli["asesor"].fillna("Sin asesor").value_counts()
+    
+    # Especificaciones de todas las gráficas (solo datos agregados)
+    specs = {
+        "pastel": spec_grafica(
+            "pastel", (4, 3),
+            valores=[dispersados, en_proceso, rechazados],
+            etiquetas=['Dispersados', 'En Proceso', 'Rechazados'],
+            colores=['#28a745', '#ffc107', '#dc3545']
+        ),
+    }
+    if not analisis_financiero['montos_por_estatus'].empty:
+        estatus_con_monto = analisis_financiero['montos_por_estatus'][
+            analisis_financiero['montos_por_estatus'][('monto_propuesta_num', 'sum')] > 0
+        ]
+        top_estatus = estatus_con_monto.sort_values(
+            ('monto_propuesta_num', 'sum'), ascending=False
+        ).head(5)
+        specs["top_estatus"] = spec_grafica(
+            "barras_h", (8, 4),
+            etiquetas=[str(e)[:30] for e in top_estatus.index],  # Limitar longitud
+            valores=list(top_estatus[('monto_propuesta_num', 'sum')]),
+            color='#28a745', eje='Monto ($)', titulo='Top 5 Estatus por Monto', formato="monto"
+        )
+    if not resultado_modelo["tabla"].empty:
+        specs["financiero"] = spec_grafica(
+            "barras", (8, 2.5),
+            etiquetas=['Cartera\nTotal', 'Conversión\nEsperada', 'Retorno\nEsperado'],
+            valores=[resultado_modelo["total_cartera"], resultado_modelo["total_monto_esperado"], resultado_modelo["total_retorno"]],
+            colores=['#007bff', '#28a745', '#ffc107'],
+            eje='Monto ($)', titulo='Análisis Financiero de Cartera', formato="monto"
+        )
+    top_10_estatus = estatus_counts.head(10)
+    top_asesores = asesor_counts.head(10)
+    for nombre, serie, largo, color, titulo in [
+        ("estatus", top_10_estatus, 25, '#17a2b8', 'Top 10 Estatus (por cantidad)'),
+        ("sucursales", sucursal_counts, 30, '#6f42c1', 'Clientes por Sucursal'),
+        ("asesores", top_asesores, 30, '#fd7e14', 'Top 10 Asesores (por cantidad de clientes)'),
+    ]:
+        specs[nombre] = spec_grafica(
+            "barras_h", (8, 5),
+            etiquetas=[str(e)[:largo] for e in serie.index],
+            valores=list(serie.values),
+            color=color, eje='Cantidad de Clientes', titulo=titulo, formato="entero", invertir=True
+        )
+    imagenes = renderizar_graficas(specs)
     
     # === SLIDE 1: PORTADA ===
     slide = prs.slides.add_slide(prs.slide_layouts[6])  # Layout en blanco
@@ -872,21 +1299,7 @@ def generar_presentacion_dashboard(df_cli: pd.DataFrame) -> bytes:
             delta_p.alignment = PP_ALIGN.CENTER
     
     # Gráfica de distribución de estatus (pie chart)
-    fig, ax = plt.subplots(figsize=(4, 3))
-    sizes = [dispersados, en_proceso, rechazados]
-    labels = ['Dispersados', 'En Proceso', 'Rechazados']
-    colors = ['#28a745', '#ffc107', '#dc3545']
-    
-    if sum(sizes) > 0:
-        ax.pie(sizes, labels=labels, autopct='%1.1f%%', colors=colors, startangle=90)
-        ax.axis('equal')
-    
-    # Guardar gráfica en BytesIO
-    img_stream = BytesIO()
-    plt.tight_layout()
-    plt.savefig(img_stream, format='png', dpi=150, bbox_inches='tight')
-    plt.close()
-    img_stream.seek(0)
+    img_stream = BytesIO(imagenes["pastel"])
     
     # Agregar gráfica al slide
     slide.shapes.add_picture(img_stream, Inches(3), Inches(3.8), width=Inches(4))
@@ -913,95 +1326,19 @@ def generar_presentacion_dashboard(df_cli: pd.DataFrame) -> bytes:
     presupuesto_p.font.color.rgb = RGBColor(33, 37, 41)
     
     # Top estatus
-    if not analisis_financiero['montos_por_estatus'].empty:
-        estatus_con_monto = analisis_financiero['montos_por_estatus'][
-            analisis_financiero['montos_por_estatus'][('monto_propuesta_num', 'sum')] > 0
-        ]
-        top_estatus = estatus_con_monto.sort_values(
-            ('monto_propuesta_num', 'sum'), ascending=False
-        ).head(5)
-        
-        # Crear gráfica de barras
-        fig, ax = plt.subplots(figsize=(8, 4))
-        estatus_nombres = [str(e)[:30] for e in top_estatus.index]  # Limitar longitud
-        montos = [top_estatus.loc[e, ('monto_propuesta_num', 'sum')] for e in top_estatus.index]
-        
-        bars = ax.barh(estatus_nombres, montos, color='#28a745')
-        ax.set_xlabel('Monto ($)', fontsize=11)
-        ax.set_title('Top 5 Estatus por Monto', fontsize=13, fontweight='bold')
-        
-        # Agregar valores en las barras
-        for i, (bar, monto) in enumerate(zip(bars, montos)):
-            ax.text(bar.get_width(), bar.get_y() + bar.get_height()/2, 
-                   f' {formatear_monto(monto)}', 
-                   va='center', fontsize=10, fontweight='bold')
-        
-        plt.tight_layout()
-        
-        # Guardar gráfica
-        img_stream = BytesIO()
-        plt.savefig(img_stream, format='png', dpi=150, bbox_inches='tight')
-        plt.close()
-        img_stream.seek(0)
+    if "top_estatus" in specs:
+        img_stream = BytesIO(imagenes["top_estatus"])
         
         # Agregar al slide
         slide.shapes.add_picture(img_stream, Inches(0.8), Inches(1.8), width=Inches(8.4))
     
     # === SLIDE 4: ANÁLISIS FINANCIERO ===
-    df_temp = df_cli.copy()
-    
-    def limpiar_monto_simple(monto_str):
-        if pd.isna(monto_str) or str(monto_str).strip() == "":
-            return 0.0
-        try:
-            import re
-            clean = re.sub(r'[,$\s]', '', str(monto_str))
-            return float(clean)
-        except:
-            return 0.0
-    
-    df_temp['monto_analisis'] = df_temp.apply(
-        lambda row: limpiar_monto_simple(row['monto_final']) if row['estatus'] == 'DISPERSADO' 
-        else limpiar_monto_simple(row['monto_propuesta']), axis=1
-    )
-    df_analisis = df_temp[df_temp['monto_analisis'] > 0].copy()
-    
-    if not df_analisis.empty:
-        # Modelo financiero
-        prob_conversion = {
-            "DISPERSADO": 1.00, "APROB. CON PROPUESTA": 0.75, "PROPUESTA": 0.75,
-            "PEND. ACEPT. CLIENTE": 0.65, "PENDIENTE CLIENTE": 0.65,
-            "PEND. DOC. PARA EVALUACION": 0.45, "PENDIENTE DOC": 0.45,
-            "EN ONBOARDING": 0.55, "RECH. CLIENTE CANCELA": 0.10,
-            "RECH. SOBREENDEUDAMIENTO": 0.05,
-        }
-        factor_retorno = {
-            "DISPERSADO": 1.00, "APROB. CON PROPUESTA": 0.85, "PROPUESTA": 0.85,
-            "PEND. ACEPT. CLIENTE": 0.80, "PENDIENTE CLIENTE": 0.80,
-            "PEND. DOC. PARA EVALUACION": 0.70, "PENDIENTE DOC": 0.70,
-            "EN ONBOARDING": 0.75, "RECH. CLIENTE CANCELA": 0.00,
-            "RECH. SOBREENDEUDAMIENTO": 0.00,
-        }
-        riesgo_pct = {
-            "DISPERSADO": 5, "APROB. CON PROPUESTA": 20, "PROPUESTA": 20,
-            "PEND. ACEPT. CLIENTE": 30, "PENDIENTE CLIENTE": 30,
-            "PEND. DOC. PARA EVALUACION": 45, "PENDIENTE DOC": 45,
-            "EN ONBOARDING": 40, "RECH. CLIENTE CANCELA": 90,
-            "RECH. SOBREENDEUDAMIENTO": 95,
-        }
-        
-        df_analisis["Probabilidad de Conversión"] = df_analisis["estatus"].map(prob_conversion).fillna(0.5)
-        df_analisis["Factor Retorno"] = df_analisis["estatus"].map(factor_retorno).fillna(0.5)
-        df_analisis["Riesgo (%)"] = df_analisis["estatus"].map(riesgo_pct).fillna(50)
-        
-        df_analisis["Monto Esperado"] = df_analisis["monto_analisis"] * df_analisis["Probabilidad de Conversión"]
-        df_analisis["Retorno Esperado"] = df_analisis["monto_analisis"] * df_analisis["Factor Retorno"]
-        
-        total_cartera = df_analisis["monto_analisis"].sum()
-        total_monto_esperado = df_analisis["Monto Esperado"].sum()
-        total_retorno = df_analisis["Retorno Esperado"].sum()
-        prom_riesgo = df_analisis["Riesgo (%)"].mean()
-        prom_conversion = df_analisis["Probabilidad de Conversión"].mean() * 100
+    if not resultado_modelo["tabla"].empty:
+        total_cartera = resultado_modelo["total_cartera"]
+        total_monto_esperado = resultado_modelo["total_monto_esperado"]
+        total_retorno = resultado_modelo["total_retorno"]
+        prom_riesgo = resultado_modelo["prom_riesgo"]
+        prom_conversion = resultado_modelo["prom_conversion"]
         
         slide = prs.slides.add_slide(prs.slide_layouts[6])
         
@@ -1042,29 +1379,7 @@ def generar_presentacion_dashboard(df_cli: pd.DataFrame) -> bytes:
             p.level = 1
         
         # Gráfica de métricas financieras
-        fig, ax = plt.subplots(figsize=(8, 2.5))
-        
-        categorias = ['Cartera\nTotal', 'Conversión\nEsperada', 'Retorno\nEsperado']
-        valores = [total_cartera, total_monto_esperado, total_retorno]
-        colores = ['#007bff', '#28a745', '#ffc107']
-        
-        bars = ax.bar(categorias, valores, color=colores, alpha=0.7, edgecolor='black')
-        ax.set_ylabel('Monto ($)', fontsize=11)
-        ax.set_title('Análisis Financiero de Cartera', fontsize=13, fontweight='bold')
-        
-        # Agregar valores en las barras
-        for bar, valor in zip(bars, valores):
-            height = bar.get_height()
-            ax.text(bar.get_x() + bar.get_width()/2., height,
-                   f'{formatear_monto(valor)}',
-                   ha='center', va='bottom', fontsize=11, fontweight='bold')
-        
-        plt.tight_layout()
-        
-        img_stream = BytesIO()
-        plt.savefig(img_stream, format='png', dpi=150, bbox_inches='tight')
-        plt.close()
-        img_stream.seek(0)
+        img_stream = BytesIO(imagenes["financiero"])
         
         slide.shapes.add_picture(img_stream, Inches(1), Inches(4.2), width=Inches(8))
     
@@ -1080,31 +1395,7 @@ def generar_presentacion_dashboard(df_cli: pd.DataFrame) -> bytes:
     title_p.font.color.rgb = RGBColor(33, 37, 41)
     
     # Gráfica de barras horizontales con todos los estatus
-    fig, ax = plt.subplots(figsize=(8, 5))
-    
-    # Ordenar por cantidad
-    top_10_estatus = estatus_counts.head(10)
-    
-    estatus_labels = [str(e)[:25] for e in top_10_estatus.index]
-    cantidades = top_10_estatus.values
-    
-    bars = ax.barh(estatus_labels, cantidades, color='#17a2b8')
-    ax.set_xlabel('Cantidad de Clientes', fontsize=11)
-    ax.set_title('Top 10 Estatus (por cantidad)', fontsize=13, fontweight='bold')
-    ax.invert_yaxis()
-    
-    # Agregar valores
-    for bar, cantidad in zip(bars, cantidades):
-        ax.text(bar.get_width(), bar.get_y() + bar.get_height()/2,
-               f' {int(cantidad)}',
-               va='center', fontsize=10, fontweight='bold')
-    
-    plt.tight_layout()
-    
-    img_stream = BytesIO()
-    plt.savefig(img_stream, format='png', dpi=150, bbox_inches='tight')
-    plt.close()
-    img_stream.seek(0)
+    img_stream = BytesIO(imagenes["estatus"])
     
     slide.shapes.add_picture(img_stream, Inches(0.8), Inches(1.2), width=Inches(8.4))
     
@@ -1119,32 +1410,8 @@ def generar_presentacion_dashboard(df_cli: pd.DataFrame) -> bytes:
     title_p.font.bold = True
     title_p.font.color.rgb = RGBColor(33, 37, 41)
     
-    # Contar clientes por sucursal
-    sucursal_counts = df_cli["sucursal"].fillna("Sin sucursal").value_counts()
-    
-    # Crear gráfica de barras
-    fig, ax = plt.subplots(figsize=(8, 5))
-    
-    sucursal_labels = [str(s)[:30] for s in sucursal_counts.index]
-    cantidades = sucursal_counts.values
-    
-    bars = ax.barh(sucursal_labels, cantidades, color='#6f42c1')
-    ax.set_xlabel('Cantidad de Clientes', fontsize=11)
-    ax.set_title('Clientes por Sucursal', fontsize=13, fontweight='bold')
-    ax.invert_yaxis()
-    
-    # Agregar valores
-    for bar, cantidad in zip(bars, cantidades):
-        ax.text(bar.get_width(), bar.get_y() + bar.get_height()/2,
-               f' {int(cantidad)}',
-               va='center', fontsize=10, fontweight='bold')
-    
-    plt.tight_layout()
-    
-    img_stream = BytesIO()
-    plt.savefig(img_stream, format='png', dpi=150, bbox_inches='tight')
-    plt.close()
-    img_stream.seek(0)
+    # Gráfica de clientes por sucursal
+    img_stream = BytesIO(imagenes["sucursales"])
     
     slide.shapes.add_picture(img_stream, Inches(0.8), Inches(1.2), width=Inches(8.4))
     
@@ -1159,33 +1426,8 @@ def generar_presentacion_dashboard(df_cli: pd.DataFrame) -> bytes:
     title_p.font.bold = True
     title_p.font.color.rgb = RGBColor(33, 37, 41)
     
-    # Contar clientes por asesor
-    asesor_counts = df_cli["asesor"].fillna("Sin asesor").value_counts()
-    
-    # Crear gráfica de barras (mostrar top 10 si hay muchos)
-    fig, ax = plt.subplots(figsize=(8, 5))
-    
-    top_asesores = asesor_counts.head(10)
-    asesor_labels = [str(a)[:30] for a in top_asesores.index]
-    cantidades = top_asesores.values
-    
-    bars = ax.barh(asesor_labels, cantidades, color='#fd7e14')
-    ax.set_xlabel('Cantidad de Clientes', fontsize=11)
-    ax.set_title('Top 10 Asesores (por cantidad de clientes)', fontsize=13, fontweight='bold')
-    ax.invert_yaxis()
-    
-    # Agregar valores
-    for bar, cantidad in zip(bars, cantidades):
-        ax.text(bar.get_width(), bar.get_y() + bar.get_height()/2,
-               f' {int(cantidad)}',
-               va='center', fontsize=10, fontweight='bold')
-    
-    plt.tight_layout()
-    
-    img_stream = BytesIO()
-    plt.savefig(img_stream, format='png', dpi=150, bbox_inches='tight')
-    plt.close()
-    img_stream.seek(0)
+    # Gráfica de asesores (top 10 si hay muchos)
+    img_stream = BytesIO(imagenes["asesores"])
     
     slide.shapes.add_picture(img_stream, Inches(0.8), Inches(1.2), width=Inches(8.4))
     
@@ -1281,6 +1523,104 @@ DOCS_DIR.mkdir(parents=True, exist_ok=True)
 CLIENTES_CSV = DATA_DIR / "clientes.csv"
 CLIENTES_XLSX = DATA_DIR / "clientes.xlsx"
 
+# --- Escritura segura de archivos locales ---
+# Varias sesiones (y varios procesos de Streamlit) escriben los mismos archivos: cada escritura
+# toma un candado consultivo (flock sobre <archivo>.lock) y reemplaza el archivo de forma atómica
+# (temporal en el mismo directorio + fsync + os.replace), así nadie lee un archivo a medias.
+try:
+    import fcntl
+except ImportError:  # Windows: solo se serializa dentro del proceso
+    fcntl = None
+from contextlib import contextmanager
+
+ARCHIVO_LOCK_TIMEOUT_S = 30
+_BLOQUEOS_ARCHIVOS = _estado_compartido("bloqueos_archivos")
+
+def _registrar_espera_bloqueo(ruta: Path, espera: float) -> None:
+    """Acumula la espera por candado (total, máxima y por archivo) para el panel de admin."""
+    with _BLOQUEOS_ARCHIVOS.setdefault("lock", threading.Lock()):
+        m = _BLOQUEOS_ARCHIVOS.setdefault("metricas", {"adquisiciones": 0, "con_espera": 0, "espera_s": 0.0, "max_s": 0.0, "por_archivo": {}})
+        m["adquisiciones"] += 1
+        m["espera_s"] += espera
+        m["max_s"] = max(m["max_s"], espera)
+        if espera > 0.001:
+            m["con_espera"] += 1
+            m["por_archivo"][ruta.name] = m["por_archivo"].get(ruta.name, 0.0) + espera
+
+def metricas_bloqueos() -> dict:
+    """Copia de las métricas de espera por candados de archivo."""
+    with _BLOQUEOS_ARCHIVOS.setdefault("lock", threading.Lock()):
+        m = _BLOQUEOS_ARCHIVOS.get("metricas") or {"adquisiciones": 0, "con_espera": 0, "espera_s": 0.0, "max_s": 0.0, "por_archivo": {}}
+        return {**m, "por_archivo": dict(m["por_archivo"])}
+
+@contextmanager
+def bloqueo_archivo(ruta: Path, exclusivo: bool = True):
+    """Candado consultivo sobre `ruta` entre procesos e hilos (compartido para lecturas)."""
+    ruta = Path(ruta)
+    inicio = time.monotonic()
+    if fcntl is None:
+        lock = _BLOQUEOS_ARCHIVOS.setdefault(str(ruta.resolve()), threading.Lock())
+        if not lock.acquire(timeout=ARCHIVO_LOCK_TIMEOUT_S):
+            raise TimeoutError(f"Archivo ocupado: {ruta.name}")
+        _registrar_espera_bloqueo(ruta, time.monotonic() - inicio)
+        try:
+            yield
+        finally:
+            lock.release()
+        return
+    ruta.parent.mkdir(parents=True, exist_ok=True)
+    fh = open(ruta.with_name(ruta.name + ".lock"), "a+")
+    try:
+        modo = fcntl.LOCK_EX if exclusivo else fcntl.LOCK_SH
+        while True:
+            try:
+                fcntl.flock(fh.fileno(), modo | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() - inicio > ARCHIVO_LOCK_TIMEOUT_S:
+                    raise TimeoutError(f"Archivo ocupado: {ruta.name}")
+                time.sleep(0.01)
+        _registrar_espera_bloqueo(ruta, time.monotonic() - inicio)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+    finally:
+        fh.close()
+
+@contextmanager
+def archivo_atomico(ruta: Path):
+    """
+    Entrega una ruta temporal junto a `ruta`; al salir sin error la reemplaza de forma atómica.
+    El reemplazo conserva los permisos de `ruta` (o los de un archivo nuevo según el umask).
+    """
+    ruta = Path(ruta)
+    try:
+        modo = os.stat(ruta).st_mode & 0o7777
+    except FileNotFoundError:
+        modo = None
+    tmp = ruta.with_name(f".{ruta.name}.{secrets.token_hex(8)}.tmp")
+    # 0o666 con O_EXCL: el umask aplica igual que en open(); no el 0600 fijo de mkstemp
+    os.close(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+    try:
+        if modo is not None:
+            os.chmod(tmp, modo)
+        yield tmp
+        with open(tmp, "rb+") as fh:
+            os.fsync(fh.fileno())
+        os.replace(tmp, ruta)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+def escribir_atomico(ruta: Path, datos, encoding: str = "utf-8") -> None:
+    """Reemplaza `ruta` con `datos` (str o bytes) bajo candado exclusivo."""
+    with bloqueo_archivo(ruta), archivo_atomico(ruta) as tmp:
+        tmp.write_bytes(datos.encode(encoding) if isinstance(datos, str) else datos)
+
+def guardar_json(ruta: Path, obj) -> None:
+    """JSON con el formato de los catálogos (indentado, sin escapar acentos), escrito de forma atómica."""
+    escribir_atomico(ruta, json.dumps(obj, ensure_ascii=False, indent=2))
+
 # === CONFIGURACIÓN GOOGLE SHEETS ===
 USE_GSHEETS = True   # pon False si quieres trabajar sólo local
 GSHEET_ID      = "10_xueUKm0O1QwOK1YtZI-dFZlNdKVv82M2z29PfM9qk"
@@ -1292,23 +1632,169 @@ GSHEET_SUCURSALES_TAB = "sucursales"
 GSHEET_ASESORES_TAB = "asesores"  
 GSHEET_ESTATUS_TAB = "estatus"
 GSHEET_SEGUNDO_ESTATUS_TAB = "segundo_estatus"
+GSHEET_USERSTAB = "users"  # usuarios
 
 
 # Opcional: pega aquí el contenido JSON del service account si prefieres no usar el archivo
 # Si la variable está vacía (""), se seguirá leyendo `service_account.json` desde disco.
 SERVICE_ACCOUNT_JSON_STR = ""
-# CACHING para gspread: minimizar auth / apertura repetida durante reruns
-_GS_CREDS = None
-_GS_GC = None
-_GS_SH = None
-_GS_WS_CACHE: dict = {}
+# --- Programador de llamadas a Google Sheets ---
+# Toda petición de gspread pasa por ClienteHTTPProgramado: cupo por minuto (token bucket
+# compartido entre sesiones), lecturas repetidas en la misma ejecución se sirven una sola
+# vez, 429/5xx se reintentan con backoff exponencial con jitter y todo queda contado.
+# Las escrituras no idempotentes (values:append, batchUpdate del libro) solo se reintentan
+# si la petición no llegó a Google o si hubo 429; ante otro error se propaga y quien llama
+# relee la hoja antes de volver a intentar (la réplica lo hace en su siguiente ronda).
+GS_CUOTA_LECTURAS_MIN = 55     # Sheets: 60 lecturas/min por usuario (la cuenta de servicio)
+GS_CUOTA_ESCRITURAS_MIN = 55   # Sheets: 60 escrituras/min por usuario
+GS_MAX_ESPERA_S = 20           # espera máxima por cupo; después se intenta y, si hay 429, se reintenta
+GS_MAX_REINTENTOS = 5
+GS_BACKOFF_BASE_S = 1.0
+GS_BACKOFF_MAX_S = 32.0
+GS_COALESCER_S = 10            # vigencia de una lectura para repetirla dentro de la misma ejecución
+
+@st.cache_resource
+def _programador_gsheets() -> dict:
+    """Cubetas, contadores y lecturas por hilo, compartidos por todas las sesiones."""
+    ahora = time.monotonic()
+    return {
+        "lock": threading.Lock(),
+        "cubetas": {"lectura": [GS_CUOTA_LECTURAS_MIN, ahora], "escritura": [GS_CUOTA_ESCRITURAS_MIN, ahora]},
+        "hilo": threading.local(),
+        "contadores": {"lecturas": 0, "escrituras": 0, "coalescidas": 0, "reintentos": 0, "errores": 0, "espera_s": 0.0, "ultimo_error": ""},
+    }
+
+def _contar_gsheets(**incrementos) -> None:
+    estado = _programador_gsheets()
+    with estado["lock"]:
+        for k, v in incrementos.items():
+            if k == "ultimo_error":
+                estado["contadores"][k] = v
+            else:
+                estado["contadores"][k] += v
+
+def _tomar_cupo_gsheets(tipo: str) -> float:
+    """Consume un turno de la cubeta `tipo`, esperando si hace falta. Retorna los segundos esperados."""
+    estado = _programador_gsheets()
+    capacidad = GS_CUOTA_LECTURAS_MIN if tipo == "lectura" else GS_CUOTA_ESCRITURAS_MIN
+    esperado = 0.0
+    while True:
+        with estado["lock"]:
+            tokens, ts = estado["cubetas"][tipo]
+            ahora = time.monotonic()
+            tokens = min(capacidad, tokens + (ahora - ts) * capacidad / 60.0)
+            if tokens >= 1:
+                estado["cubetas"][tipo] = [tokens - 1, ahora]
+                return esperado
+            estado["cubetas"][tipo] = [tokens, ahora]
+            falta = (1 - tokens) * 60.0 / capacidad
+        if esperado + falta > GS_MAX_ESPERA_S:
+            return esperado
+        time.sleep(falta)
+        esperado += falta
+
+def _es_idempotente_gsheets(metodo: str, endpoint: str) -> bool:
+    """Repetir la petición deja la hoja igual: lecturas y escrituras de valores en rangos fijos."""
+    metodo = metodo.upper()
+    if metodo in ("GET", "PUT"):
+        return True
+    ruta = str(endpoint).split("?")[0]
+    return metodo == "POST" and ruta.endswith((":batchGet", ":batchGetByDataFilter", "values:batchUpdate", ":clear", ":batchClear"))
+
+def _peticion_no_enviada(error: Exception) -> bool:
+    """True si falló al conectar: la petición nunca llegó al servidor."""
+    import requests, urllib3
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        causa = error.args[0] if error.args else None
+        return isinstance(getattr(causa, "reason", causa), urllib3.exceptions.NewConnectionError)
+    return False
+
+def _es_reintentable_gsheets(error: Exception, idempotente: bool = True) -> bool:
+    import requests
+    codigo = getattr(getattr(error, "response", None), "status_code", None) or getattr(error, "code", None)
+    if _peticion_no_enviada(error) or codigo == 429:  # 429: Sheets la rechazó sin aplicarla
+        return True
+    if not idempotente:
+        return False  # pudo aplicarse y perderse la respuesta: repetirla duplicaría filas
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return isinstance(codigo, int) and (codigo == 408 or codigo >= 500)
+
+def _espera_backoff(intento: int) -> float:
+    """Backoff exponencial con jitter completo."""
+    import random
+    return random.uniform(0, min(GS_BACKOFF_MAX_S, GS_BACKOFF_BASE_S * (2 ** intento)))
+
+def nueva_ronda_gsheets() -> None:
+    """Inicia el registro de lecturas de esta ejecución (lo que se coalesce)."""
+    _programador_gsheets()["hilo"].lecturas = {}
+
+def programar_gsheets(metodo: str, clave, llamada, idempotente: bool | None = None):
+    """Ejecuta `llamada` respetando cupo, coalescencia de lecturas y reintentos."""
+    estado = _programador_gsheets()
+    es_lectura = metodo.upper() == "GET"
+    if idempotente is None:
+        idempotente = metodo.upper() in ("GET", "PUT")
+    lecturas = getattr(estado["hilo"], "lecturas", None)  # None fuera del hilo del script
+    if lecturas is not None:
+        if es_lectura:
+            previo = lecturas.get(clave)
+            if previo is not None and (time.monotonic() - previo[0]) < GS_COALESCER_S:
+                _contar_gsheets(coalescidas=1)
+                return previo[1]
+        else:
+            lecturas.clear()  # una escritura invalida lo leído
+    tipo = "lectura" if es_lectura else "escritura"
+    for intento in range(GS_MAX_REINTENTOS + 1):
+        _contar_gsheets(espera_s=_tomar_cupo_gsheets(tipo))
+        try:
+            respuesta = llamada()
+        except Exception as e:
+            if intento >= GS_MAX_REINTENTOS or not _es_reintentable_gsheets(e, idempotente):
+                _contar_gsheets(errores=1, ultimo_error=str(e)[:200])
+                raise
+            _contar_gsheets(reintentos=1)
+            time.sleep(_espera_backoff(intento))
+            continue
+        _contar_gsheets(**{"lecturas" if es_lectura else "escrituras": 1})
+        if es_lectura and lecturas is not None:
+            lecturas[clave] = (time.monotonic(), respuesta)
+        return respuesta
+
+def metricas_gsheets() -> dict:
+    estado = _programador_gsheets()
+    with estado["lock"]:
+        return dict(estado["contadores"])
+
+class ClienteHTTPProgramado(gspread.http_client.HTTPClient):
+    """HTTPClient de gspread que pasa cada petición por programar_gsheets."""
+
+    def request(self, method, endpoint, params=None, data=None, json=None, files=None, headers=None):
+        clave = (endpoint, repr(params))
+        base = gspread.http_client.HTTPClient.request
+        return programar_gsheets(
+            method, clave, lambda: base(self, method, endpoint, params=params, data=data, json=json, files=files, headers=headers),
+            idempotente=_es_idempotente_gsheets(method, endpoint),
+        )
+
+nueva_ronda_gsheets()
+
+# CACHING para gspread: credenciales, cliente (sesión HTTP keep-alive), libro y pestañas
+# viven en un pool compartido por todas las sesiones; no se re-autentica en cada rerun.
+GS_METADATA_TTL_S = 600     # cada cuánto se vuelve a listar las pestañas (una sola llamada)
+GS_TOKEN_MARGEN_S = 300     # renovar el token antes de que expire
 
-# Variables globales para caché de worksheets con timestamp
-_GS_WS_CACHE_TIME = {}
+@st.cache_resource
+def _pool_gsheets() -> dict:
+    """Estado compartido de Google Sheets; `lock` protege solo el reemplazo de sus entradas (la red va fuera)."""
+    return {"lock": threading.RLock(), "creds": None, "gc": None, "sh": None, "ws": {}, "ts_ws": 0.0}
 
 # Variables globales para caché de clientes
 _CLIENTES_CACHE = None
 _CLIENTES_CACHE_TIME = 0
+_CLIENTES_LEIDO = None  # {id: (versión, fila)} de la réplica al cargar en esta ejecución (control optimista)
 
 # Variables globales para caché de historial
 _HISTORIAL_CACHE = None
@@ -1334,9 +1820,9 @@ _CATALOGS_CACHE_TIME = {
 
 def _gs_credentials():
     """Carga credenciales desde Streamlit secrets - Versión mejorada para Streamlit Cloud"""
-    global _GS_CREDS
-    if _GS_CREDS is not None:
-        return _GS_CREDS
+    pool = _pool_gsheets()
+    if pool["creds"] is not None:
+        return pool["creds"]
     try:
         # 1) Streamlit Secrets (PRIMARIO para Streamlit Cloud)
         if hasattr(st, "secrets"):
@@ -1358,8 +1844,8 @@ def _gs_credentials():
                     sa_info["private_key"] = sa_info["private_key"].replace("\\n", "\n")
                 
                 scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-                _GS_CREDS = Credentials.from_service_account_info(sa_info, scopes=scopes)
-                return _GS_CREDS
+                pool["creds"] = Credentials.from_service_account_info(sa_info, scopes=scopes)
+                return pool["creds"]
         
         # 2) Fallback para desarrollo local
         try:
@@ -1369,8 +1855,8 @@ def _gs_credentials():
                 if "private_key" in sa_info:
                     sa_info["private_key"] = sa_info["private_key"].replace("\\n", "\n")
                 scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-                _GS_CREDS = Credentials.from_service_account_info(sa_info, scopes=scopes)
-                return _GS_CREDS
+                pool["creds"] = Credentials.from_service_account_info(sa_info, scopes=scopes)
+                return pool["creds"]
         except FileNotFoundError:
             pass
             
@@ -1381,56 +1867,119 @@ def _gs_credentials():
         st.error(f"❌ Error en autenticación Google Sheets: {str(e)}")
         return None
 
+def _gs_renovar_token(creds) -> None:
+    """Renueva el token de la cuenta de servicio si venció o está por vencer."""
+    from datetime import timezone
+    expira = getattr(creds, "expiry", None)
+    ahora = datetime.now(timezone.utc).replace(tzinfo=None)
+    if not creds.valid or (expira is not None and (expira - ahora).total_seconds() < GS_TOKEN_MARGEN_S):
+        creds.refresh(Request())
+
+def _gs_reiniciar_pool() -> None:
+    """Descarta libro y pestañas (p. ej. tras un error); se reconstruyen en la siguiente llamada."""
+    pool = _pool_gsheets()
+    with pool["lock"]:
+        pool.update(gc=None, sh=None, ws={}, ts_ws=0.0)
+
+def _gs_spreadsheet():
+    """Libro de Google Sheets compartido (None si no hay credenciales o no se pudo abrir)."""
+    pool = _pool_gsheets()
+    creds = _gs_credentials()
+    if creds is None:
+        return None
+    try:
+        _gs_renovar_token(creds)
+    except Exception:
+        pass  # gspread vuelve a intentar al recibir 401
+    if pool["sh"] is not None:
+        return pool["sh"]
+    # Se abre fuera del lock (puede esperar cupo/backoff); si otra sesión ganó, se usa el suyo
+    try:
+        gc = gspread.authorize(creds, http_client=ClienteHTTPProgramado)
+        sh = gc.open_by_key(GSHEET_ID)
+    except Exception:
+        return None
+    with pool["lock"]:
+        if pool["sh"] is None:
+            pool.update(gc=gc, sh=sh)
+        return pool["sh"]
+
 def _gs_open_worksheet(tab_name: str, force_reload: bool = False):
-    """Versión con caché temporal para evitar recargas innecesarias"""
-    global _GS_GC, _GS_SH, _GS_WS_CACHE, _GS_WS_CACHE_TIME
-    
-    # Verificar si el caché es reciente (menos de 5 segundos)
-    import time
-    now = time.time()
-    cache_duration = 5  # segundos
-    
-    if not force_reload and tab_name in _GS_WS_CACHE:
-        if tab_name in _GS_WS_CACHE_TIME:
-            if (now - _GS_WS_CACHE_TIME[tab_name]) < cache_duration:
-                return _GS_WS_CACHE[tab_name]
-    
+    """
+    Pestaña del libro desde el pool. Las pestañas se listan todas en una llamada y se
+    vuelven a listar solo si falta la pedida, al forzar recarga o cada GS_METADATA_TTL_S.
+    """
+    pool = _pool_gsheets()
     try:
-        creds = _gs_credentials()
-        if creds is None:
+        sh = _gs_spreadsheet()
+        if sh is None:
             return None
-
-        if _GS_GC is None:
-            _GS_GC = gspread.authorize(creds)
-        
-        if _GS_SH is None:
+        # Las llamadas de red van fuera del lock; bajo él solo se reemplaza pool["ws"]
+        vencido = (time.time() - pool["ts_ws"]) > GS_METADATA_TTL_S
+        ws = pool["ws"].get(tab_name)
+        if force_reload or vencido or ws is None:
+            pestanas = {w.title: w for w in sh.worksheets()}
+            with pool["lock"]:
+                pool.update(ws=pestanas, ts_ws=time.time())
+            ws = pestanas.get(tab_name)
+        if ws is None:
             try:
-                _GS_SH = _GS_GC.open_by_key(GSHEET_ID)
+                ws = sh.add_worksheet(title=tab_name, rows="5000", cols="50")
             except Exception:
-                return None
-
-        try:
-            ws = _GS_SH.worksheet(tab_name)
-        except gspread.exceptions.WorksheetNotFound:
-            ws = _GS_SH.add_worksheet(title=tab_name, rows="5000", cols="50")
-
-        _GS_WS_CACHE[tab_name] = ws
-        _GS_WS_CACHE_TIME[tab_name] = now
+                # Otra sesión pudo crearla al mismo tiempo
+                ws = {w.title: w for w in sh.worksheets()}.get(tab_name)
+                if ws is None:
+                    raise
+            with pool["lock"]:
+                pool["ws"] = {**pool["ws"], tab_name: ws}
         return ws
-        
     except Exception:
+        # Health check: ante un error de red/autenticación se rehace el cliente
+        _gs_reiniciar_pool()
         return None
 
+# --- Lectura inicial en batch ---
+# Al arrancar cada ejecución se leen clientes, usuarios y catálogos con un solo
+# spreadsheets.values.batchGet; cada cargador consume su pestaña (una vez) en lugar
+# de abrir la hoja y pedirla por separado.
+GSHEET_BOOTSTRAP_TABS = [GSHEET_TAB, GSHEET_USERSTAB, GSHEET_SUCURSALES_TAB, GSHEET_ESTATUS_TAB, GSHEET_SEGUNDO_ESTATUS_TAB]
+_GS_BOOTSTRAP: dict = {}
+
+def bootstrap_gsheets(tabs: list | None = None) -> None:
+    """Lee las pestañas indicadas en una sola petición y deja sus valores en _GS_BOOTSTRAP."""
+    if not USE_GSHEETS:
+        return
+    tabs = list(tabs or GSHEET_BOOTSTRAP_TABS)
+    try:
+        sh = _gs_spreadsheet()
+        if sh is None:
+            return
+        resp = sh.values_batch_get(["'" + t.replace("'", "''") + "'" for t in tabs], params={"valueRenderOption": "FORMATTED_VALUE"})
+        for tab, rango in zip(tabs, resp.get("valueRanges", [])):
+            _GS_BOOTSTRAP[tab] = rango.get("values", [])
+    except Exception:
+        pass  # si falla (p. ej. falta una pestaña) cada cargador lee la suya como antes
+
+def _gs_bootstrap_valores(tab: str) -> list | None:
+    """Valores leídos en el arranque para `tab` (se entregan una sola vez)."""
+    return _GS_BOOTSTRAP.pop(tab, None)
+
+def _df_desde_valores(valores: list) -> pd.DataFrame:
+    """DataFrame (texto) a partir de filas de valores con encabezado; sin filas vacías."""
+    if not valores:
+        return pd.DataFrame()
+    encabezado = [str(c) for c in valores[0]]
+    ancho = len(encabezado)
+    filas = [list(map(str, f[:ancho])) + [""] * (ancho - len(f)) for f in valores[1:] if any(str(x).strip() for x in f)]
+    return pd.DataFrame(filas, columns=encabezado)
+
 def limpiar_cache_gsheets():
     """Limpia todos los cachés de Google Sheets para forzar recarga de datos."""
-    global _GS_GC, _GS_SH, _GS_WS_CACHE, _CLIENTES_CACHE, _CLIENTES_CACHE_TIME, _GS_WS_CACHE_TIME
+    global _CLIENTES_CACHE, _CLIENTES_CACHE_TIME
     global _HISTORIAL_CACHE, _HISTORIAL_CACHE_TIME, _USUARIOS_CACHE, _USUARIOS_CACHE_TIME
     global _CATALOGS_CACHE, _CATALOGS_CACHE_TIME
     
-    _GS_WS_CACHE.clear()
-    _GS_WS_CACHE_TIME.clear()
-    _GS_GC = None
-    _GS_SH = None
+    _pool_gsheets()["ts_ws"] = 0.0  # volver a listar pestañas; el cliente autenticado se conserva
     _CLIENTES_CACHE = None
     _CLIENTES_CACHE_TIME = 0
     _HISTORIAL_CACHE = None
@@ -1483,7 +2032,7 @@ def load_sucursales() -> list:
             if gsheet_data:
                 # Sincronizar con archivo local
                 try:
-                    SUCURSALES_FILE.write_text(json.dumps(gsheet_data, ensure_ascii=False, indent=2), encoding="utf-8")
+                    guardar_json(SUCURSALES_FILE, gsheet_data)
                 except Exception:
                     pass
                 return gsheet_data
@@ -1502,7 +2051,7 @@ def load_sucursales() -> list:
     
     # Si todo falla, usar valores por defecto y crearlos
     try:
-        SUCURSALES_FILE.write_text(json.dumps(defaults, ensure_ascii=False, indent=2), encoding="utf-8")
+        guardar_json(SUCURSALES_FILE, defaults)
         # También sincronizar con Google Sheets si está disponible
         if USE_GSHEETS:
             sync_catalog_to_gsheet("sucursales", defaults, GSHEET_SUCURSALES_TAB)
@@ -1513,7 +2062,7 @@ def load_sucursales() -> list:
 def save_sucursales(lst: list):
     try:
         clean = [str(x).strip() for x in lst if str(x).strip()]
-        SUCURSALES_FILE.write_text(json.dumps(clean, ensure_ascii=False, indent=2), encoding="utf-8")
+        guardar_json(SUCURSALES_FILE, clean)
         # Limpiar cache relacionado
         _cache_data.pop("sucursales", None)
         _cache_timestamp.pop("sucursales", None)
@@ -1523,8 +2072,6 @@ def save_sucursales(lst: list):
     except Exception:
         pass
 
-# Inicializar lista de sucursales desde disco
-SUCURSALES = load_sucursales()
 ESTATUS_FILE = DATA_DIR / "estatus.json"
 SEGUNDO_ESTATUS_FILE = DATA_DIR / "segundo_estatus.json"
 
@@ -1541,7 +2088,7 @@ def load_estatus() -> list:
             if gsheet_data:
                 # Sincronizar con archivo local
                 try:
-                    ESTATUS_FILE.write_text(json.dumps(gsheet_data, ensure_ascii=False, indent=2), encoding="utf-8")
+                    guardar_json(ESTATUS_FILE, gsheet_data)
                 except Exception:
                     pass
                 return gsheet_data
@@ -1559,7 +2106,7 @@ def load_estatus() -> list:
     
     # Si todo falla, usar valores por defecto
     try:
-        ESTATUS_FILE.write_text(json.dumps(defaults, ensure_ascii=False, indent=2), encoding="utf-8")
+        guardar_json(ESTATUS_FILE, defaults)
         # También sincronizar con Google Sheets si está disponible
         if USE_GSHEETS:
             sync_catalog_to_gsheet("estatus", defaults, GSHEET_ESTATUS_TAB)
@@ -1597,7 +2144,7 @@ def clear_cache():
 def save_estatus(lst: list):
     try:
         clean = [str(x).strip() for x in lst if str(x).strip()]
-        ESTATUS_FILE.write_text(json.dumps(clean, ensure_ascii=False, indent=2), encoding="utf-8")
+        guardar_json(ESTATUS_FILE, clean)
         # Limpiar cache relacionado
         _cache_data.pop("estatus", None)
         _cache_timestamp.pop("estatus", None)
@@ -1620,7 +2167,7 @@ def load_segundo_estatus() -> list:
             if gsheet_data:
                 # Sincronizar con archivo local
                 try:
-                    SEGUNDO_ESTATUS_FILE.write_text(json.dumps(gsheet_data, ensure_ascii=False, indent=2), encoding="utf-8")
+                    guardar_json(SEGUNDO_ESTATUS_FILE, gsheet_data)
                 except Exception:
                     pass
                 return gsheet_data
@@ -1638,7 +2185,7 @@ def load_segundo_estatus() -> list:
     
     # Si todo falla, usar valores por defecto
     try:
-        SEGUNDO_ESTATUS_FILE.write_text(json.dumps(defaults, ensure_ascii=False, indent=2), encoding="utf-8")
+        guardar_json(SEGUNDO_ESTATUS_FILE, defaults)
         # También sincronizar con Google Sheets si está disponible
         if USE_GSHEETS:
             sync_catalog_to_gsheet("segundo_estatus", defaults, GSHEET_SEGUNDO_ESTATUS_TAB)
@@ -1649,7 +2196,7 @@ def load_segundo_estatus() -> list:
 def save_segundo_estatus(lst: list):
     try:
         clean = [str(x).strip() for x in lst if (str(x).strip() or x == "")]
-        SEGUNDO_ESTATUS_FILE.write_text(json.dumps(clean, ensure_ascii=False, indent=2), encoding="utf-8")
+        guardar_json(SEGUNDO_ESTATUS_FILE, clean)
         # Limpiar cache relacionado
         _cache_data.pop("segundo_estatus", None)
         _cache_timestamp.pop("segundo_estatus", None)
@@ -1659,48 +2206,338 @@ def save_segundo_estatus(lst: list):
     except Exception:
         pass
 
-# === FUNCIONES DE SINCRONIZACIÓN CON GOOGLE SHEETS ===
+MODELO_RIESGO_FILE = DATA_DIR / "modelo_riesgo.json"
 
-def sync_catalog_to_gsheet(catalog_name: str, catalog_data: list, sheet_tab: str):
-    """Sincroniza un catálogo local a Google Sheets"""
-    if not USE_GSHEETS:
-        return
+def load_modelo_riesgo() -> dict:
+    """
+    Carga los pesos del modelo financiero (prob_conversion, factor_retorno, riesgo_pct por estatus)
+    desde JSON local; completa con MODELO_RIESGO_DEFAULT lo que falte.
+    """
+    modelo = json.loads(json.dumps(MODELO_RIESGO_DEFAULT))
     try:
-        ws = _gs_open_worksheet(sheet_tab)
-        if ws is None:
-            return
-        
-        # Crear DataFrame con el catálogo
-        df_catalog = pd.DataFrame({"valor": catalog_data})
-        
-        # Limpiar la hoja y escribir los datos
-        ws.clear()
-        ws.update("A1", [["valor"]])  # Encabezado
-        if not df_catalog.empty:
-            rows = df_catalog.values.tolist()
-            ws.append_rows(rows, value_input_option="RAW")
-            
+        if MODELO_RIESGO_FILE.exists():
+            data = json.loads(MODELO_RIESGO_FILE.read_text(encoding="utf-8"))
+            if isinstance(data, dict):
+                for clave in ("rechazo", "default"):
+                    modelo[clave].update({k: float(v) for k, v in (data.get(clave) or {}).items() if k in MODELO_PESOS})
+                if isinstance(data.get("estatus"), dict):
+                    modelo["estatus"] = {
+                        str(est).strip(): {k: float(pesos.get(k, modelo["default"][k])) for k in MODELO_PESOS}
+                        for est, pesos in data["estatus"].items() if str(est).strip() and isinstance(pesos, dict)
+                    }
+            return modelo
     except Exception:
-        pass  # Fallar silenciosamente
+        pass
+    try:
+        guardar_json(MODELO_RIESGO_FILE, modelo)
+    except Exception:
+        pass
+    return modelo
 
-def load_catalog_from_gsheet(sheet_tab: str, default_values: list = None, force_reload: bool = False) -> list:
+def save_modelo_riesgo(modelo: dict):
+    try:
+        guardar_json(MODELO_RIESGO_FILE, modelo)
+    except Exception:
+        pass
+
+# === REPORTES PRE-GENERADOS (presentaciones del dashboard) ===
+REPORTES_DIR = DATA_DIR / "reportes"
+REPORTES_INTERVALO_HORAS = 24  # reconstruir aunque no cambien los datos (la portada lleva la fecha)
+REPORTES_SOLICITUD_DIAS = 7    # solo se pre-generan el global y los alcances pedidos en estos días
+_REPORTES_CACHE = _estado_compartido("reportes_pptx")
+
+@st.cache_resource(show_spinner=False)
+def _ejecutor_reportes():
+    """Un solo hilo de fondo para construir presentaciones sin bloquear las sesiones."""
+    import concurrent.futures
+    return concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="reportes")
+
+def clave_reporte(df: pd.DataFrame, modelo: dict | None = None) -> str:
+    """Hash del contenido (sin importar el orden de filas), de los pesos del modelo, de la plantilla y del día."""
+    h = hashlib.sha1(version_datos(df, orden=False).encode("utf-8"))
+    h.update(json.dumps(modelo or {}, sort_keys=True, default=str).encode("utf-8"))
+    plantilla_pptx()
+    h.update(repr(_PLANTILLA_CACHE.get("firma")).encode("utf-8"))
+    h.update(date.today().isoformat().encode("utf-8"))
+    return h.hexdigest()
+
+def variantes_reporte(df: pd.DataFrame) -> dict:
+    """Subconjuntos a pre-generar: global, cada sucursal y cada asesor. {(tipo, valor): df}"""
+    variantes = {("global", ""): df}
+    for col in ("sucursal", "asesor"):
+        if col not in df.columns:
+            continue
+        valores = df[col].fillna("").astype(str).str.strip()
+        for valor, sub in df.groupby(valores, sort=True):
+            if valor:
+                variantes[(col, valor)] = sub
+    return variantes
+
+def _archivo_reporte(clave: str) -> Path:
+    return REPORTES_DIR / f"{clave}.pptx"
+
+def _lock_reportes():
+    """Lock del estado compartido de reportes (solicitados, clave y futuro se leen y escriben juntos)."""
+    return _REPORTES_CACHE.setdefault("lock", threading.Lock())
+
+def solicitar_reporte(variante: tuple) -> None:
+    """Marca un alcance (tipo, valor) como pedido por algún usuario: entra en la pre-generación."""
+    with _lock_reportes():
+        _REPORTES_CACHE.setdefault("solicitados", {})[variante] = time.time()
+
+def reportes_solicitados() -> set:
+    """Global más los alcances pedidos en los últimos REPORTES_SOLICITUD_DIAS."""
+    limite = time.time() - REPORTES_SOLICITUD_DIAS * 86400
+    with _lock_reportes():
+        solicitados = _REPORTES_CACHE.setdefault("solicitados", {})
+        for variante, ts in list(solicitados.items()):
+            if ts < limite:
+                solicitados.pop(variante, None)
+        return {("global", ""), *solicitados}
+
+def construir_reportes(df: pd.DataFrame, modelo: dict | None = None, solicitados: set | None = None) -> dict:
     """
-    Carga un catálogo desde Google Sheets con caché inteligente
-    force_reload: True para forzar recarga desde Google Sheets
+    Genera (si no existen) las presentaciones de las variantes en `solicitados` (todas si es None)
+    y las guarda por hash. Se ejecuta en el hilo de fondo: no usa st.*. Borra archivos que ya no
+    corresponden a ninguna variante. Retorna el índice {(tipo, valor): clave}.
     """
-    global _CATALOGS_CACHE, _CATALOGS_CACHE_TIME
-    
-    if not USE_GSHEETS:
-        return default_values or []
-    
-    # Determinar qué catálogo es basándose en sheet_tab
-    catalog_name = None
-    if "sucursal" in sheet_tab.lower():
-        catalog_name = "sucursales"
-    elif "segundo" in sheet_tab.lower() or "2" in sheet_tab.lower():
-        catalog_name = "segundo_estatus"
-    elif "estatus" in sheet_tab.lower() or "status" in sheet_tab.lower():
-        catalog_name = "estatus"
+    REPORTES_DIR.mkdir(parents=True, exist_ok=True)
+    indice = {}
+    for variante, sub in variantes_reporte(df).items():
+        if solicitados is not None and variante not in solicitados:
+            continue
+        try:
+            clave = clave_reporte(sub, modelo)
+            destino = _archivo_reporte(clave)
+            if not destino.exists():
+                tmp = destino.with_suffix(".tmp")
+                tmp.write_bytes(generar_presentacion_dashboard(sub, modelo))
+                os.replace(tmp, destino)
+            indice[variante] = clave
+        except Exception:
+            pass
+    vigentes = {f"{c}.pptx" for c in indice.values()}
+    for f in REPORTES_DIR.glob("*.pptx"):
+        if f.name not in vigentes:
+            try:
+                f.unlink()
+            except Exception:
+                pass
+    _REPORTES_CACHE["indice"] = indice
+    return indice
+
+def programar_reportes(df: pd.DataFrame, modelo: dict | None = None, clave: str | None = None) -> None:
+    """
+    Encola la reconstrucción en segundo plano de los alcances solicitados cuando cambian los
+    datos/pesos o los alcances, o cuando pasan REPORTES_INTERVALO_HORAS desde la última.
+    No hace nada si ya hay una en curso. `clave` evita recalcular clave_reporte(df, modelo).
+    """
+    solicitados = reportes_solicitados()
+    clave = (clave or clave_reporte(df, modelo), frozenset(solicitados))
+    with _lock_reportes():
+        futuro = _REPORTES_CACHE.get("futuro")
+        if futuro is not None and not futuro.done():
+            return
+        vencido = time.time() - _REPORTES_CACHE.get("construido", 0) > REPORTES_INTERVALO_HORAS * 3600
+        if _REPORTES_CACHE.get("clave") == clave and not vencido:
+            return
+        try:
+            _REPORTES_CACHE["futuro"] = _ejecutor_reportes().submit(construir_reportes, df.copy(), modelo, solicitados)
+            _REPORTES_CACHE["clave"] = clave
+            _REPORTES_CACHE["construido"] = time.time()
+        except Exception:
+            pass
+
+def reporte_cacheado(df: pd.DataFrame, modelo: dict | None = None, clave: str | None = None) -> Path | None:
+    """Archivo de la presentación ya generada para exactamente estos datos, o None (no se lee aquí)."""
+    try:
+        archivo = _archivo_reporte(clave or clave_reporte(df, modelo))
+        return archivo if archivo.exists() else None
+    except Exception:
+        return None
+
+# === TRABAJOS DE EXPORTACIÓN EN SEGUNDO PLANO ===
+# Las exportaciones grandes se escriben a archivos temporales en hilos de fondo;
+# la sesión solo guarda el id del trabajo (no los bytes).
+EXPORTS_DIR = Path(tempfile.gettempdir()) / "crm_kapitaliza_exports"
+EXPORT_MAX_EDAD_S = 2 * 3600          # se descartan archivos listos con más de 2 horas
+EXPORT_MAX_BYTES = 512 * 1024 * 1024  # y los más antiguos si el total supera 512 MB
+_TRABAJOS_EXPORT = _estado_compartido("trabajos_export")
+
+@st.cache_resource(show_spinner=False)
+def _ejecutor_exportaciones():
+    """Pool de hilos compartido para construir exportaciones."""
+    import concurrent.futures
+    return concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="exportaciones")
+
+def _ejecutar_trabajo(job_id: str, generador) -> None:
+    """Corre en el hilo de fondo (sin st.*): escribe a .part y renombra al terminar."""
+    trabajo = _TRABAJOS_EXPORT.get(job_id)
+    if trabajo is None:
+        return
+    trabajo["estado"] = "en_proceso"
+    destino = EXPORTS_DIR / f"{job_id}.out"
+    parcial = destino.with_suffix(".part")
+    def progreso(valor: float):
+        trabajo["progreso"] = max(0.0, min(1.0, float(valor)))
+    try:
+        EXPORTS_DIR.mkdir(parents=True, exist_ok=True)
+        generador(parcial, progreso)
+        os.replace(parcial, destino)
+        trabajo.update(estado="listo", progreso=1.0, ruta=destino, tamano=destino.stat().st_size, terminado=time.time())
+    except Exception as e:
+        trabajo.update(estado="error", error=str(e), terminado=time.time())
+        try:
+            parcial.unlink()
+        except Exception:
+            pass
+    limpiar_exportaciones()
+
+def encolar_exportacion(nombre_archivo: str, mime: str, generador, clave: str | None = None) -> str:
+    """
+    Encola una exportación. generador(destino: Path, progreso: callable) escribe el archivo.
+    Si ya hay un trabajo vigente con la misma clave (mismo contenido) y el mismo nombre de archivo
+    se reutiliza; la clave debe incluir el alcance (cliente, filtro) además del contenido.
+    Retorna el id del trabajo.
+    """
+    if clave is not None:
+        for job_id, t in list(_TRABAJOS_EXPORT.items()):
+            if t.get("clave") == clave and t["nombre"] == nombre_archivo and t["estado"] in ("en_cola", "en_proceso", "listo"):
+                if t["estado"] != "listo" or Path(t["ruta"]).exists():
+                    return job_id
+    job_id = secrets.token_hex(8)
+    _TRABAJOS_EXPORT[job_id] = {
+        "estado": "en_cola", "progreso": 0.0, "nombre": nombre_archivo, "mime": mime,
+        "clave": clave, "creado": time.time(), "ruta": None, "tamano": 0, "error": "",
+    }
+    try:
+        _ejecutor_exportaciones().submit(_ejecutar_trabajo, job_id, generador)
+    except Exception as e:
+        _TRABAJOS_EXPORT[job_id].update(estado="error", error=str(e))
+    return job_id
+
+def estado_exportacion(job_id: str | None) -> dict | None:
+    """Copia del estado del trabajo (None si no existe o ya fue descartado)."""
+    t = _TRABAJOS_EXPORT.get(job_id) if job_id else None
+    if t is None or (t["estado"] == "listo" and not Path(t["ruta"]).exists()):
+        return None
+    return dict(t)
+
+def limpiar_exportaciones() -> None:
+    """Descarta trabajos terminados por antigüedad y, si el total excede EXPORT_MAX_BYTES, los más viejos."""
+    ahora = time.time()
+    terminados = sorted(
+        ((jid, t) for jid, t in list(_TRABAJOS_EXPORT.items()) if t["estado"] in ("listo", "error")),
+        key=lambda x: x[1].get("terminado", 0)
+    )
+    total = sum(t.get("tamano", 0) for _, t in terminados)
+    for jid, t in terminados:
+        if ahora - t.get("terminado", 0) > EXPORT_MAX_EDAD_S or total > EXPORT_MAX_BYTES:
+            total -= t.get("tamano", 0)
+            _TRABAJOS_EXPORT.pop(jid, None)
+            try:
+                if t.get("ruta"):
+                    Path(t["ruta"]).unlink()
+            except Exception:
+                pass
+    # Archivos huérfanos (p. ej. de un reinicio del servidor)
+    try:
+        vigentes = set(_TRABAJOS_EXPORT)
+        for f in EXPORTS_DIR.glob("*"):
+            if f.stem not in vigentes and ahora - f.stat().st_mtime > EXPORT_MAX_EDAD_S:
+                f.unlink()
+    except Exception:
+        pass
+
+def panel_exportacion(etiqueta: str, key: str, nombre_archivo: str, mime: str, generador, clave: str | None = None, al_encolar=None) -> None:
+    """
+    UI de una exportación en segundo plano: botón para prepararla, progreso mientras
+    corre y botón de descarga cuando está lista. Solo el id del trabajo vive en session_state.
+    """
+    estado_key = f"_job_{key}"
+    if st.button(etiqueta, key=f"btn_{key}"):
+        st.session_state[estado_key] = encolar_exportacion(nombre_archivo, mime, generador, clave)
+        if al_encolar is not None:
+            try:
+                al_encolar()
+            except Exception:
+                pass
+
+    def _mostrar():
+        t = estado_exportacion(st.session_state.get(estado_key))
+        if t is None:
+            return
+        if t["estado"] in ("en_cola", "en_proceso"):
+            st.progress(t["progreso"], text=f"⏳ Preparando {t['nombre']}… {t['progreso']*100:.0f}%")
+        elif t["estado"] == "error":
+            st.error(f"No se pudo preparar {t['nombre']}: {t['error']}")
+        else:
+            ruta = Path(t["ruta"])
+            st.download_button(
+                f"⬇️ Descargar {t['nombre']} ({t['tamano']/1024/1024:.1f} MB)",
+                data=lambda: ruta.read_bytes(),
+                file_name=t["nombre"],
+                mime=t["mime"],
+                key=f"dl_{key}"
+            )
+
+    t = estado_exportacion(st.session_state.get(estado_key))
+    if t is not None and t["estado"] in ("en_cola", "en_proceso") and hasattr(st, "fragment"):
+        # Refrescar solo este bloque hasta que termine; luego rerun completo para mostrar la descarga
+        @st.fragment(run_every=1)
+        def _sondeo():
+            actual = estado_exportacion(st.session_state.get(estado_key))
+            if actual is None or actual["estado"] not in ("en_cola", "en_proceso"):
+                st.rerun()
+            _mostrar()
+        _sondeo()
+    else:
+        _mostrar()
+        if t is not None and t["estado"] in ("en_cola", "en_proceso"):
+            st.button("🔄 Actualizar", key=f"refresh_{key}")
+
+# === FUNCIONES DE SINCRONIZACIÓN CON GOOGLE SHEETS ===
+
+def sync_catalog_to_gsheet(catalog_name: str, catalog_data: list, sheet_tab: str):
+    """Sincroniza un catálogo local a Google Sheets"""
+    if not USE_GSHEETS:
+        return
+    try:
+        ws = _gs_open_worksheet(sheet_tab)
+        if ws is None:
+            return
+        
+        # Crear DataFrame con el catálogo
+        df_catalog = pd.DataFrame({"valor": catalog_data})
+        
+        # Limpiar la hoja y escribir los datos
+        ws.clear()
+        ws.update("A1", [["valor"]])  # Encabezado
+        if not df_catalog.empty:
+            rows = df_catalog.values.tolist()
+            ws.append_rows(rows, value_input_option="RAW")
+            
+    except Exception:
+        pass  # Fallar silenciosamente
+
+def load_catalog_from_gsheet(sheet_tab: str, default_values: list = None, force_reload: bool = False) -> list:
+    """
+    Carga un catálogo desde Google Sheets con caché inteligente
+    force_reload: True para forzar recarga desde Google Sheets
+    """
+    global _CATALOGS_CACHE, _CATALOGS_CACHE_TIME
+    
+    if not USE_GSHEETS:
+        return default_values or []
+    
+    # Determinar qué catálogo es basándose en sheet_tab
+    catalog_name = None
+    if "sucursal" in sheet_tab.lower():
+        catalog_name = "sucursales"
+    elif "segundo" in sheet_tab.lower() or "2" in sheet_tab.lower():
+        catalog_name = "segundo_estatus"
+    elif "estatus" in sheet_tab.lower() or "status" in sheet_tab.lower():
+        catalog_name = "estatus"
     elif "asesor" in sheet_tab.lower():
         catalog_name = "asesores"
     
@@ -1716,15 +2553,19 @@ def load_catalog_from_gsheet(sheet_tab: str, default_values: list = None, force_
                 return _CATALOGS_CACHE[catalog_name].copy()
     
     try:
-        ws = _gs_open_worksheet(sheet_tab, force_reload=force_reload)
-        if ws is None:
-            # Si hay caché antiguo, usarlo
-            if catalog_name and _CATALOGS_CACHE.get(catalog_name) is not None:
-                return _CATALOGS_CACHE[catalog_name].copy()
-            return default_values or []
-        
-        # Obtener todos los valores
-        data = ws.get_all_records()
+        valores = None if force_reload else _gs_bootstrap_valores(sheet_tab)
+        if valores is not None:
+            data = _df_desde_valores(valores).to_dict("records")
+        else:
+            ws = _gs_open_worksheet(sheet_tab, force_reload=force_reload)
+            if ws is None:
+                # Si hay caché antiguo, usarlo
+                if catalog_name and _CATALOGS_CACHE.get(catalog_name) is not None:
+                    return _CATALOGS_CACHE[catalog_name].copy()
+                return default_values or []
+
+            # Obtener todos los valores
+            data = ws.get_all_records()
         if data:
             values = [str(row.get("valor", "")).strip() for row in data]
             # Filtrar valores vacíos
@@ -1799,7 +2640,13 @@ def load_catalogs_from_gsheet():
     except Exception:
         pass  # Mantener valores actuales si falla
 
-# Inicializar catálogos desde disco (con posible actualización desde Google Sheets)
+# Inicializar catálogos desde disco (con posible actualización desde Google Sheets).
+# Va después de load_catalog_from_gsheet: antes, load_sucursales fallaba con NameError y
+# las sucursales nunca se leían de Sheets al arrancar.
+_REPLICA = _estado_compartido("replica_clientes")  # réplica local de clientes (ver cargar_clientes)
+# Con la réplica ya cargada, los clientes se concilian en segundo plano: no hace falta leerlos aquí
+bootstrap_gsheets([t for t in GSHEET_BOOTSTRAP_TABS if t != GSHEET_TAB or not _REPLICA.get("ultimo_intento")])
+SUCURSALES = load_sucursales()
 ESTATUS_OPCIONES = load_estatus()
 SEGUNDO_ESTATUS_OPCIONES = load_segundo_estatus()
 
@@ -1831,6 +2678,165 @@ def sort_df_by_dates(df: pd.DataFrame) -> pd.DataFrame:
         return df.sort_values(date_cols, ascending=True, na_position="last").reset_index(drop=True)
     return df
 
+# --- Exportaciones (Excel / CSV / Parquet) ---
+_EXPORTACIONES_CACHE = _estado_compartido("exportaciones")
+
+def formatos_exportacion() -> dict:
+    """Formatos disponibles según las librerías instaladas: {clave: (nombre, extensión, mime)}."""
+    formatos = {}
+    for modulo in ("xlsxwriter", "openpyxl"):
+        try:
+            __import__(modulo)
+            formatos["xlsx"] = ("Excel", "xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            break
+        except Exception:
+            continue
+    formatos["csv"] = ("CSV", "csv", "text/csv")
+    try:
+        import pyarrow  # type: ignore  # noqa: F401
+        formatos["parquet"] = ("Parquet", "parquet", "application/vnd.apache.parquet")
+    except Exception:
+        pass
+    return formatos
+
+def _nombre_hoja(nombre: str, usados: set) -> str:
+    """Nombre de pestaña válido para Excel (máx. 31 caracteres, sin / \\ * ? : [ ]) y sin repetir."""
+    base = re.sub(r'[/\\*?:\[\]]', '_', str(nombre or "Sin_asesor"))[:31] or "Sin_asesor"
+    hoja, n = base, 1
+    while hoja.lower() in usados:
+        n += 1
+        hoja = f"{base[:31 - len(str(n)) - 1]}_{n}"
+    usados.add(hoja.lower())
+    return hoja
+
+def hojas_por_asesor(df: pd.DataFrame) -> dict:
+    """Una hoja por asesor en una sola pasada de groupby; vacíos como '(Sin asesor)'."""
+    asesor = df["asesor"].fillna("(Sin asesor)").replace({"": "(Sin asesor)"})
+    usados = set()
+    return {_nombre_hoja(a, usados): sub for a, sub in df.assign(asesor=asesor).groupby(asesor, sort=True)}
+
+def escribir_xlsx(hojas: dict) -> bytes:
+    """
+    Escribe {nombre_hoja: DataFrame} a XLSX. Con xlsxwriter usa constant_memory
+    (fila por fila a un archivo temporal, sin mantener la hoja en memoria);
+    si solo hay openpyxl usa pandas.
+    """
+    import tempfile
+    try:
+        import xlsxwriter  # type: ignore
+    except Exception:
+        bio = io.BytesIO()
+        with pd.ExcelWriter(bio, engine="openpyxl") as writer:
+            for nombre, df in hojas.items():
+                df.to_excel(writer, index=False, sheet_name=nombre)
+        return bio.getvalue()
+
+    fd, ruta = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        wb = xlsxwriter.Workbook(ruta, {"constant_memory": True, "default_date_format": "yyyy-mm-dd hh:mm:ss"})
+        for nombre, df in hojas.items():
+            ws = wb.add_worksheet(nombre)
+            ws.write_row(0, 0, [str(c) for c in df.columns])
+            valores = df.astype(object).where(df.notna(), None)
+            for i, fila in enumerate(valores.itertuples(index=False, name=None), start=1):
+                ws.write_row(i, 0, fila)
+        wb.close()
+        return Path(ruta).read_bytes()
+    finally:
+        try:
+            os.unlink(ruta)
+        except Exception:
+            pass
+
+def generador_csv(df: pd.DataFrame, bloque: int = 5000):
+    """Generador para encolar_exportacion: escribe el CSV por bloques reportando progreso."""
+    def _generar(destino: Path, progreso):
+        n = len(df)
+        with open(destino, "w", encoding="utf-8", newline="") as fh:
+            df.iloc[:0].to_csv(fh, index=False)
+            for inicio in range(0, n, bloque):
+                df.iloc[inicio:inicio + bloque].to_csv(fh, index=False, header=False)
+                progreso((inicio + bloque) / n)
+    return _generar
+
+# Formatos ya comprimidos: se guardan sin recomprimir (STORED)
+ZIP_SIN_COMPRIMIR = {
+    ".pdf", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+    ".zip", ".rar", ".7z", ".gz", ".docx", ".xlsx", ".pptx", ".mp3", ".mp4", ".mov",
+}
+
+def _entradas_zip(archivos: list) -> list:
+    """Normaliza a [(Path, nombre_en_zip)]; acepta Paths sueltos o tuplas (Path, nombre)."""
+    return [(Path(a[0]), a[1]) if isinstance(a, tuple) else (Path(a), Path(a).name) for a in archivos]
+
+def manifiesto_archivos(archivos: list) -> str:
+    """Huella de (nombre, tamaño, mtime) de los archivos; cambia si se agrega, borra o modifica alguno."""
+    h = hashlib.sha1()
+    for ruta, nombre in sorted(_entradas_zip(archivos), key=lambda e: e[1]):
+        try:
+            info = ruta.stat()
+            h.update(f"{nombre}|{info.st_size}|{info.st_mtime_ns}\n".encode("utf-8"))
+        except OSError:
+            h.update(f"{nombre}|-\n".encode("utf-8"))
+    return h.hexdigest()
+
+def generador_zip(archivos: list):
+    """
+    Generador para encolar_exportacion: ZIP escrito directo al archivo temporal del trabajo,
+    copiando cada documento por bloques (sin cargarlo completo). Progreso por archivo.
+    """
+    entradas = _entradas_zip(archivos)
+    def _generar(destino: Path, progreso):
+        with zipfile.ZipFile(destino, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for i, (ruta, nombre) in enumerate(entradas, start=1):
+                tipo = zipfile.ZIP_STORED if ruta.suffix.lower() in ZIP_SIN_COMPRIMIR else zipfile.ZIP_DEFLATED
+                zf.write(ruta, arcname=nombre, compress_type=tipo)
+                progreso(i / len(entradas))
+    return _generar
+
+def archivos_clientes(ids: list) -> list:
+    """Documentos de varios clientes para un ZIP masivo: [(Path, 'id_nombre/archivo')]."""
+    docs = docs_indexados(ids)
+    entradas = []
+    for cid, grupo in docs.groupby("cliente_id", sort=False):
+        carpeta = f"{safe_name(str(cid))}_{safe_name(get_nombre_by_id(cid) or '')}"
+        entradas += [(DOCS_DIR / c / n, f"{carpeta}/{n}") for c, n in zip(grupo["carpeta"], grupo["nombre"])]
+    return entradas
+
+def exportar_clientes(df: pd.DataFrame, formato: str = "xlsx", por_asesor: bool = False) -> bytes:
+    """
+    Genera la exportación de clientes (ordenada por fechas) en el formato pedido.
+    Pensada para download_button(data=callable): solo corre al hacer clic.
+    Cachea por (formato, por_asesor, huella de los datos filtrados).
+    """
+    clave = (formato, por_asesor, version_datos(df))
+    if clave in _EXPORTACIONES_CACHE:
+        return _EXPORTACIONES_CACHE[clave]
+    try:
+        df_export = sort_df_by_dates(df) if not df.empty else df.copy()
+    except Exception:
+        df_export = df.copy()
+    if formato == "csv":
+        datos = df_export.to_csv(index=False).encode("utf-8-sig")
+    elif formato == "parquet":
+        bio = io.BytesIO()
+        try:
+            df_export.to_parquet(bio, index=False)
+        except Exception:
+            bio = io.BytesIO()
+            df_export.astype(str).to_parquet(bio, index=False)
+        datos = bio.getvalue()
+    else:
+        hojas = hojas_por_asesor(df_export) if por_asesor else {"Filtrados": df_export}
+        try:
+            datos = escribir_xlsx(hojas)
+        except Exception:
+            # fallback: convertir todo a texto y volver a escribir
+            datos = escribir_xlsx({n: h.astype(str) for n, h in hojas.items()})
+    _cache_guardar(_EXPORTACIONES_CACHE, clave, datos, max_items=4)
+    return datos
+
 def parse_dates_flexible(date_series: pd.Series) -> pd.Series:
     """
     Parsea fechas de manera flexible, manejando formatos MM/DD/YYYY y DD/MM/YYYY.
@@ -1914,6 +2920,7 @@ def carpeta_docs_cliente(cid: str) -> Path:
             if id_folder.exists() and id_folder.is_dir() and not name_folder.exists():
                 # mover la carpeta entera para preservar archivos previos
                 shutil.move(str(id_folder), str(name_folder))
+                mover_carpeta_indice(id_safe, name_safe)
         except Exception:
             # si la migración falla, no bloquear: seguiremos usando/creando name_folder
             pass
@@ -1974,84 +2981,332 @@ def canonicalize_from_catalog(
 from googleapiclient.http import MediaIoBaseUpload
 import io
 
+# --- Subidas a Google Drive ---
+# Un servicio por sesión (y uno por hilo del pool, porque httplib2 no es thread-safe),
+# ids de carpetas en caché, subidas en paralelo y permisos públicos en un solo batch.
+DRIVE_CARPETA_RAIZ = "CRM Kapitaliza"
+DRIVE_MAX_HILOS = 4
+DRIVE_RESUMABLE_MIN = 5 * 1024 * 1024   # a partir de aquí, subida reanudable por bloques
+DRIVE_CHUNK = 8 * 1024 * 1024           # múltiplo de 256 KB
+_DRIVE_HILO = threading.local()
+
+@st.cache_resource
+def _ejecutor_drive():
+    """Pool acotado compartido para las subidas a Drive."""
+    import concurrent.futures
+    return concurrent.futures.ThreadPoolExecutor(max_workers=DRIVE_MAX_HILOS, thread_name_prefix="drive")
+
+def drive_service():
+    """Servicio de Drive de la sesión; se reconstruye solo si cambian las credenciales."""
+    creds = st.session_state.get("drive_creds")
+    if not creds:
+        return None
+    cache = st.session_state.get("_drive_service")
+    if not cache or cache[0] is not creds:
+        cache = (creds, build("drive", "v3", credentials=creds, cache_discovery=False))
+        st.session_state["_drive_service"] = cache
+    return cache[1]
+
+def _drive_service_hilo(creds):
+    """Servicio propio de cada hilo del pool (se reutiliza entre subidas)."""
+    if getattr(_DRIVE_HILO, "creds", None) is not creds:
+        _DRIVE_HILO.service = build("drive", "v3", credentials=creds, cache_discovery=False)
+        _DRIVE_HILO.creds = creds
+    return _DRIVE_HILO.service
+
+def _buscar_o_crear_carpeta_drive(service, nombre: str, parent_id: str | None = None) -> str:
+    nombre_q = nombre.replace("\\", "\\\\").replace("'", "\\'")
+    query = f"name='{nombre_q}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
+    if parent_id:
+        query += f" and '{parent_id}' in parents"
+    results = service.files().list(q=query, fields="files(id, name)", pageSize=1).execute()
+    if results.get("files"):
+        return results["files"][0]["id"]
+    metadata = {"name": nombre, "mimeType": "application/vnd.google-apps.folder"}
+    if parent_id:
+        metadata["parents"] = [parent_id]
+    return service.files().create(body=metadata, fields="id").execute().get("id")
+
+# --- Registro de carpetas de Drive ---
+# cuenta de Drive + id de cliente → id de carpeta, en data/drive_carpetas.json y en la
+# pestaña "drive_carpetas". Resolver la carpeta no cuesta llamadas a la API y renombrar
+# al cliente no crea otra carpeta; reconciliar_carpetas_drive() pone al día los nombres.
+DRIVE_REGISTRO_FILE = DATA_DIR / "drive_carpetas.json"
+GSHEET_DRIVE_TAB = "drive_carpetas"
+DRIVE_REGISTRO_COLS = ["cuenta", "cliente_id", "carpeta_id", "nombre", "actualizado"]
+_DRIVE_REGISTRO = _estado_compartido("drive_registro")
+
+def _nombre_carpeta_drive(cliente_id, cliente_nombre="") -> str:
+    """Nombre de la carpeta del cliente: solo el nombre (sin ID), limpio y acotado."""
+    if str(cliente_nombre or "").strip():
+        return re.sub(r'[<>:"/\\|?*]', '_', str(cliente_nombre).strip())[:100]
+    return f"Cliente_{cliente_id}"
+
+def cuenta_drive(service=None) -> str:
+    """Correo de la cuenta de Drive conectada (una consulta por sesión)."""
+    cuenta = st.session_state.get("_drive_cuenta")
+    if cuenta is None:
+        service = service or drive_service()
+        try:
+            cuenta = service.about().get(fields="user(emailAddress)").execute()["user"]["emailAddress"]
+        except Exception:
+            cuenta = ""
+        st.session_state["_drive_cuenta"] = cuenta
+    return cuenta
+
+def _registro_drive() -> dict:
+    """Registro en memoria {(cuenta, cliente_id): fila}; se carga una vez (local + Sheets)."""
+    if "filas" not in _DRIVE_REGISTRO:
+        filas = []
+        try:
+            if DRIVE_REGISTRO_FILE.exists():
+                filas = json.loads(DRIVE_REGISTRO_FILE.read_text(encoding="utf-8"))
+        except Exception:
+            filas = []
+        if USE_GSHEETS:
+            try:
+                ws = _gs_open_worksheet(GSHEET_DRIVE_TAB)
+                if ws is not None:
+                    filas += ws.get_all_records()
+            except Exception:
+                pass
+        registro = {}
+        # Si hay repetidos (local vs. Sheets o actualizaciones), gana el más reciente
+        for fila in sorted(filas, key=lambda f: str(f.get("actualizado", ""))):
+            fila = {c: str(fila.get(c, "") or "") for c in DRIVE_REGISTRO_COLS}
+            if fila["carpeta_id"]:
+                registro[(fila["cuenta"], fila["cliente_id"])] = fila
+        _DRIVE_REGISTRO["filas"] = registro
+    return _DRIVE_REGISTRO["filas"]
+
+def _guardar_registro_drive_local() -> None:
+    try:
+        DRIVE_REGISTRO_FILE.parent.mkdir(parents=True, exist_ok=True)
+        guardar_json(DRIVE_REGISTRO_FILE, list(_registro_drive().values()))
+    except Exception:
+        pass
+
+def registrar_carpeta_drive(cuenta: str, cliente_id: str, carpeta_id: str, nombre: str) -> None:
+    """Guarda (o actualiza) la carpeta de un cliente; en Sheets se agrega una fila."""
+    fila = {"cuenta": cuenta, "cliente_id": str(cliente_id), "carpeta_id": carpeta_id,
+            "nombre": nombre, "actualizado": datetime.now().isoformat(timespec="seconds")}
+    _registro_drive()[(cuenta, str(cliente_id))] = fila
+    _guardar_registro_drive_local()
+    if USE_GSHEETS:
+        try:
+            ws = _gs_open_worksheet(GSHEET_DRIVE_TAB)
+            if ws is not None:
+                if not ws.row_values(1):
+                    ws.update("A1", [DRIVE_REGISTRO_COLS])
+                ws.append_row([fila[c] for c in DRIVE_REGISTRO_COLS], value_input_option="RAW")
+        except Exception:
+            pass
+
+def _sincronizar_registro_drive_gsheet() -> None:
+    """Reescribe la pestaña con una fila por carpeta (compacta las actualizaciones)."""
+    if not USE_GSHEETS:
+        return
+    try:
+        ws = _gs_open_worksheet(GSHEET_DRIVE_TAB)
+        if ws is None:
+            return
+        ws.clear()
+        filas = [[f[c] for c in DRIVE_REGISTRO_COLS] for f in _registro_drive().values()]
+        ws.update("A1", [DRIVE_REGISTRO_COLS] + filas)
+    except Exception:
+        pass
+
+def olvidar_carpeta_drive(cuenta: str, cliente_id: str) -> None:
+    """Quita una carpeta del registro en memoria y local (la próxima resolución la busca o crea)."""
+    if _registro_drive().pop((cuenta, str(cliente_id)), None) is not None:
+        _guardar_registro_drive_local()
+
+def _carpeta_drive_no_disponible(error: Exception) -> bool:
+    """La carpeta destino ya no existe (404) o está en la papelera (ver _subir_bytes_drive)."""
+    return isinstance(error, FileNotFoundError) or getattr(getattr(error, "resp", None), "status", None) == 404
+
 def crear_carpeta_cliente_drive(cliente_id, cliente_nombre=""):
-    """Crea o encuentra la carpeta del cliente en Google Drive."""
-    if not st.session_state.drive_creds:
+    """Id de la carpeta del cliente en Google Drive: del registro, o la busca/crea y la registra."""
+    service = drive_service()
+    if service is None:
         return None
-    
-    drive_service = build("drive", "v3", credentials=st.session_state.drive_creds)
-    
-    # Buscar carpeta principal "CRM Kapitaliza"
-    query = "name='CRM Kapitaliza' and mimeType='application/vnd.google-apps.folder' and trashed=false"
-    results = drive_service.files().list(q=query, fields="files(id, name)").execute()
-    
-    if not results.get('files'):
-        # Crear carpeta principal
-        folder_metadata = {
-            'name': 'CRM Kapitaliza',
-            'mimeType': 'application/vnd.google-apps.folder'
-        }
-        main_folder = drive_service.files().create(body=folder_metadata, fields='id').execute()
-        main_folder_id = main_folder.get('id')
-    else:
-        main_folder_id = results['files'][0]['id']
-    
-    # Buscar carpeta del cliente - usar solo el nombre (sin ID)
-    if cliente_nombre:
-        # Limpiar el nombre para evitar problemas con caracteres especiales
-        import re
-        folder_name = re.sub(r'[<>:"/\\|?*]', '_', cliente_nombre.strip())
-        folder_name = folder_name[:100]  # Limitar longitud para evitar problemas
+    cuenta = cuenta_drive(service)
+    registro = _registro_drive()
+
+    raiz = registro.get((cuenta, ""))
+    if raiz is None:
+        raiz_id = _buscar_o_crear_carpeta_drive(service, DRIVE_CARPETA_RAIZ)
+        registrar_carpeta_drive(cuenta, "", raiz_id, DRIVE_CARPETA_RAIZ)
     else:
-        folder_name = f"Cliente_{cliente_id}"
-    
-    # Buscar si ya existe una carpeta con este nombre
-    query = f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and '{main_folder_id}' in parents and trashed=false"
-    results = drive_service.files().list(q=query, fields="files(id, name)").execute()
-    
-    if not results.get('files'):
-        # Crear carpeta del cliente
-        folder_metadata = {
-            'name': folder_name,
-            'mimeType': 'application/vnd.google-apps.folder',
-            'parents': [main_folder_id]
-        }
-        client_folder = drive_service.files().create(body=folder_metadata, fields='id').execute()
-        return client_folder.get('id')
+        raiz_id = raiz["carpeta_id"]
+
+    fila = registro.get((cuenta, str(cliente_id)))
+    if fila is not None:
+        return fila["carpeta_id"]
+    folder_name = _nombre_carpeta_drive(cliente_id, cliente_nombre)
+    carpeta_id = _buscar_o_crear_carpeta_drive(service, folder_name, raiz_id)
+    registrar_carpeta_drive(cuenta, str(cliente_id), carpeta_id, folder_name)
+    return carpeta_id
+
+def reconciliar_carpetas_drive(df: pd.DataFrame | None = None) -> dict:
+    """
+    Revisa las carpetas registradas de la cuenta conectada (en batch): quita las borradas o
+    en papelera y renombra las de clientes cuyo nombre cambió. Retorna los conteos.
+    """
+    service = drive_service()
+    resumen = {"verificadas": 0, "renombradas": 0, "eliminadas": 0}
+    if service is None:
+        return resumen
+    cuenta = cuenta_drive(service)
+    registro = _registro_drive()
+    filas = {cid: f for (c, cid), f in registro.items() if c == cuenta}
+    if df is None:
+        df = cargar_clientes()
+    nombres = {}
+    if isinstance(df, pd.DataFrame) and {"id", "nombre"} <= set(df.columns):
+        nombres = dict(zip(df["id"].astype(str), df["nombre"].fillna("").astype(str)))
+
+    estado = {}
+    def _recibir(request_id, response, exception):
+        # 404 = la carpeta ya no existe; otros errores (cuota, red) no se toman como borrado
+        if exception is None:
+            estado[request_id] = response
+        elif getattr(getattr(exception, "resp", None), "status", None) == 404:
+            estado[request_id] = {"trashed": True}
+
+    claves = list(filas)
+    for i in range(0, len(claves), 100):
+        batch = service.new_batch_http_request(callback=_recibir)
+        for cid in claves[i:i + 100]:
+            batch.add(service.files().get(fileId=filas[cid]["carpeta_id"], fields="id, name, trashed"), request_id=cid)
+        try:
+            batch.execute()
+        except Exception:
+            return resumen
+
+    renombrar = []
+    for cid in claves:
+        meta = estado.get(cid)
+        if meta is None:
+            continue
+        if meta.get("trashed"):
+            registro.pop((cuenta, cid), None)
+            resumen["eliminadas"] += 1
+            continue
+        resumen["verificadas"] += 1
+        if cid and cid not in nombres:
+            continue  # cliente eliminado: se conserva la carpeta tal cual
+        esperado = _nombre_carpeta_drive(cid, nombres[cid]) if cid else DRIVE_CARPETA_RAIZ
+        if meta.get("name") != esperado:
+            renombrar.append((cid, esperado))
+    for i in range(0, len(renombrar), 100):
+        batch = service.new_batch_http_request(callback=_recibir)
+        for cid, esperado in renombrar[i:i + 100]:
+            batch.add(service.files().update(fileId=filas[cid]["carpeta_id"], body={"name": esperado}, fields="id"), request_id=f"ren:{cid}")
+        try:
+            batch.execute()
+        except Exception:
+            continue
+    ahora = datetime.now().isoformat(timespec="seconds")
+    for cid, esperado in renombrar:
+        if estado.get(f"ren:{cid}") is not None:
+            registro[(cuenta, cid)] = {**filas[cid], "nombre": esperado, "actualizado": ahora}
+            resumen["renombradas"] += 1
+    _guardar_registro_drive_local()
+    _sincronizar_registro_drive_gsheet()
+    return resumen
+
+def _subir_bytes_drive(creds, nombre: str, datos: bytes, mimetype: str, parent_id: str | None) -> tuple[str, str]:
+    """
+    Sube un archivo desde un hilo del pool. Retorna (id, webViewLink).
+    Si la carpeta destino está en la papelera el archivo cae ahí: se borra y se lanza FileNotFoundError.
+    """
+    service = _drive_service_hilo(creds)
+    metadata = {"name": nombre}
+    if parent_id:
+        metadata["parents"] = [parent_id]
+    mimetype = mimetype or "application/octet-stream"
+    if len(datos) >= DRIVE_RESUMABLE_MIN:
+        media = MediaIoBaseUpload(io.BytesIO(datos), mimetype=mimetype, chunksize=DRIVE_CHUNK, resumable=True)
+        request = service.files().create(body=metadata, media_body=media, fields="id, webViewLink, trashed")
+        respuesta = None
+        while respuesta is None:
+            _, respuesta = request.next_chunk(num_retries=3)
     else:
-        return results['files'][0]['id']
+        media = MediaIoBaseUpload(io.BytesIO(datos), mimetype=mimetype, resumable=False)
+        respuesta = service.files().create(body=metadata, media_body=media, fields="id, webViewLink, trashed").execute(num_retries=3)
+    if respuesta.get("trashed"):
+        try:
+            service.files().delete(fileId=respuesta.get("id")).execute()
+        except Exception:
+            pass
+        raise FileNotFoundError(f"Carpeta de Drive en la papelera: {parent_id}")
+    return respuesta.get("id"), respuesta.get("webViewLink")
+
+def publicar_en_drive(service, file_ids: list) -> None:
+    """Permiso de lectura pública para varios archivos en batch (máx. 100 por petición)."""
+    for i in range(0, len(file_ids), 100):
+        batch = service.new_batch_http_request(callback=lambda *_: None)  # si no se puede hacer público, continuar
+        for fid in file_ids[i:i + 100]:
+            batch.add(service.permissions().create(fileId=fid, body={"type": "anyone", "role": "reader"}, fields="id"))
+        try:
+            batch.execute()
+        except Exception:
+            pass
+
+def subir_varios_a_drive(items: list, cliente_id=None, cliente_nombre="") -> list:
+    """
+    Sube [(nombre, bytes, mimetype)] a la carpeta del cliente en paralelo.
+    Retorna [(nombre, enlace o None)] en el mismo orden.
+    """
+    service = drive_service()
+    if service is None or not items:
+        return [(nombre, None) for nombre, _, _ in items]
+    creds = st.session_state.get("drive_creds")
+    parent_id = crear_carpeta_cliente_drive(cliente_id, cliente_nombre) if cliente_id else None
+
+    def _subir(lote, parent):
+        futuros = [_ejecutor_drive().submit(_subir_bytes_drive, creds, nombre, datos, mime, parent) for nombre, datos, mime in lote]
+        salida = []
+        for fut in futuros:
+            try:
+                salida.append(fut.result())
+            except Exception as e:
+                salida.append(e)
+        return salida
+
+    res = _subir(items, parent_id)
+    # Carpeta registrada borrada o en papelera: se olvida (también la raíz), se resuelve de nuevo
+    # y se reintenta una vez; el camino normal sigue sin llamadas extra
+    fallidos = [k for k, r in enumerate(res) if isinstance(r, Exception) and _carpeta_drive_no_disponible(r)]
+    if fallidos and cliente_id:
+        try:
+            cuenta = cuenta_drive(service)
+            olvidar_carpeta_drive(cuenta, str(cliente_id))
+            olvidar_carpeta_drive(cuenta, "")
+            parent_id = crear_carpeta_cliente_drive(cliente_id, cliente_nombre)
+            for k, r in zip(fallidos, _subir([items[k] for k in fallidos], parent_id)):
+                res[k] = r
+        except Exception:
+            pass
+    resultados, subidos = [], []
+    for (nombre, _, _), r in zip(items, res):
+        if isinstance(r, Exception):
+            resultados.append((nombre, None))
+        else:
+            subidos.append(r[0])
+            resultados.append((nombre, r[1]))
+    publicar_en_drive(service, subidos)
+    return resultados
 
 def subir_a_drive(uploaded_file, cliente_id=None, cliente_nombre=""):
     """Sube un archivo a Google Drive en la carpeta del cliente y devuelve el enlace público."""
     if not st.session_state.drive_creds:
         st.warning("⚠ Conecta tu cuenta de Google Drive primero.")
         return None
-
-    drive_service = build("drive", "v3", credentials=st.session_state.drive_creds)
-    
-    # Si se especifica cliente, subir a su carpeta
-    parent_folder_id = None
-    if cliente_id:
-        parent_folder_id = crear_carpeta_cliente_drive(cliente_id, cliente_nombre)
-    
-    file_metadata = {"name": uploaded_file.name}
-    if parent_folder_id:
-        file_metadata["parents"] = [parent_folder_id]
-    
-    media = MediaIoBaseUpload(io.BytesIO(uploaded_file.getbuffer()), mimetype=uploaded_file.type)
-    file = drive_service.files().create(body=file_metadata, media_body=media, fields="id, webViewLink").execute()
-    
-    # Hacer el archivo público para visualización
-    try:
-        permission = {
-            'type': 'anyone',
-            'role': 'reader'
-        }
-        drive_service.permissions().create(fileId=file.get('id'), body=permission).execute()
-    except:
-        pass  # Si no se puede hacer público, continuar
-    
-    return file.get("webViewLink")
+    datos = bytes(uploaded_file.getbuffer())
+    [(_, link)] = subir_varios_a_drive([(uploaded_file.name, datos, getattr(uploaded_file, "type", None))], cliente_id, cliente_nombre)
+    return link
 
 
 def subir_docs(cid: str, files, prefijo: str = "", usar_drive: bool = True) -> list:
@@ -2096,25 +3351,25 @@ def subir_docs(cid: str, files, prefijo: str = "", usar_drive: bool = True) -> l
         exitosos = 0
         errores = 0
         
+        items = []
         for f in files_iter:
             try:
                 fname = getattr(f, "name", None) or getattr(f, "filename", None) or "uploaded"
                 target_name = safe_name(f"{prefijo}{fname}")
-                
-                # Crear un objeto temporal con el nombre correcto
-                import io
-                temp_file = io.BytesIO(f.getbuffer())
-                temp_file.name = target_name
-                temp_file.type = getattr(f, 'type', 'application/octet-stream')
-                temp_file.getbuffer = lambda: f.getbuffer()
-                
-                drive_link = subir_a_drive(temp_file, cid, cliente_nombre)
-                if drive_link:
-                    resultados.append(f"[Drive] {target_name}: {drive_link}")
-                    exitosos += 1
-                else:
-                    errores += 1
-            except Exception as e:
+                items.append((target_name, bytes(f.getbuffer()), getattr(f, 'type', 'application/octet-stream')))
+            except Exception:
+                errores += 1
+
+        try:
+            subidos = subir_varios_a_drive(items, cid, cliente_nombre)
+        except Exception:
+            subidos = [(nombre, None) for nombre, _, _ in items]
+        for (target_name, datos, _), (_, drive_link) in zip(items, subidos):
+            if drive_link:
+                resultados.append(f"[Drive] {target_name}: {drive_link}")
+                indexar_doc(cid, datos=datos, ubicacion="drive", nombre=target_name, enlace=drive_link)
+                exitosos += 1
+            else:
                 errores += 1
                 
         # Mostrar resumen al final
@@ -2159,16 +3414,17 @@ def subir_docs(cid: str, files, prefijo: str = "", usar_drive: bool = True) -> l
             except Exception:
                 continue
 
-        # Escribir en paralelo para acelerar (especialmente cuando hay varios archivos)
+        # Guardar en el almacén por contenido (data/blobs) y dejar en la carpeta del cliente
+        # solo una referencia; en paralelo para acelerar el hash cuando hay varios archivos
         saved_files = []
+        hashes = {}
         try:
             import concurrent.futures
             def write_file(item):
                 target_name, data = item
                 target_path = folder / target_name
                 try:
-                    with open(target_path, "wb") as out:
-                        out.write(data)
+                    hashes[target_name] = guardar_doc_en_blob(target_path, data)
                     return target_name
                 except Exception:
                     return None
@@ -2181,40 +3437,328 @@ def subir_docs(cid: str, files, prefijo: str = "", usar_drive: bool = True) -> l
             for target_name, data in to_write:
                 target_path = folder / target_name
                 try:
-                    with open(target_path, "wb") as out:
-                        out.write(data)
+                    hashes[target_name] = guardar_doc_en_blob(target_path, data)
                     saved_files.append(target_name)
                 except Exception:
                     pass
+        # Registrar en el índice de documentos
+        for target_name in saved_files:
+            indexar_doc(cid, folder / target_name, sha256=hashes.get(target_name))
         resultados = saved_files
     
     return resultados
 
 
-def listar_docs_cliente(cid: str):
+# ---------- Índice de documentos (SQLite) ----------
+# Catálogo de documentos por cliente: evita recorrer carpetas en cada render.
+DOCS_INDEX_DB = DATA_DIR / "documentos.sqlite"
+# Prefijos con que subir_docs guarda cada categoría
+DOC_PREFIJOS = {
+    "estado_cuenta": "estado_",
+    "buro_credito": "buro_",
+    "solicitud": "solic_",
+    "contrato": "contrato_",
+    "otros": "otros_",
+}
+_DOCS_INDEX_ESTADO = _estado_compartido("indice_documentos")
+
+def _docs_db():
+    """Conexión al índice (una por llamada; SQLite serializa escrituras entre hilos)."""
+    import sqlite3
+    con = sqlite3.connect(str(DOCS_INDEX_DB), timeout=10)
+    if _DOCS_INDEX_ESTADO.get("esquema") != str(DOCS_INDEX_DB):
+        con.executescript("""
+            CREATE TABLE IF NOT EXISTS documentos (
+                cliente_id TEXT NOT NULL,
+                categoria  TEXT NOT NULL,
+                nombre     TEXT NOT NULL,
+                carpeta    TEXT NOT NULL,
+                ubicacion  TEXT NOT NULL DEFAULT 'local',
+                tamano     INTEGER,
+                mtime      REAL,
+                sha256     TEXT,
+                enlace     TEXT DEFAULT '',
+                PRIMARY KEY (ubicacion, carpeta, nombre)
+            );
+            CREATE INDEX IF NOT EXISTS ix_documentos_cliente ON documentos (cliente_id, categoria);
+            CREATE INDEX IF NOT EXISTS ix_documentos_sha ON documentos (sha256);
+            CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT);
+        """)
+        _DOCS_INDEX_ESTADO["esquema"] = str(DOCS_INDEX_DB)
+    return con
+
+def categoria_doc(nombre: str) -> str:
+    """Categoría según el prefijo del nombre de archivo ('otros' si no coincide ninguno)."""
+    for cat, pref in DOC_PREFIJOS.items():
+        if nombre.startswith(pref):
+            return cat
+    return "otros"
+
+def _sha256_archivo(ruta: Path) -> str:
+    h = hashlib.sha256()
+    with open(ruta, "rb") as fh:
+        for bloque in iter(lambda: fh.read(1024 * 1024), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+def indexar_doc(cid: str, ruta: Path | None = None, datos: bytes | None = None, ubicacion: str = "local", nombre: str = "", enlace: str = "", sha256: str | None = None) -> None:
     """
-    Lista los archivos asociados a un cliente (Path objects), ordenados por nombre.
-    Retorna lista vacía si no existe carpeta.
+    Registra (o actualiza) un documento en el índice. Local: `ruta` dentro de DOCS_DIR.
+    Drive: sin ruta; se indica `nombre` y `enlace`. El sha256 se toma de `sha256`, de los
+    bytes si se pasan, o se calcula leyendo el archivo.
     """
+    from contextlib import closing
     try:
-        nombre = get_nombre_by_id(cid) or ""
+        if ruta is not None:
+            ruta = Path(ruta)
+            info = ruta.stat()
+            nombre, carpeta, tamano, mtime = ruta.name, ruta.parent.name, info.st_size, info.st_mtime
+            sha = sha256 or (hashlib.sha256(datos).hexdigest() if datos is not None else _sha256_archivo(ruta))
+        else:
+            carpeta, tamano, mtime = str(cid), len(datos or b""), time.time()
+            sha = hashlib.sha256(datos).hexdigest() if datos is not None else ""
+        with closing(_docs_db()) as con, con:
+            con.execute(
+                "INSERT OR REPLACE INTO documentos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (str(cid), categoria_doc(nombre), nombre, carpeta, ubicacion, tamano, mtime, sha, enlace)
+            )
     except Exception:
-        nombre = ""
+        pass
 
-    name_safe = safe_name(nombre) if nombre else ""
-    id_safe = safe_name(str(cid))
+def desindexar_doc(ruta: Path) -> None:
+    """Quita un documento local del índice (tras borrarlo) y libera su blob si quedó sin referencias."""
+    from contextlib import closing
+    try:
+        ruta = Path(ruta)
+        clave = (ruta.parent.name, ruta.name)
+        with closing(_docs_db()) as con, con:
+            shas = [r[0] for r in con.execute("SELECT sha256 FROM documentos WHERE ubicacion = 'local' AND carpeta = ? AND nombre = ?", clave)]
+            con.execute("DELETE FROM documentos WHERE ubicacion = 'local' AND carpeta = ? AND nombre = ?", clave)
+        for sha in shas:
+            liberar_blob(sha)
+    except Exception:
+        pass
 
-    # Preferir la carpeta por nombre si existe; si no, revisar la carpeta por id.
-    if name_safe:
-        folder = DOCS_DIR / name_safe
-        if folder.exists() and folder.is_dir():
-            return sorted([p for p in folder.iterdir() if p.is_file()], key=lambda p: p.name)
+def desindexar_cliente(cid: str) -> None:
+    """Quita todos los documentos de un cliente del índice y libera los blobs sin referencias."""
+    from contextlib import closing
+    try:
+        with closing(_docs_db()) as con, con:
+            shas = [r[0] for r in con.execute("SELECT DISTINCT sha256 FROM documentos WHERE cliente_id = ? AND ubicacion = 'local'", (str(cid),))]
+            con.execute("DELETE FROM documentos WHERE cliente_id = ?", (str(cid),))
+        for sha in shas:
+            liberar_blob(sha)
+    except Exception:
+        pass
 
-    folder_id = DOCS_DIR / id_safe
-    if folder_id.exists() and folder_id.is_dir():
-        return sorted([p for p in folder_id.iterdir() if p.is_file()], key=lambda p: p.name)
+# --- Almacén por contenido (blobs sha256) ---
+# Cada contenido se guarda una sola vez en data/blobs/<aa>/<sha256>; las carpetas de
+# clientes tienen hardlinks (copia si el sistema de archivos no los soporta).
+BLOBS_DIR = DATA_DIR / "blobs"
+
+def ruta_blob(sha: str) -> Path:
+    return BLOBS_DIR / sha[:2] / sha
+
+def _vincular(origen: Path, destino: Path) -> None:
+    """Crea `destino` como hardlink de `origen` (o copia), reemplazándolo de forma atómica."""
+    tmp = destino.with_name(f".{destino.name}.{secrets.token_hex(4)}.tmp")
+    try:
+        os.link(origen, tmp)
+    except OSError:
+        shutil.copyfile(origen, tmp)
+    os.replace(tmp, destino)
 
-    return []
+def guardar_doc_en_blob(destino: Path, datos: bytes) -> str:
+    """
+    Guarda `datos` en el almacén (solo si el contenido es nuevo) y deja `destino` como
+    referencia al blob. Retorna el sha256.
+    """
+    sha = hashlib.sha256(datos).hexdigest()
+    blob = ruta_blob(sha)
+    if not blob.exists():
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        tmp = blob.with_name(f".{sha}.{secrets.token_hex(4)}.tmp")
+        tmp.write_bytes(datos)
+        os.replace(tmp, blob)
+    try:
+        if destino.exists() and os.path.samefile(destino, blob):
+            return sha
+    except OSError:
+        pass
+    _vincular(blob, destino)
+    return sha
+
+def referencias_blob(sha: str) -> int:
+    """Cuántos documentos locales del índice apuntan a este contenido."""
+    from contextlib import closing
+    try:
+        with closing(_docs_db()) as con:
+            return con.execute("SELECT COUNT(*) FROM documentos WHERE sha256 = ? AND ubicacion = 'local'", (sha,)).fetchone()[0]
+    except Exception:
+        return 1  # ante la duda, conservar
+
+def liberar_blob(sha: str) -> bool:
+    """Borra el blob si ningún documento lo referencia (índice y enlaces en disco)."""
+    blob = ruta_blob(sha or "")
+    try:
+        if sha and blob.is_file() and referencias_blob(sha) == 0 and blob.stat().st_nlink <= 1:
+            blob.unlink()
+            return True
+    except Exception:
+        pass
+    return False
+
+def deduplicar_docs() -> tuple[int, int]:
+    """
+    Pasa al almacén los documentos locales ya indexados: el primero de cada contenido se
+    enlaza como blob y los repetidos se reemplazan por referencias. Después borra blobs huérfanos.
+    Retorna (archivos deduplicados, bytes liberados).
+    """
+    from contextlib import closing
+    try:
+        with closing(_docs_db()) as con:
+            filas = con.execute("SELECT carpeta, nombre, sha256, tamano FROM documentos WHERE ubicacion = 'local' AND sha256 != ''").fetchall()
+    except Exception:
+        filas = []
+    n, liberados = 0, 0
+    for carpeta, nombre, sha, tamano in filas:
+        f = DOCS_DIR / carpeta / nombre
+        blob = ruta_blob(sha)
+        try:
+            if not f.is_file():
+                continue
+            if not blob.exists():
+                blob.parent.mkdir(parents=True, exist_ok=True)
+                _vincular(f, blob)
+            elif not os.path.samefile(f, blob):
+                if f.stat().st_nlink <= 1:
+                    liberados += int(tamano or 0)
+                _vincular(blob, f)
+                n += 1
+        except Exception:
+            continue
+    try:
+        for blob in BLOBS_DIR.glob("*/*"):
+            if not blob.name.startswith("."):
+                liberar_blob(blob.name)
+    except Exception:
+        pass
+    return n, liberados
+
+def mover_carpeta_indice(origen: str, destino: str) -> None:
+    """Actualiza el índice cuando se renombra la carpeta de un cliente (id -> nombre)."""
+    from contextlib import closing
+    try:
+        with closing(_docs_db()) as con, con:
+            con.execute("UPDATE documentos SET carpeta = ? WHERE ubicacion = 'local' AND carpeta = ?", (destino, origen))
+    except Exception:
+        pass
+
+def reindexar_docs(df: pd.DataFrame | None = None) -> int:
+    """
+    Reconstruye el índice local recorriendo DOCS_DIR una vez. Las carpetas se asocian al
+    cliente por safe_name(nombre) o safe_name(id), con la misma prioridad que listar_docs_cliente.
+    Conserva las entradas de Drive. Retorna cuántos documentos quedaron indexados.
+    """
+    from contextlib import closing
+    df = df_cli if df is None else df
+    carpeta_a_id = {}
+    if isinstance(df, pd.DataFrame) and not df.empty and "id" in df.columns:
+        for cid in df["id"].astype(str):
+            carpeta_a_id.setdefault(safe_name(cid), cid)
+        for cid, nombre in zip(df["id"].astype(str), df.get("nombre", pd.Series("", index=df.index)).fillna("").astype(str)):
+            if nombre.strip():
+                carpeta_a_id[safe_name(nombre)] = cid
+    filas = []
+    try:
+        carpetas = [c for c in DOCS_DIR.iterdir() if c.is_dir()]
+    except Exception:
+        carpetas = []
+    for carpeta in carpetas:
+        cid = carpeta_a_id.get(carpeta.name)
+        if cid is None:
+            continue
+        for f in carpeta.iterdir():
+            if f.is_file():
+                try:
+                    info = f.stat()
+                    filas.append((cid, categoria_doc(f.name), f.name, carpeta.name, "local", info.st_size, info.st_mtime, _sha256_archivo(f), ""))
+                except Exception:
+                    continue
+    try:
+        with closing(_docs_db()) as con, con:
+            con.execute("DELETE FROM documentos WHERE ubicacion = 'local'")
+            con.executemany("INSERT OR REPLACE INTO documentos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", filas)
+            con.execute("INSERT OR REPLACE INTO meta VALUES ('indexado', ?)", (datetime.now().isoformat(),))
+    except Exception:
+        pass
+    _DOCS_INDEX_ESTADO["listo"] = str(DOCS_INDEX_DB)
+    return len(filas)
+
+def _asegurar_indice_docs() -> None:
+    """La primera vez (índice nunca construido) indexa las carpetas existentes."""
+    from contextlib import closing
+    if _DOCS_INDEX_ESTADO.get("listo") == str(DOCS_INDEX_DB):
+        return
+    try:
+        with closing(_docs_db()) as con:
+            construido = con.execute("SELECT 1 FROM meta WHERE clave = 'indexado'").fetchone()
+    except Exception:
+        construido = None
+    if construido:
+        _DOCS_INDEX_ESTADO["listo"] = str(DOCS_INDEX_DB)
+    else:
+        reindexar_docs()
+
+def docs_indexados(ids: list, ubicacion: str | None = "local") -> pd.DataFrame:
+    """Filas del índice para varios clientes (una consulta por bloque de 500 ids)."""
+    from contextlib import closing
+    _asegurar_indice_docs()
+    cols = ["cliente_id", "categoria", "nombre", "carpeta", "ubicacion", "tamano", "mtime", "sha256", "enlace"]
+    partes = []
+    ids = [str(c) for c in ids]
+    try:
+        with closing(_docs_db()) as con:
+            for inicio in range(0, len(ids), 500):
+                bloque = ids[inicio:inicio + 500]
+                sql = f"SELECT {', '.join(cols)} FROM documentos WHERE cliente_id IN ({','.join('?' * len(bloque))})"
+                args = list(bloque)
+                if ubicacion is not None:
+                    sql += " AND ubicacion = ?"
+                    args.append(ubicacion)
+                partes += con.execute(sql + " ORDER BY nombre", args).fetchall()
+    except Exception:
+        pass
+    return pd.DataFrame(partes, columns=cols)
+
+def conteo_docs_por_categoria(ids: list | None = None) -> pd.DataFrame:
+    """Cantidad de documentos por cliente y categoría (todos los clientes si ids es None)."""
+    from contextlib import closing
+    _asegurar_indice_docs()
+    try:
+        with closing(_docs_db()) as con:
+            if ids is None:
+                filas = con.execute("SELECT cliente_id, categoria, COUNT(*) FROM documentos GROUP BY cliente_id, categoria").fetchall()
+            else:
+                filas = []
+                ids = [str(c) for c in ids]
+                for inicio in range(0, len(ids), 500):
+                    bloque = ids[inicio:inicio + 500]
+                    filas += con.execute(
+                        f"SELECT cliente_id, categoria, COUNT(*) FROM documentos WHERE cliente_id IN ({','.join('?' * len(bloque))}) GROUP BY cliente_id, categoria",
+                        bloque
+                    ).fetchall()
+    except Exception:
+        filas = []
+    return pd.DataFrame(filas, columns=["cliente_id", "categoria", "cantidad"])
+
+def listar_docs_cliente(cid: str):
+    """
+    Lista los archivos locales asociados a un cliente (Path objects), ordenados por nombre.
+    Consulta el índice de documentos; retorna lista vacía si no tiene documentos.
+    """
+    docs = docs_indexados([cid])
+    return [DOCS_DIR / c / n for c, n in zip(docs["carpeta"], docs["nombre"])]
 
 
 def nuevo_id_cliente(df: pd.DataFrame) -> str:
@@ -2586,86 +4130,71 @@ COLUMNS = [
 
 def cargar_clientes(force_reload: bool = False) -> pd.DataFrame:
     """
-    Lee primero de Google Sheets con caché inteligente
-    force_reload: True para forzar recarga desde Google Sheets
+    Devuelve los clientes desde la réplica local (memoria compartida respaldada en disco).
+    La conciliación con Google Sheets corre en segundo plano; force_reload la hace en el momento.
     """
-    global _CLIENTES_CACHE, _CLIENTES_CACHE_TIME
-    
+    global _CLIENTES_CACHE, _CLIENTES_CACHE_TIME, _CLIENTES_LEIDO
+
     import time
     now = time.time()
     cache_duration = 3  # segundos
-    
+
     # Usar caché si es reciente y no se fuerza recarga
     if not force_reload and _CLIENTES_CACHE is not None:
         if (now - _CLIENTES_CACHE_TIME) < cache_duration:
             return _CLIENTES_CACHE.copy()
-    
-    def _ensure_cols(df: pd.DataFrame) -> pd.DataFrame:
-        df = df.copy().fillna("")
-        for c in COLUMNS:
-            if c not in df.columns:
-                df[c] = ""
-        return df[[c for c in COLUMNS if c in df.columns]]
 
-    # 1) Intentar Google Sheets
+    rep = replica_clientes()
     if USE_GSHEETS:
-        try:
-            ws = _gs_open_worksheet(GSHEET_TAB, force_reload=force_reload)
-            if ws is None:
-                raise Exception("No connection")
-                
-            df = get_as_dataframe(ws, evaluate_formulas=True, dtype=str, header=0).dropna(how="all")
-            if df is None or df.empty:
-                df = pd.DataFrame(columns=COLUMNS)
-            else:
-                # Mostrar mensaje solo al iniciar sesión
+        if force_reload or not rep.get("ultimo_intento"):
+            # Primera lectura del proceso (o recarga pedida): conciliar antes de responder
+            sincronizar_replica_clientes()
+            if rep.get("error"):
                 if 'gs_first_load' not in st.session_state:
-                    st.session_state['gs_first_load'] = True
-                    show_once_success("gsheets_load", f"Datos cargados desde Google Sheets: {len(df)} registros")
-                
-            df = df.fillna("")
-            for c in COLUMNS:
-                if c not in df.columns:
-                    df[c] = ""
-            
-            result = df[COLUMNS].astype(str).fillna("")
-            
-            # Actualizar caché
-            _CLIENTES_CACHE = result.copy()
-            _CLIENTES_CACHE_TIME = now
-            
-            return result
-        except Exception as e:
-            if 'gs_first_load' not in st.session_state:
-                st.warning(f"⚠️ No se pudo cargar desde Google Sheets, usando datos locales")
+                    st.warning(f"⚠️ No se pudo cargar desde Google Sheets, usando datos locales")
+        else:
+            programar_sincronizacion_replica()
+        if 'gs_first_load' not in st.session_state and rep.get("ultima_sync"):
+            st.session_state['gs_first_load'] = True
+            show_once_success("gsheets_load", f"Datos cargados desde Google Sheets: {len(rep['df'])} registros")
+
+    result, _CLIENTES_LEIDO = lectura_clientes()
+    _CLIENTES_CACHE = result.copy()
+    _CLIENTES_CACHE_TIME = now
+    return result
 
-    # 2) Fallback a archivos locales
-    try:
-        if CLIENTES_XLSX.exists():
-            df = pd.read_excel(CLIENTES_XLSX, dtype=str).fillna("")
-            result = _ensure_cols(df)
-            _CLIENTES_CACHE = result.copy()
-            _CLIENTES_CACHE_TIME = now
-            return result
-    except Exception:
-        pass
+def _escribir_clientes_local(df_to_save: pd.DataFrame) -> None:
+    """Escribe clientes.csv y el respaldo XLSX (cada uno bajo candado y reemplazo atómico)."""
+    # CSV (local)
+    with bloqueo_archivo(CLIENTES_CSV), archivo_atomico(CLIENTES_CSV) as tmp:
+        df_to_save.to_csv(tmp, index=False, encoding="utf-8")
 
+    # XLSX (respaldo)
     try:
-        if CLIENTES_CSV.exists():
-            df = pd.read_csv(CLIENTES_CSV, dtype=str).fillna("")
-            result = _ensure_cols(df)
-            _CLIENTES_CACHE = result.copy()
-            _CLIENTES_CACHE_TIME = now
-            return result
+        engine = None
+        try:
+            import xlsxwriter
+            engine = "xlsxwriter"
+        except Exception:
+            try:
+                import openpyxl
+                engine = "openpyxl"
+            except Exception:
+                engine = None
+
+        if engine:
+            with bloqueo_archivo(CLIENTES_XLSX), archivo_atomico(CLIENTES_XLSX) as tmp:
+                with pd.ExcelWriter(tmp, engine=engine) as writer:
+                    df_to_save.to_excel(writer, index=False, sheet_name="Clientes")
     except Exception:
         pass
 
-    return pd.DataFrame(columns=COLUMNS)
-
-def guardar_clientes(df: pd.DataFrame):
-    """Guarda la base y actualiza caché"""
-    global _CLIENTES_CACHE, _CLIENTES_CACHE_TIME
-    
+def guardar_clientes(df: pd.DataFrame, leido: dict | None = None):
+    """
+    Guarda la base en la réplica local y deja la subida a Google Sheets en segundo plano.
+    Las filas que otro usuario cambió desde la lectura (`leido`, por defecto la de esta ejecución)
+    no se pisan: se fusionan y los choques quedan en st.session_state["conflictos_clientes"].
+    """
     try:
         if df is None:
             return
@@ -2675,46 +4204,171 @@ def guardar_clientes(df: pd.DataFrame):
                 df[c] = ""
         df_to_save = df[[c for c in COLUMNS if c in df.columns]].copy().fillna("").astype(str)
 
-        # CSV (local)
-        df_to_save.to_csv(CLIENTES_CSV, index=False, encoding="utf-8")
+        # Réplica: compare-and-set por versión de fila; luego se persiste lo que quedó en ella
+        n_cambios, conflictos = registrar_cambios_replica(df_to_save, _CLIENTES_LEIDO if leido is None else leido)
+        _publicar_guardado_clientes(n_cambios, conflictos)
 
-        # XLSX (respaldo)
+    except Exception as e:
         try:
-            engine = None
-            try:
-                import xlsxwriter
-                engine = "xlsxwriter"
-            except Exception:
-                try:
-                    import openpyxl
-                    engine = "openpyxl"
-                except Exception:
-                    engine = None
+            st.error(f"Error guardando clientes: {e}")
+        except Exception:
+            pass
 
-            if engine:
-                with pd.ExcelWriter(CLIENTES_XLSX, engine=engine) as writer:
-                    df_to_save.to_excel(writer, index=False, sheet_name="Clientes")
+def guardar_cambios_clientes(cambios: pd.DataFrame, leido: dict | None = None) -> pd.DataFrame:
+    """
+    Guarda solo las celdas de un conjunto de cambios (id, columna, anterior, nuevo; ver diff_clientes).
+    Las filas no tocadas no se comparan ni se marcan para sincronizar. Devuelve las celdas que sí
+    se aplicaron (sin los choques), para registrar en el historial solo lo guardado.
+    """
+    vacio = pd.DataFrame(columns=CAMBIOS_COLS)
+    try:
+        if cambios is None or cambios.empty:
+            return vacio
+        aplicados, conflictos = aplicar_cambios_replica(cambios, _CLIENTES_LEIDO if leido is None else leido)
+        _publicar_guardado_clientes(aplicados["id"].nunique(), conflictos)
+        return aplicados
+    except Exception as e:
+        try:
+            st.error(f"Error guardando clientes: {e}")
         except Exception:
             pass
+        return vacio
 
-        # Actualizar caché inmediatamente
-        import time
-        _CLIENTES_CACHE = df_to_save.copy()
-        _CLIENTES_CACHE_TIME = time.time()
+def lectura_mostrada(clave: str) -> dict | None:
+    """
+    Lectura ({id: (versión, fila)}) contra la que guardar lo que un formulario mostró: la de la
+    ejecución anterior, cuando se dibujó lo que el usuario ve al hacer clic. Guarda la actual para la siguiente.
+    Llamar en cada ejecución que dibuja el formulario, antes del botón.
+    """
+    previa = st.session_state.get(clave)
+    st.session_state[clave] = _CLIENTES_LEIDO
+    return _CLIENTES_LEIDO if previa is None else previa
 
-        # Google Sheets (async, sin bloquear)
-        if USE_GSHEETS:
-            try:
-                guardar_clientes_gsheet_append(df_to_save)
-            except Exception:
-                pass
+def _publicar_guardado_clientes(n_cambios: int, conflictos: list) -> None:
+    """Tras cambiar la réplica: archivos locales, cubo de KPIs, caché de la ejecución, sync y choques."""
+    global _CLIENTES_CACHE, _CLIENTES_CACHE_TIME, _CLIENTES_LEIDO
+    df_to_save, leido_nuevo = lectura_clientes()
+    _escribir_clientes_local(df_to_save)
 
-    except Exception as e:
+    # Cubo de KPIs: aplicar solo el delta respecto a la versión cargada
+    if _CLIENTES_CACHE is not None:
+        actualizar_cubo_kpi(_CLIENTES_CACHE, df_to_save)
+
+    # Actualizar caché inmediatamente
+    import time
+    _CLIENTES_CACHE = df_to_save.copy()
+    _CLIENTES_CACHE_TIME = time.time()
+    _CLIENTES_LEIDO = leido_nuevo
+
+    # Conciliar con Google Sheets sin bloquear
+    if n_cambios:
+        programar_sincronizacion_replica(forzar=True)
+    if conflictos:
         try:
-            st.error(f"Error guardando clientes: {e}")
+            st.session_state.setdefault("conflictos_clientes", []).extend(conflictos)
+            st.warning(f"⚠️ {len(conflictos)} cambio(s) chocaron con la edición de otro usuario y no se aplicaron; revísalos en «Conflictos de edición».")
         except Exception:
             pass
 
+def aplicar_conflicto_cliente(conflicto: dict, actor: str | None = None) -> None:
+    """
+    Reaplica el valor propio de un choque como conjunto de cambios contra la versión actual (leída en
+    esta ejecución) y lo registra en el historial, como el guardado del editor. Si vuelve a chocar
+    queda otra vez en «Conflictos de edición».
+    """
+    df = cargar_clientes()
+    leido = _CLIENTES_LEIDO
+    cid, col = str(conflicto["id"]), conflicto["columna"]
+    actual = df[df["id"].astype(str) == cid]
+    fila = conflicto.get("fila")
+    if col == "*" and (fila is None or actual.empty):
+        # Borrado en un lado y edición en el otro: se guarda la fila completa (compare-and-set por versión)
+        if fila is None:
+            nombre = str(actual["nombre"].iat[-1]) if not actual.empty else ""
+            guardar_clientes(df[df["id"].astype(str) != cid], leido=leido)
+            append_historial(cid, nombre, "", "", "", "", f"Eliminado por {actor}", action="CLIENTE ELIMINADO", actor=actor)
+        else:
+            nuevo = dict(zip(COLUMNS, map(str, fila)))
+            guardar_clientes(pd.concat([df, pd.DataFrame([nuevo], columns=COLUMNS)], ignore_index=True), leido=leido)
+            append_historial(cid, nuevo.get("nombre", ""), "", nuevo.get("estatus", ""), "", nuevo.get("segundo_estatus", ""),
+                             f"Restaurado por {actor}", action="CLIENTE AGREGADO", actor=actor)
+        return
+    previa = actual.iloc[-1].astype(str) if not actual.empty else pd.Series(dtype=str)
+    if col == "*":
+        mio = dict(zip(COLUMNS, map(str, fila)))
+        celdas = [(cid, c, previa.get(c, ""), mio[c]) for c in COLUMNS if c != "id" and previa.get(c, "") != mio[c]]
+    else:
+        celdas = [(cid, col, previa.get(col, ""), str(conflicto["mio"]))]
+    aplicados = guardar_cambios_clientes(pd.DataFrame(celdas, columns=CAMBIOS_COLS), leido=leido)
+    try:
+        append_historial_many(historial_desde_cambios(aplicados, df, actor=actor))
+    except Exception:
+        pass
+
+def panel_conflictos_clientes() -> None:
+    """Cambios que no se aplicaron por chocar con la edición de otro usuario."""
+    conflictos = st.session_state.get("conflictos_clientes") or []
+    if not conflictos:
+        return
+    with st.expander(f"⚠️ Conflictos de edición ({len(conflictos)})", expanded=True):
+        st.caption("Otro usuario cambió estos datos mientras editabas; se conservó su valor.")
+        for k, c in enumerate(list(conflictos)):
+            col1, col2, col3 = st.columns([6, 1, 1])
+            col1.markdown(f"**{c['id']}** · {c['columna']} — tu valor: `{c['mio']}` · valor actual: `{c['actual']}`")
+            if col2.button("Usar el mío", key=f"conflicto_mio_{k}"):
+                actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
+                aplicar_conflicto_cliente(c, actor=actor)
+                conflictos.remove(c)
+                do_rerun()
+            if col3.button("Descartar", key=f"conflicto_descartar_{k}"):
+                conflictos.remove(c)
+                do_rerun()
+
+# --- Diferencias celda a celda (guardado del editor) ---
+CAMBIOS_COLS = ["id", "columna", "anterior", "nuevo"]
+
+def diff_clientes(mostrado: pd.DataFrame, editado: pd.DataFrame, original: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    Cambios entre lo que mostró el editor y lo que devolvió, alineados por id, con una sola
+    comparación vectorizada. `anterior` sale de `original` (la base sin formatear) si se pasa.
+    Devuelve un DataFrame (id, columna, anterior, nuevo); vacío si no se tocó nada.
+    """
+    cols = [c for c in COLUMNS if c != "id" and c in editado.columns and c in mostrado.columns]
+    ed = editado.assign(id=editado["id"].astype(str)).drop_duplicates("id", keep="last").set_index("id")[cols]
+    antes = mostrado.assign(id=mostrado["id"].astype(str)).drop_duplicates("id", keep="last").set_index("id")[cols]
+    ids = ed.index[ed.index.isin(antes.index) & (ed.index != "")]
+    a = antes.loc[ids].fillna("").astype(str).to_numpy()
+    e = ed.loc[ids].fillna("").astype(str).to_numpy()
+    filas, columnas = np.nonzero(a != e)
+    cambios = pd.DataFrame({
+        "id": ids.to_numpy()[filas], "columna": np.asarray(cols)[columnas],
+        "anterior": a[filas, columnas], "nuevo": e[filas, columnas],
+    }, columns=CAMBIOS_COLS)
+    if original is not None and not cambios.empty:
+        base = original.assign(id=original["id"].astype(str)).drop_duplicates("id", keep="last").set_index("id")
+        for c in cambios["columna"].unique():
+            sel = (cambios["columna"] == c).to_numpy()
+            cambios.loc[sel, "anterior"] = base[c].reindex(cambios.loc[sel, "id"]).fillna("").astype(str).to_numpy()
+        cambios = cambios[cambios["anterior"] != cambios["nuevo"]].reset_index(drop=True)
+    return cambios
+
+def historial_desde_cambios(cambios: pd.DataFrame, original: pd.DataFrame, actor: str | None = None) -> list[dict]:
+    """Un registro de historial por cliente modificado ('Campos cambiados: ...'), como el guardado por filas."""
+    if cambios is None or cambios.empty:
+        return []
+    base = original.assign(id=original["id"].astype(str)).drop_duplicates("id", keep="last").set_index("id")
+    registros = []
+    for cid, grupo in cambios.groupby("id", sort=False):
+        nuevos = dict(zip(grupo["columna"], grupo["nuevo"]))
+        viejo = base.loc[cid] if cid in base.index else pd.Series(dtype=str)
+        est_old, seg_old = str(viejo.get("estatus", "")), str(viejo.get("segundo_estatus", ""))
+        registros.append(registro_historial(
+            cid, nuevos.get("nombre", str(viejo.get("nombre", ""))),
+            est_old, nuevos.get("estatus", est_old), seg_old, nuevos.get("segundo_estatus", seg_old),
+            "Campos cambiados: " + ",".join(grupo["columna"]), action="ESTATUS MODIFICADO", actor=actor,
+        ))
+    return registros
+
 # --- Helpers para GSheet append/upsert ---
 def _ensure_columns(df: pd.DataFrame, cols: list[str]) -> pd.DataFrame:
     df = df.copy().fillna("")
@@ -2729,81 +4383,458 @@ def _sheet_to_df(ws) -> pd.DataFrame:
         return pd.DataFrame()
     return dfsh.fillna("").astype(str)
 
-def guardar_clientes_gsheet_append(df_nuevo: pd.DataFrame):
-    """Versión optimizada: solo actualiza filas modificadas"""
-    if df_nuevo is None or df_nuevo.empty:
-        return
-
+# --- Réplica local de clientes ---
+# Las lecturas se sirven de una copia en memoria compartida entre sesiones (respaldada en
+# clientes.csv). Cada guardado sube la versión de las filas que cambió y las marca como
+# pendientes; un hilo de fondo concilia con la hoja. Por fila se conserva la última versión
+# vista en la hoja (base), así la fusión es a tres bandas: lo que cambió de un solo lado se
+# aplica sin más y, si ambos lados tocaron la misma celda, gana el guardado local (el último
+# escritor que conoce esta instancia) y el choque queda registrado para revisión.
+REPLICA_DB = DATA_DIR / "replica_clientes.sqlite"
+REPLICA_SYNC_S = 60  # antigüedad máxima de la réplica antes de conciliar en segundo plano
+REPLICA_CAMBIO = 1   # pendiente: fila nueva o modificada aquí
+REPLICA_BORRADO = 2  # pendiente: fila borrada aquí
+
+@st.cache_resource
+def _ejecutor_replica():
+    """Un solo hilo para las conciliaciones en segundo plano."""
+    import concurrent.futures
+    return concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="replica")
+
+def _replica_db():
+    """Conexión a los metadatos de la réplica (base, pendientes y conflictos)."""
+    import sqlite3
+    con = sqlite3.connect(str(REPLICA_DB), timeout=10)
+    if _REPLICA.get("esquema") != str(REPLICA_DB):
+        con.executescript("""
+            CREATE TABLE IF NOT EXISTS filas (
+                id          TEXT PRIMARY KEY,
+                base        TEXT,
+                version     INTEGER NOT NULL DEFAULT 0,
+                pendiente   INTEGER NOT NULL DEFAULT 0,
+                actualizado REAL
+            );
+            CREATE TABLE IF NOT EXISTS conflictos (
+                id      TEXT NOT NULL,
+                columna TEXT NOT NULL,
+                local   TEXT,
+                remoto  TEXT,
+                ts      REAL
+            );
+        """)
+        _REPLICA["esquema"] = str(REPLICA_DB)
+    return con
+
+def _filas_por_id(df: pd.DataFrame) -> dict:
+    """{id: tupla de valores en el orden de COLUMNS}; ignora ids vacíos."""
+    if df is None or df.empty:
+        return {}
+    return {f[0]: f for f in _ensure_columns(df, COLUMNS).itertuples(index=False, name=None) if str(f[0]).strip()}
+
+def replica_clientes() -> dict:
+    """Estado de la réplica; la primera vez en el proceso se carga de disco."""
+    lock = _REPLICA.setdefault("lock", threading.RLock())
+    with lock:
+        if "df" in _REPLICA:
+            return _REPLICA
+        df = pd.DataFrame(columns=COLUMNS)
+        for ruta, lector in ((CLIENTES_XLSX, pd.read_excel), (CLIENTES_CSV, pd.read_csv)):
+            try:
+                if ruta.exists():
+                    df = _ensure_columns(lector(ruta, dtype=str), COLUMNS)
+                    break
+            except Exception:
+                pass
+        base, versiones, pendientes = {}, {}, {}
+        try:
+            con = _replica_db()
+            try:
+                for id_, b, v, p, ts in con.execute("SELECT id, base, version, pendiente, actualizado FROM filas"):
+                    if b:
+                        base[id_] = tuple(json.loads(b))
+                    versiones[id_] = int(v or 0)
+                    if p:
+                        pendientes[id_] = (int(p), float(ts or 0))
+            finally:
+                con.close()
+        except Exception:
+            pass
+        _REPLICA.update(df=df, base=base, versiones=versiones, pendientes=pendientes, generacion=0,
+                        ronda=threading.Lock(), ultima_sync=0.0, ultimo_intento=0.0, error="")
+        return _REPLICA
+
+def _persistir_replica(rep: dict, ids) -> None:
+    """Guarda base/versión/pendiente de `ids` en disco (las filas sin nada que recordar se borran)."""
+    guardar, quitar = [], []
+    for i in ids:
+        b, p = rep["base"].get(i), rep["pendientes"].get(i)
+        if b is None and p is None:
+            quitar.append((i,))
+        else:
+            guardar.append((i, json.dumps(list(b)) if b is not None else None, rep["versiones"].get(i, 0),
+                            p[0] if p else 0, p[1] if p else None))
     try:
-        ws = _gs_open_worksheet(GSHEET_TAB)
-        if ws is None:
-            return
-            
-        df_nuevo = _ensure_columns(df_nuevo, COLUMNS)
+        con = _replica_db()
+        try:
+            with con:
+                con.executemany("INSERT OR REPLACE INTO filas (id, base, version, pendiente, actualizado) VALUES (?, ?, ?, ?, ?)", guardar)
+                con.executemany("DELETE FROM filas WHERE id = ?", quitar)
+        finally:
+            con.close()
+    except Exception:
+        pass
 
-        # Asegurar encabezado
+def lectura_clientes() -> tuple[pd.DataFrame, dict]:
+    """Copia de la réplica y su lectura {id: (versión, fila)}, tomadas a la vez."""
+    rep = replica_clientes()
+    with rep["lock"]:
+        cache = rep.get("lectura")
+        if cache is None or cache[0] != rep["generacion"]:
+            cache = rep["lectura"] = (rep["generacion"], {i: (rep["versiones"].get(i, 0), f) for i, f in _filas_por_id(rep["df"]).items()})
+        return rep["df"].copy(), cache[1]
+
+def _fusionar_guardado(mia, leida, actual) -> tuple:
+    """
+    Fila a guardar cuando la réplica cambió desde la lectura: (fila resultante, choques).
+    Lo que solo cambió un lado se conserva; si ambos tocaron la misma celda se queda el valor actual.
+    """
+    if mia == leida or mia == actual:
+        return actual, []
+    if actual == leida:
+        return mia, []
+    if mia is None or actual is None or leida is None:
+        # Borrado en un lado y edición en el otro (o alta con el mismo id)
+        return actual, [("*", "(borrado)" if mia is None else "(fila editada)", "(borrado)" if actual is None else "(fila editada)")]
+    fila, choques = [], []
+    for c, m, l, a in zip(COLUMNS, mia, leida, actual):
+        if m == l or m == a:
+            fila.append(a)
+        elif a == l:
+            fila.append(m)
+        else:
+            fila.append(a)
+            choques.append((c, m, a))
+    return tuple(fila), choques
+
+def registrar_cambios_replica(df: pd.DataFrame, leido: dict | None = None) -> tuple[int, list]:
+    """
+    Sustituye la réplica por `df` y marca como pendientes las filas que cambiaron.
+    Con `leido` ({id: (versión, fila)}) es un compare-and-set: las filas cuya versión cambió desde la
+    lectura se fusionan en lugar de pisarse. Devuelve (filas cambiadas, choques sin aplicar).
+    """
+    rep = replica_clientes()
+    ahora = time.time()
+    conflictos = []
+    with rep["lock"]:
+        antes, despues = _filas_por_id(rep["df"]), _filas_por_id(df)
+        df = _ensure_columns(df, COLUMNS)
+        if leido is not None:
+            resultado = dict(despues)
+            for i in dict.fromkeys([*despues, *antes]):
+                version, fila_leida = leido.get(i, (0, None))
+                if antes.get(i) == despues.get(i) or rep["versiones"].get(i, 0) == version:
+                    continue
+                resultado[i], choques = _fusionar_guardado(despues.get(i), fila_leida, antes.get(i))
+                conflictos += [{"id": i, "columna": c, "mio": m, "actual": a, "fila": despues.get(i)} for c, m, a in choques]
+            if resultado != despues:
+                filas, vistos = [], set()
+                for f in df.itertuples(index=False, name=None):
+                    if not str(f[0]).strip():
+                        filas.append(f)
+                    elif f[0] in resultado and f[0] not in vistos:
+                        vistos.add(f[0])
+                        if resultado[f[0]] is not None:
+                            filas.append(resultado[f[0]])
+                filas += [f for i, f in resultado.items() if i not in vistos and f is not None]
+                df = _ensure_columns(pd.DataFrame(filas, columns=COLUMNS), COLUMNS)
+                despues = {i: f for i, f in resultado.items() if f is not None}
+        cambios = {i: REPLICA_CAMBIO for i, f in despues.items() if antes.get(i) != f}
+        cambios.update({i: REPLICA_BORRADO for i in antes if i not in despues})
+        for i, tipo in cambios.items():
+            rep["versiones"][i] = rep["versiones"].get(i, 0) + 1
+            rep["pendientes"][i] = (tipo, ahora)
+        rep["df"] = df
+        rep["generacion"] += 1
+        if cambios:
+            _persistir_replica(rep, cambios)
+    return len(cambios), conflictos
+
+def aplicar_cambios_replica(cambios: pd.DataFrame, leido: dict | None = None) -> tuple[pd.DataFrame, list]:
+    """
+    Aplica celdas (id, columna, anterior, nuevo) sobre la réplica sin recorrer las demás filas.
+    Compare-and-set por celda: si el valor actual ya no es el leído (`leido` o, sin él, `anterior`)
+    y tampoco es el nuevo, otro usuario la cambió y se devuelve como choque.
+    Devuelve (celdas aplicadas con el mismo formato, choques).
+    """
+    rep = replica_clientes()
+    ahora = time.time()
+    conflictos = []
+    with rep["lock"]:
+        df = rep["df"]
+        ids = pd.Index(df["id"].astype(str))
+        if ids.is_unique:
+            pos = ids.get_indexer(cambios["id"].astype(str))
+        else:
+            ultima = {i: k for k, i in enumerate(ids)}
+            pos = np.array([ultima.get(str(i), -1) for i in cambios["id"]], dtype=int)
+        col_pos = np.array([COLUMNS.index(c) for c in cambios["columna"]])
+        valores = df.to_numpy()
+        existe = pos >= 0
+        actual = np.where(existe, valores[np.where(existe, pos, 0), col_pos], None)
+        leidos = cambios["anterior"].to_numpy().copy()
+        if leido:
+            for k, (i, c) in enumerate(zip(cambios["id"], col_pos)):
+                if i in leido and leido[i][1] is not None:
+                    leidos[k] = leido[i][1][c]
+        nuevo = cambios["nuevo"].to_numpy()
+        aplicar = existe & (actual == leidos) & (actual != nuevo)
+        for k in np.nonzero(~existe | ((actual != leidos) & (actual != nuevo)))[0]:
+            conflictos.append({"id": cambios["id"].iat[k], "columna": cambios["columna"].iat[k], "mio": nuevo[k],
+                               "actual": actual[k] if existe[k] else "(borrado)", "fila": None})
+        if not aplicar.any():
+            return cambios.iloc[:0][CAMBIOS_COLS], conflictos
+        aplicados = cambios.loc[aplicar, CAMBIOS_COLS].assign(anterior=actual[aplicar]).reset_index(drop=True)
+        df = df.copy()
+        for c in np.unique(col_pos[aplicar]):
+            sel = aplicar & (col_pos == c)
+            df.iloc[pos[sel], c] = nuevo[sel]
+        tocadas = set(cambios["id"].to_numpy()[aplicar])
+        for i in tocadas:
+            rep["versiones"][i] = rep["versiones"].get(i, 0) + 1
+            rep["pendientes"][i] = (REPLICA_CAMBIO, ahora)
+        rep["df"] = df
+        rep["generacion"] += 1
+        _persistir_replica(rep, tocadas)
+    return aplicados, conflictos
+
+def fusionar_replica(local: dict, base: dict, remoto: dict, pendientes: dict) -> dict:
+    """
+    Fusión a tres bandas de filas {id: tupla}. Devuelve {"filas": resultado, "subir": ids a escribir
+    en la hoja, "borrar": ids a quitar de la hoja, "conflictos": [(id, columna, local, remoto)]}.
+    """
+    filas, subir, borrar, conflictos = {}, set(), set(), []
+    for i in dict.fromkeys([*local, *remoto, *pendientes]):
+        L, B, R = local.get(i), base.get(i), remoto.get(i)
+        tipo = pendientes.get(i, (0, 0))[0]
+        if tipo == REPLICA_BORRADO:
+            if R is None:
+                continue
+            if B is None or R == B:
+                borrar.add(i)
+            else:
+                # La hoja editó una fila que aquí se borró: se conserva la edición
+                filas[i] = R
+                conflictos.append((i, "*", "(borrado)", "(editado en la hoja)"))
+        elif tipo == REPLICA_CAMBIO and L is not None:
+            if R is None:
+                filas[i] = L
+                subir.add(i)
+                if B is not None:
+                    conflictos.append((i, "*", "(editado)", "(borrado en la hoja)"))
+            elif R == B or R == L:
+                filas[i] = L
+                if L != R:
+                    subir.add(i)
+            else:
+                b = B or ("",) * len(COLUMNS)
+                fila = []
+                for c, l, r, bb in zip(COLUMNS, L, R, b):
+                    if l == r or r == bb:
+                        fila.append(l)
+                    elif l == bb:
+                        fila.append(r)
+                    else:
+                        fila.append(l)
+                        conflictos.append((i, c, l, r))
+                filas[i] = tuple(fila)
+                if filas[i] != R:
+                    subir.add(i)
+        elif R is not None:
+            filas[i] = R  # sin cambios locales: manda la hoja
+        # Sin R ni cambios locales: se borró en la hoja (o es una copia local previa a la réplica)
+    return {"filas": filas, "subir": subir, "borrar": borrar, "conflictos": conflictos}
+
+def _leer_hoja_clientes(valores: list) -> tuple[dict, dict]:
+    """({id: tupla}, {id: [números de fila]}) a partir de los valores de la pestaña de clientes."""
+    if not valores:
+        return {}, {}
+    encabezado = [str(h).strip() for h in valores[0]]
+    pos = {c: encabezado.index(c) for c in COLUMNS if c in encabezado}
+    remoto, filas = {}, {}
+    for n, f in enumerate(valores[1:], start=2):
+        t = tuple(str(f[pos[c]]) if c in pos and pos[c] < len(f) else "" for c in COLUMNS)
+        if t[0].strip():
+            remoto[t[0]] = t
+            filas.setdefault(t[0], []).append(n)
+    return remoto, filas
+
+def _aplicar_en_hoja(ws, valores: list, posiciones: dict, remoto: dict, res: dict, orden: list) -> set:
+    """
+    Escribe en la hoja el resultado de una fusión (actualizaciones, borrados y altas en lote).
+    Antes relee las filas a tocar y omite las que cambiaron desde la lectura (compare-and-set);
+    devuelve esos ids para fusionarlos de nuevo en la siguiente ronda.
+    """
+    if [str(h).strip() for h in (valores[0] if valores else [])][:len(COLUMNS)] != COLUMNS:
+        ws.update("A1", [COLUMNS])
+    ultima = gspread.utils.rowcol_to_a1(1, len(COLUMNS))[:-1]
+    tocar = [(i, n) for i in orden if i in posiciones and (i in res["subir"] or i in res["borrar"]) for n in posiciones[i]]
+    omitidas = set()
+    if tocar:
+        # Una sola lectura de las filas afectadas: si ya no coinciden con lo fusionado, no se pisan
+        releidas = ws.batch_get([f"A{n}:{ultima}{n}" for _, n in tocar])
+        for (i, n), rango in zip(tocar, releidas):
+            fila = list(rango[0]) if rango else []
+            fila = tuple(map(str, fila + [""] * (len(COLUMNS) - len(fila))))
+            if (fila != remoto[i]) if n == posiciones[i][-1] else (fila[0] != i):
+                omitidas.add(i)
+    updates = [{"range": f"A{posiciones[i][-1]}:{ultima}{posiciones[i][-1]}", "values": [list(res["filas"][i])]}
+               for i in orden if i in res["subir"] and i in posiciones and i not in omitidas]
+    for k in range(0, len(updates), 100):
+        ws.batch_update(updates[k:k + 100], value_input_option="RAW")
+    # Borrados (incluye ids repetidos) de abajo hacia arriba en una sola petición
+    borrar = sorted({n for i in res["borrar"] - omitidas for n in posiciones.get(i, [])}, reverse=True)
+    if borrar:
+        ws.spreadsheet.batch_update({"requests": [
+            {"deleteDimension": {"range": {"sheetId": ws.id, "dimension": "ROWS", "startIndex": n - 1, "endIndex": n}}}
+            for n in borrar
+        ]})
+    nuevos = [list(res["filas"][i]) for i in orden if i in res["subir"] and i not in posiciones]
+    if nuevos:
+        ws.append_rows(nuevos, value_input_option="RAW")
+    return omitidas
+
+def sincronizar_replica_clientes() -> dict:
+    """Una ronda de conciliación réplica ↔ hoja; devuelve el resumen (vacío si no hubo conexión)."""
+    rep = replica_clientes()
+    if not USE_GSHEETS:
+        return {}
+    with rep["ronda"]:
+        rep["ultimo_intento"] = time.time()
+        with rep["lock"]:
+            df_antes = rep["df"]
+            local = _filas_por_id(df_antes)
+            base, pendientes, versiones = dict(rep["base"]), dict(rep["pendientes"]), dict(rep["versiones"])
+        omitidas = set()
         try:
-            header_row = ws.row_values(1)
-            header_norm = [str(h).strip() for h in header_row]
-            if header_norm[:len(COLUMNS)] != COLUMNS:
-                ws.update("A1", [COLUMNS])
-        except Exception:
-            ws.update("A1", [COLUMNS])
+            valores = _gs_bootstrap_valores(GSHEET_TAB)
+            ws = None
+            if valores is None:
+                ws = _gs_open_worksheet(GSHEET_TAB)
+                if ws is None:
+                    raise RuntimeError("sin conexión con Google Sheets")
+                valores = ws.get_all_values()
+            remoto, posiciones = _leer_hoja_clientes(valores)
+            res = fusionar_replica(local, base, remoto, pendientes)
+            orden = list(dict.fromkeys([*local, *res["filas"]]))
+            if res["subir"] or res["borrar"]:
+                ws = ws or _gs_open_worksheet(GSHEET_TAB)
+                if ws is None:
+                    raise RuntimeError("sin conexión con Google Sheets")
+                omitidas = _aplicar_en_hoja(ws, valores, posiciones, remoto, res, orden)
+        except Exception as e:
+            rep["error"] = str(e)[:200]
+            return {}
+
+        with rep["lock"]:
+            # Lo editado durante la ronda (o que la hoja cambió antes de escribir) se queda como
+            # está y pendiente hasta la siguiente
+            actual = _filas_por_id(rep["df"])
+            editadas = {i for i in set(versiones) | set(rep["versiones"]) if rep["versiones"].get(i, 0) != versiones.get(i, 0)}
+            editadas |= omitidas
+            tocadas = set()
+            filas = []
+            for i in dict.fromkeys([*actual, *orden]):
+                f = actual.get(i) if i in editadas else res["filas"].get(i)
+                if f is not None:
+                    filas.append(f)
+                if i in editadas:
+                    continue
+                if f != actual.get(i):
+                    # Lo que llega de la hoja también sube la versión: invalida lecturas anteriores
+                    rep["versiones"][i] = rep["versiones"].get(i, 0) + 1
+                    tocadas.add(i)
+                if i in res["filas"]:
+                    if rep["base"].get(i) != res["filas"][i]:
+                        rep["base"][i] = res["filas"][i]
+                        tocadas.add(i)
+                elif rep["base"].pop(i, None) is not None:
+                    tocadas.add(i)
+                if rep["pendientes"].pop(i, None) is not None:
+                    tocadas.add(i)
+            for i in set(pendientes) - editadas:
+                if rep["pendientes"].pop(i, None) is not None:
+                    tocadas.add(i)
+                if i not in res["filas"] and rep["base"].pop(i, None) is not None:
+                    tocadas.add(i)
+            cambio_local = filas != list(local.values())
+            df_nuevo = _ensure_columns(pd.DataFrame(filas, columns=COLUMNS), COLUMNS)
+            rep["df"] = df_nuevo
+            rep["generacion"] += 1
+            _persistir_replica(rep, tocadas)
+            if res["conflictos"]:
+                try:
+                    con = _replica_db()
+                    try:
+                        with con:
+                            con.executemany("INSERT INTO conflictos (id, columna, local, remoto, ts) VALUES (?, ?, ?, ?, ?)",
+                                            [(*c, time.time()) for c in res["conflictos"]])
+                    finally:
+                        con.close()
+                except Exception:
+                    pass
+            rep["ultima_sync"] = time.time()
+            rep["error"] = ""
+            if omitidas:
+                rep["repetir"] = True
 
-        df_actual = _sheet_to_df(ws)
-        
-        # Si la hoja está vacía, usar set_with_dataframe (una sola vez)
-        if df_actual.empty:
+        if cambio_local:
             try:
-                set_with_dataframe(ws, df_nuevo, include_index=False, include_column_header=True, resize=True)
+                _escribir_clientes_local(df_nuevo)
+                actualizar_cubo_kpi(df_antes, df_nuevo)
             except Exception:
                 pass
-            return
-        
-        df_actual = _ensure_columns(df_actual, COLUMNS)
-
-        # Índices por ID para detección eficiente
-        idx_actual = {str(r["id"]): i for i, r in df_actual.reset_index(drop=True).iterrows() if str(r["id"]).strip() != ""}
-        idx_nuevo  = {str(r["id"]): i for i, r in df_nuevo.reset_index(drop=True).iterrows() if str(r["id"]).strip() != ""}
+        return {"subidas": len(res["subir"] - omitidas), "borradas": len(res["borrar"] - omitidas),
+                "conflictos": len(res["conflictos"]), "omitidas": len(omitidas), "cambio_local": cambio_local}
+
+def _ronda_replica() -> None:
+    """Trabajo del hilo de fondo: concilia y repite si llegaron guardados mientras tanto."""
+    rep = replica_clientes()
+    while True:
+        rep["repetir"] = False
+        sincronizar_replica_clientes()
+        if not rep.get("repetir") or rep.get("error"):
+            break
 
-        # 1) Nuevos: append en lote
-        nuevos_ids = [i for i in idx_nuevo.keys() if i not in idx_actual]
-        if nuevos_ids:
-            rows_to_append = df_nuevo.loc[df_nuevo["id"].astype(str).isin(nuevos_ids), COLUMNS].values.tolist()
-            try:
-                ws.append_rows(rows_to_append, value_input_option="RAW")
-            except Exception:
-                pass
+def programar_sincronizacion_replica(forzar: bool = False):
+    """Lanza una conciliación en segundo plano si hay pendientes o la réplica es antigua (sin esperar)."""
+    if not USE_GSHEETS:
+        return None
+    rep = replica_clientes()
+    with rep["lock"]:
+        futuro = rep.get("futuro")
+        if futuro is not None and not futuro.done():
+            rep["repetir"] = rep.get("repetir") or forzar
+            return futuro
+        # Con pendientes se reintenta en cada lectura; sin ellos (o tras un error) cada REPLICA_SYNC_S
+        espera = 0 if rep["pendientes"] and not rep.get("error") else REPLICA_SYNC_S
+        if not forzar and time.time() - rep.get("ultimo_intento", 0.0) < espera:
+            return None
+        rep["futuro"] = _ejecutor_replica().submit(_ronda_replica)
+        return rep["futuro"]
 
-        # 2) Actualizados: batch update (más eficiente)
-        comunes_ids = [i for i in idx_nuevo.keys() if i in idx_actual]
-        if comunes_ids:
-            updates = []
-            for _id in comunes_ids:
-                row_new = df_nuevo.loc[idx_nuevo[_id], COLUMNS]
-                row_old = df_actual.loc[idx_actual[_id], COLUMNS]
-                if not row_new.equals(row_old):
-                    fila = idx_actual[_id] + 2  # +2 por encabezado (1-indexed)
-                    # Calcular letra de última columna (ej: P para 16 columnas)
-                    import string
-                    col_letter = string.ascii_uppercase[len(COLUMNS) - 1] if len(COLUMNS) <= 26 else 'Z'
-                    rango = f"A{fila}:{col_letter}{fila}"
-                    updates.append({
-                        "range": rango,
-                        "values": [row_new.tolist()]
-                    })
-
-            # Batch update (máximo 100 por lote para evitar límites de API)
-            if updates:
-                try:
-                    for i in range(0, len(updates), 100):
-                        batch = updates[i:i+100]
-                        ws.batch_update(batch, value_input_option="RAW")
-                except Exception:
-                    pass
-                    
+def conflictos_replica(limite: int = 50) -> pd.DataFrame:
+    """Últimos choques registrados por la conciliación (más recientes primero)."""
+    try:
+        con = _replica_db()
+        try:
+            filas = con.execute("SELECT id, columna, local, remoto, ts FROM conflictos ORDER BY ts DESC LIMIT ?", (limite,)).fetchall()
+        finally:
+            con.close()
     except Exception:
-        pass
+        filas = []
+    df = pd.DataFrame(filas, columns=["id", "columna", "local", "remoto", "ts"])
+    df["ts"] = pd.to_datetime(df["ts"], unit="s").dt.strftime("%Y-%m-%d %H:%M:%S") if not df.empty else df["ts"]
+    return df
 
 # Función cargar_y_corregir_clientes optimizada
 # Función cargar_y_corregir_clientes optimizada
@@ -2849,6 +4880,8 @@ def _fix_missing_or_duplicate_ids(df: pd.DataFrame) -> pd.DataFrame:
 
 # Funciones de historial
 HIST_COLUMNS_DEFAULT = ["fecha","accion","id","nombre","detalle","usuario"]
+# Columnas extra en Sheets para poder reconstruir las transiciones de estatus (embudo/cohortes)
+HIST_GSHEET_COLUMNS = HIST_COLUMNS_DEFAULT + ["estatus_old","estatus_new","segundo_old","segundo_new"]
 
 def append_historial_gsheet(evento: dict):
     """ Agrega un registro al historial (una fila nueva) """
@@ -2960,10 +4993,9 @@ def cargar_historial(force_reload: bool = False) -> pd.DataFrame:
                         dfh_formatted = pd.DataFrame()
                         dfh_formatted['id'] = dfh.get('id', '').astype(str)
                         dfh_formatted['nombre'] = dfh.get('nombre', '').astype(str)
-                        dfh_formatted['estatus_old'] = ''  # No se almacena separadamente en GSheets
-                        dfh_formatted['estatus_new'] = ''  # No se almacena separadamente en GSheets  
-                        dfh_formatted['segundo_old'] = ''  # No se almacena separadamente en GSheets
-                        dfh_formatted['segundo_new'] = ''  # No se almacena separadamente en GSheets
+                        # Transiciones de estatus (solo existen en filas escritas con HIST_GSHEET_COLUMNS)
+                        for c in ['estatus_old', 'estatus_new', 'segundo_old', 'segundo_new']:
+                            dfh_formatted[c] = dfh[c].astype(str) if c in dfh.columns else ''
                         dfh_formatted['observaciones'] = dfh.get('detalle', '').astype(str)
                         dfh_formatted['action'] = dfh.get('accion', '').astype(str)
                         dfh_formatted['actor'] = dfh.get('usuario', '').astype(str)
@@ -3008,10 +5040,11 @@ def cargar_historial(force_reload: bool = False) -> pd.DataFrame:
         except Exception:
             pass  # Si falla Google Sheets, usar CSV local
     
-    # Respaldo: cargar desde CSV local
+    # Respaldo: cargar desde CSV local (candado compartido: no leer un append a medias)
     try:
         if HISTORIAL_CSV.exists():
-            dfh = pd.read_csv(HISTORIAL_CSV, dtype=str).fillna("")
+            with bloqueo_archivo(HISTORIAL_CSV, exclusivo=False):
+                dfh = pd.read_csv(HISTORIAL_CSV, dtype=str).fillna("")
             for c in cols:
                 if c not in dfh.columns:
                     dfh[c] = ""
@@ -3035,83 +5068,249 @@ def append_historial_gsheet(evento: dict):
     Se crea si no existe encabezado y luego se hace append.
     Silenciosa ante cualquier excepción.
     """
-    if not USE_GSHEETS:
+    append_historial_gsheet_many([evento])
+
+def append_historial_gsheet_many(eventos: list[dict]):
+    """
+    Registra varios eventos de historial en Google Sheets con una sola llamada append_rows.
+    Revisa el encabezado una sola vez por lote. Silenciosa ante cualquier excepción.
+    """
+    if not USE_GSHEETS or not eventos:
         return
     try:
         ws = _gs_open_worksheet(GSHEET_HISTTAB)
-        headers = ["fecha","accion","id","nombre","detalle","usuario"]
+        headers = HIST_GSHEET_COLUMNS
         try:
             existing_header = ws.row_values(1)
         except Exception:
             existing_header = []
-        if not existing_header:
-            try:
-                ws.update("A1", [headers])
-            except Exception:
-                pass
-        fila = [str(evento.get(col, "")) for col in headers]
+        # Encabezado vacío o del formato anterior (6 columnas): escribir el encabezado completo
+        if not existing_header or [str(h).strip() for h in existing_header] == headers[:len(existing_header)]:
+            if len(existing_header) < len(headers):
+                try:
+                    ws.update("A1", [headers])
+                except Exception:
+                    pass
+        filas = [[str(evento.get(col, "")) for col in headers] for evento in eventos]
         try:
-            ws.append_rows([fila], value_input_option="RAW")
+            ws.append_rows(filas, value_input_option="RAW")
         except Exception:
             pass
     except Exception:
         pass
 
-def append_historial(cid: str, nombre: str, estatus_old: str, estatus_new: str, seg_old: str, seg_new: str, observaciones: str = "", action: str = "ESTATUS MODIFICADO", actor: str | None = None):
+HIST_COLUMNS = ["id", "nombre", "estatus_old", "estatus_new", "segundo_old", "segundo_new", "observaciones", "action", "actor", "ts"]
+
+def registro_historial(cid: str, nombre: str, estatus_old: str, estatus_new: str, seg_old: str, seg_new: str, observaciones: str = "", action: str = "ESTATUS MODIFICADO", actor: str | None = None) -> dict:
+    """Arma un registro de historial (mismos argumentos que append_historial) sin escribirlo."""
+    return {
+        "id": cid,
+        "nombre": nombre or "",
+        "estatus_old": estatus_old or "",
+        "estatus_new": estatus_new or "",
+        "segundo_old": seg_old or "",
+        "segundo_new": seg_new or "",
+        "observaciones": observaciones or "",
+        "action": action or "",
+        "actor": actor,
+    }
+
+def append_historial_many(registros: list[dict]) -> int:
     """
-    Agrega una fila al historial de estatus (archivo CSV).
-    action: 'crear'|'modificar'|'eliminar'|'importar' u otro texto libre.
-    actor: nombre de usuario que realizó la acción; si no se pasa, se toma el usuario actual.
+    Agrega varios registros al historial en lote: un solo append al CSV local
+    y una sola llamada append_rows a Google Sheets.
+    Cada registro usa las columnas de HIST_COLUMNS (ver registro_historial);
+    'actor' y 'ts' se completan si faltan. Retorna cuántos registros se escribieron.
     """
+    global _HISTORIAL_CACHE
+    if not registros:
+        return 0
     try:
-        if actor is None:
-            cu = current_user() or {}
-            actor = cu.get("user") or cu.get("email") or "(sistema)"
-
-        registro = {
-            "id": cid,
-            "nombre": nombre or "",
-            "estatus_old": estatus_old or "",
-            "estatus_new": estatus_new or "",
-            "segundo_old": seg_old or "",
-            "segundo_new": seg_new or "",
-            "observaciones": observaciones or "",
-            "action": action or "",
-            "actor": actor or "",
-            "ts": pd.Timestamp.now().isoformat()
-        }
-        if HISTORIAL_CSV.exists():
-            dfh = cargar_historial()
-            dfh = pd.concat([dfh, pd.DataFrame([registro])], ignore_index=True)
-        else:
-            dfh = pd.DataFrame([registro])
-        dfh.to_csv(HISTORIAL_CSV, index=False, encoding="utf-8")
-        # También intentar escribir en Google Sheets (modo append) si está habilitado
-        if USE_GSHEETS:
-            try:
-                evento = {
-                    "fecha": registro.get("ts", ""),
-                    "accion": registro.get("action", ""),
-                    "id": registro.get("id", ""),
-                    "nombre": registro.get("nombre", ""),
-                    "detalle": registro.get("observaciones", ""),
-                    "usuario": registro.get("actor", "")
-                }
+        actor_default = None
+        ts_default = pd.Timestamp.now().isoformat()
+        filas = []
+        for reg in registros:
+            fila = {c: str(reg.get(c) or "") for c in HIST_COLUMNS}
+            if not reg.get("actor"):
+                if actor_default is None:
+                    cu = current_user() or {}
+                    actor_default = cu.get("user") or cu.get("email") or "(sistema)"
+                fila["actor"] = actor_default
+            if not fila["ts"]:
+                fila["ts"] = ts_default
+            filas.append(fila)
+        df_nuevos = pd.DataFrame(filas, columns=HIST_COLUMNS)
+
+        # Append local: no se relee ni reescribe el historial completo. El candado evita que
+        # dos escritores intercalen filas o dupliquen el encabezado.
+        with bloqueo_archivo(HISTORIAL_CSV):
+            existe = HISTORIAL_CSV.exists() and HISTORIAL_CSV.stat().st_size > 0
+            if existe:
                 try:
-                    append_historial_gsheet(evento)
+                    header = list(pd.read_csv(HISTORIAL_CSV, nrows=0).columns)
                 except Exception:
-                    pass
+                    header = HIST_COLUMNS
+                df_nuevos = df_nuevos.reindex(columns=header, fill_value="")
+            with open(HISTORIAL_CSV, "a", encoding="utf-8", newline="") as fh:
+                df_nuevos.to_csv(fh, header=not existe, index=False)
+                fh.flush()
+                os.fsync(fh.fileno())
+        _HISTORIAL_CACHE = None
+
+        # También escribir en Google Sheets (modo append) si está habilitado
+        if USE_GSHEETS:
+            eventos = [{
+                "fecha": fila.get("ts", ""),
+                "accion": fila.get("action", ""),
+                "id": fila.get("id", ""),
+                "nombre": fila.get("nombre", ""),
+                "detalle": fila.get("observaciones", ""),
+                "usuario": fila.get("actor", ""),
+                "estatus_old": fila.get("estatus_old", ""),
+                "estatus_new": fila.get("estatus_new", ""),
+                "segundo_old": fila.get("segundo_old", ""),
+                "segundo_new": fila.get("segundo_new", "")
+            } for fila in filas]
+            try:
+                append_historial_gsheet_many(eventos)
             except Exception:
                 pass
+        return len(filas)
     except Exception:
         # no bloquear la app por errores de historial
-        pass
+        return 0
+
+def append_historial(cid: str, nombre: str, estatus_old: str, estatus_new: str, seg_old: str, seg_new: str, observaciones: str = "", action: str = "ESTATUS MODIFICADO", actor: str | None = None):
+    """
+    Agrega una fila al historial de estatus (archivo CSV).
+    action: 'crear'|'modificar'|'eliminar'|'importar' u otro texto libre.
+    actor: nombre de usuario que realizó la acción; si no se pasa, se toma el usuario actual.
+    Para operaciones de varias filas usar append_historial_many.
+    """
+    append_historial_many([registro_historial(cid, nombre, estatus_old, estatus_new, seg_old, seg_new, observaciones, action=action, actor=actor)])
+
+# ---------- Embudo y cohortes (transiciones del historial) ----------
+EMBUDO_ESTATUS_FINAL = "DISPERSADO"
+_EMBUDO_CACHE = _estado_compartido("embudo")
+
+def _hash_filas_historial(dfh: pd.DataFrame) -> np.ndarray:
+    """Hash por fila del historial (independiente del índice y del orden)."""
+    cols = [c for c in HIST_COLUMNS if c in dfh.columns]
+    return pd.util.hash_pandas_object(dfh[cols].astype(str), index=False).to_numpy()
+
+def eventos_estatus(dfh: pd.DataFrame) -> pd.DataFrame:
+    """
+    Extrae los cambios de estatus del historial: filas con estatus_new no vacío y
+    distinto de estatus_old. Retorna columnas id, estatus, ts (datetime).
+    """
+    vacio = pd.DataFrame({"id": pd.Series(dtype=str), "estatus": pd.Series(dtype=str), "ts": pd.Series(dtype="datetime64[ns]")})
+    if dfh is None or dfh.empty or "estatus_new" not in dfh.columns:
+        return vacio
+    nuevo = dfh["estatus_new"].fillna("").astype(str).str.strip()
+    viejo = dfh.get("estatus_old", pd.Series("", index=dfh.index)).fillna("").astype(str).str.strip()
+    mask = nuevo.ne("") & nuevo.ne(viejo)
+    if not mask.any():
+        return vacio
+    ts = pd.to_datetime(dfh.loc[mask, "ts"], errors="coerce", utc=True, format="mixed").dt.tz_localize(None)
+    ev = pd.DataFrame({
+        "id": dfh.loc[mask, "id"].fillna("").astype(str).str.strip(),
+        "estatus": nuevo[mask].str.upper(),
+        "ts": ts.astype("datetime64[ns]"),
+    })
+    return ev[ev["id"].ne("") & ev["ts"].notna()].reset_index(drop=True)
+
+def lineas_tiempo_estatus(eventos: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reconstruye la línea de tiempo por cliente: un tramo por estatus con inicio (ts),
+    fin (ts del siguiente cambio) y duración en días. El tramo vigente queda sin fin.
+    """
+    ev = eventos.sort_values(["id", "ts"], kind="mergesort")
+    # Quitar estados repetidos consecutivos del mismo cliente
+    repetido = ev["id"].eq(ev["id"].shift()) & ev["estatus"].eq(ev["estatus"].shift())
+    ev = ev[~repetido].copy()
+    ev["ts_fin"] = ev.groupby("id")["ts"].shift(-1)
+    ev["dias"] = (ev["ts_fin"] - ev["ts"]).dt.total_seconds() / 86400
+    return ev.reset_index(drop=True)
+
+def metricas_embudo(lineas: pd.DataFrame) -> pd.DataFrame:
+    """
+    Por estatus: clientes que entraron, cuántos llegaron después a DISPERSADO,
+    tasa de conversión y mediana de días en la etapa (solo tramos cerrados).
+    """
+    cols = ["estatus", "clientes", "convertidos", "conversion_pct", "mediana_dias"]
+    if lineas.empty:
+        return pd.DataFrame(columns=cols)
+    disp = lineas.loc[lineas["estatus"].eq(EMBUDO_ESTATUS_FINAL)].groupby("id")["ts"].max()
+    convertido = disp.reindex(lineas["id"].to_numpy()).to_numpy() >= lineas["ts"].to_numpy()
+    por_cliente = lineas.assign(convertido=convertido).groupby(["estatus", "id"])["convertido"].any()
+    etapas = por_cliente.groupby(level="estatus").agg(clientes="size", convertidos="sum")
+    etapas["mediana_dias"] = lineas.groupby("estatus")["dias"].median()
+    etapas["conversion_pct"] = (etapas["convertidos"] / etapas["clientes"] * 100).round(1)
+    etapas = etapas.reset_index().sort_values("clientes", ascending=False)
+    etapas["convertidos"] = etapas["convertidos"].astype(int)
+    return etapas[cols].reset_index(drop=True)
+
+def curvas_cohorte(lineas: pd.DataFrame) -> pd.DataFrame:
+    """
+    Curvas por cohorte mensual (mes del primer cambio de estatus): porcentaje de la cohorte
+    en DISPERSADO al cierre de cada mes posterior. Estado al corte vía merge_asof.
+    """
+    cols = ["cohorte", "mes", "clientes", "dispersados", "pct_dispersado"]
+    if lineas.empty:
+        return pd.DataFrame(columns=cols)
+    # Meses como enteros (año*12 + mes-1) para trabajar sin objetos Period
+    inicio = lineas.groupby("id")["ts"].min()
+    cohorte = inicio.dt.year * 12 + inicio.dt.month - 1
+    ultimo = lineas["ts"].max()
+    cortes = np.arange(cohorte.min(), ultimo.year * 12 + ultimo.month)
+    grid = pd.DataFrame({"id": np.repeat(cohorte.index.to_numpy(), len(cortes)),
+                         "periodo": np.tile(cortes, len(cohorte))})
+    grid["cohorte"] = grid["id"].map(cohorte)
+    grid = grid[grid["periodo"] >= grid["cohorte"]].copy()
+    # Corte = último instante del mes (inicio del mes siguiente - 1ns)
+    sig = grid["periodo"] + 1
+    grid["corte"] = pd.to_datetime(pd.DataFrame({"year": sig // 12, "month": sig % 12 + 1, "day": 1})) - pd.Timedelta(1, "ns")
+    estado = pd.merge_asof(
+        grid.sort_values("corte"),
+        lineas[["id", "ts", "estatus"]].sort_values("ts"),
+        left_on="corte", right_on="ts", by="id", direction="backward"
+    )
+    estado["mes"] = estado["periodo"] - estado["cohorte"]
+    estado["disp"] = estado["estatus"].eq(EMBUDO_ESTATUS_FINAL)
+    curvas = estado.groupby(["cohorte", "mes"]).agg(clientes=("id", "size"), dispersados=("disp", "sum")).reset_index()
+    curvas["pct_dispersado"] = (curvas["dispersados"] / curvas["clientes"] * 100).round(1)
+    curvas["cohorte"] = (curvas["cohorte"] // 12).astype(str) + "-" + (curvas["cohorte"] % 12 + 1).astype(str).str.zfill(2)
+    return curvas[cols]
+
+def analisis_embudo(dfh: pd.DataFrame | None = None) -> dict:
+    """
+    Embudo y cohortes a partir del historial, con caché incremental: solo las filas
+    nuevas (por hash) se convierten en eventos. Si desaparecen filas ya procesadas
+    (p. ej. se borró historial) se reconstruye todo.
+    Retorna {'lineas', 'etapas', 'cohortes'}.
+    """
+    if dfh is None:
+        dfh = cargar_historial()
+    hashes = _hash_filas_historial(dfh) if dfh is not None and not dfh.empty else np.array([], dtype="uint64")
+    previo = _EMBUDO_CACHE.get("estado")
+    if previo is not None and np.isin(previo["hashes"], hashes).all():
+        nuevas = ~np.isin(hashes, previo["hashes"])
+        if not nuevas.any():
+            return previo["resultado"]
+        eventos = pd.concat([previo["eventos"], eventos_estatus(dfh[nuevas])], ignore_index=True)
+    else:
+        eventos = eventos_estatus(dfh)
+    lineas = lineas_tiempo_estatus(eventos)
+    resultado = {"lineas": lineas, "etapas": metricas_embudo(lineas), "cohortes": curvas_cohorte(lineas)}
+    _EMBUDO_CACHE["estado"] = {"hashes": np.unique(hashes), "eventos": eventos, "resultado": resultado}
+    return resultado
 
 def eliminar_cliente(cid: str, df: pd.DataFrame, borrar_historial: bool = False) -> pd.DataFrame:
     """
     Elimina al cliente del DataFrame `df`, borra su carpeta de documentos y (opcionalmente) las entradas de historial.
     Retorna el DataFrame resultante (y guarda el CSV de clientes).
     """
+    global _HISTORIAL_CACHE
     try:
         if cid is None or cid == "" or df is None or df.empty or "id" not in df.columns:
             return df
@@ -3122,58 +5321,24 @@ def eliminar_cliente(cid: str, df: pd.DataFrame, borrar_historial: bool = False)
                 shutil.rmtree(folder)
         except Exception:
             pass
+        desindexar_cliente(cid)
 
         # Eliminar de df
         df_new = df[df["id"] != cid].reset_index(drop=True)
         guardar_clientes(df_new)
 
-        # --- NUEVO: eliminar también de la hoja de Google Sheets (si está habilitado) ---
-        if USE_GSHEETS:
-            try:
-                ws = _gs_open_worksheet(GSHEET_TAB)
-                vals = ws.get_all_values()
-                if vals and len(vals) > 0:
-                    header = [str(h).strip() for h in vals[0]]
-                    # buscar índice de la columna 'id' (case/acentos tolerantemente)
-                    id_col = None
-                    for idx, h in enumerate(header):
-                        if _norm_key(h) == _norm_key("id"):
-                            id_col = idx
-                            break
-                    if id_col is not None:
-                        rows_to_delete = []
-                        # recorrer filas de datos (vals[1:] corresponde a filas físicas a partir de la 2)
-                        for i in range(1, len(vals)):
-                            try:
-                                cell = vals[i][id_col] if id_col < len(vals[i]) else ""
-                            except Exception:
-                                cell = ""
-                            if str(cell).strip() == str(cid):
-                                # i -> índice en vals; la fila en la hoja es i+1 (1-based)
-                                rows_to_delete.append(i + 1)
-                        # borrar de abajo hacia arriba para no invalidar índices
-                        for rownum in sorted(rows_to_delete, reverse=True):
-                            try:
-                                ws.delete_rows(rownum)
-                            except Exception:
-                                # fallback no crítico: intentar limpiar la fila en lugar de borrarla
-                                try:
-                                    # limpiar un rango amplio (A..Z) para evitar errores si delete_rows falla
-                                    ws.update(f"A{rownum}:Z{rownum}", [[""] * 26])
-                                except Exception:
-                                    pass
-            except Exception:
-                # silenciar cualquier error de GSheets para no romper la app
-                pass
-        # -------------------------------------------------------
+        # La fila se quita de la hoja de Google Sheets al conciliar la réplica (incluidos ids repetidos)
 
         # Borrar historial asociado si se solicita
         if borrar_historial:
             try:
                 if HISTORIAL_CSV.exists():
-                    dfh = cargar_historial()
-                    dfh = dfh[dfh["id"] != cid].reset_index(drop=True)
-                    dfh.to_csv(HISTORIAL_CSV, index=False, encoding="utf-8")
+                    # leer el CSV local (no la versión de Sheets) para no perder columnas al reescribir
+                    with bloqueo_archivo(HISTORIAL_CSV), archivo_atomico(HISTORIAL_CSV) as tmp:
+                        dfh = pd.read_csv(HISTORIAL_CSV, dtype=str).fillna("")
+                        dfh = dfh[dfh["id"] != cid].reset_index(drop=True)
+                        dfh.to_csv(tmp, index=False, encoding="utf-8")
+                    _HISTORIAL_CACHE = None
             except Exception:
                 pass
 
@@ -3186,8 +5351,6 @@ import secrets
 import base64
 
 USERS_FILE = DATA_DIR / "users.json"   # { "users":[{"user": "...", "role":"admin|member", "salt":"...", "hash":"..."}] }
-# Google Sheets tab name for users
-GSHEET_USERSTAB = "users"
 
 PERMISSIONS = {
     "admin":  {"manage_users": True,  "delete_client": True},
@@ -3218,16 +5381,54 @@ def do_rerun():
     except Exception:
         return
 
-def _hash_pw_pbkdf2(password: str, salt_hex: str | None = None) -> tuple[str, str]:
+# --- Contraseñas ---
+# El hash guarda sus parámetros: "pbkdf2_sha256$<iteraciones>$<hex>" o "scrypt$<n>$<r>$<p>$<hex>".
+# Un hash sin prefijo es del formato anterior (pbkdf2_sha256, 100 000 iteraciones).
+# Cambiar PW_PARAMETROS ajusta el costo; cada usuario se re-hashea al iniciar sesión.
+PW_PARAMETROS = "pbkdf2_sha256$100000"
+PW_PARAMETROS_LEGADO = "pbkdf2_sha256$100000"
+PW_MAX_HILOS = 2
+
+@st.cache_resource
+def _ejecutor_hash():
+    """Pool acotado para derivar contraseñas fuera del hilo del script (hashlib libera el GIL)."""
+    import concurrent.futures
+    return concurrent.futures.ThreadPoolExecutor(max_workers=PW_MAX_HILOS, thread_name_prefix="pw")
+
+def _separar_hash_pw(hash_str: str) -> tuple[str, str]:
+    """("esquema$parámetros", hex) de un hash guardado."""
+    hash_str = hash_str or ""
+    if "$" not in hash_str:
+        return PW_PARAMETROS_LEGADO, hash_str
+    params, _, hh = hash_str.rpartition("$")
+    return params, hh
+
+def _derivar_pw(password: str, salt_hex: str, params: str) -> str:
+    esquema, *valores = params.split("$")
+    pw, salt = (password or "").encode("utf-8"), bytes.fromhex(salt_hex)
+    if esquema == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac("sha256", pw, salt, int(valores[0])).hex()
+    if esquema == "scrypt":
+        n, r, p = (int(v) for v in valores)
+        return hashlib.scrypt(pw, salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + (1 << 20)).hex()
+    raise ValueError(f"Esquema de contraseña desconocido: {esquema}")
+
+def _hash_pw(password: str, salt_hex: str | None = None) -> tuple[str, str]:
+    """(salt, hash versionado) con los parámetros actuales."""
     if not salt_hex:
         salt_hex = secrets.token_hex(16)
-    salt = bytes.fromhex(salt_hex)
-    dk = hashlib.pbkdf2_hmac("sha256", (password or "").encode("utf-8"), salt, 100_000)
-    return salt_hex, dk.hex()
+    return salt_hex, f"{PW_PARAMETROS}${_derivar_pw(password, salt_hex, PW_PARAMETROS)}"
 
 def _verify_pw(password: str, salt_hex: str, hash_hex: str) -> bool:
-    _, hh = _hash_pw_pbkdf2(password, salt_hex)
-    return secrets.compare_digest(hh, (hash_hex or ""))
+    params, hh = _separar_hash_pw(hash_hex)
+    try:
+        calculado = _ejecutor_hash().submit(_derivar_pw, password, salt_hex, params).result()
+    except Exception:
+        return False
+    return secrets.compare_digest(calculado, hh)
+
+def pw_necesita_rehash(hash_str: str) -> bool:
+    return _separar_hash_pw(hash_str)[0] != PW_PARAMETROS
 
 def cargar_usuarios_gsheet(force_reload: bool = False) -> dict:
     """
@@ -3249,11 +5450,15 @@ def cargar_usuarios_gsheet(force_reload: bool = False) -> dict:
         return {"users": []}
     
     try:
-        ws = _gs_open_worksheet(GSHEET_USERSTAB, force_reload=force_reload)
-        if ws is None:
-            return {"users": []}
-            
-        df = get_as_dataframe(ws, evaluate_formulas=True, dtype=str, header=0).dropna(how="all")
+        valores = None if force_reload else _gs_bootstrap_valores(GSHEET_USERSTAB)
+        if valores is not None:
+            df = _df_desde_valores(valores)
+        else:
+            ws = _gs_open_worksheet(GSHEET_USERSTAB, force_reload=force_reload)
+            if ws is None:
+                return {"users": []}
+
+            df = get_as_dataframe(ws, evaluate_formulas=True, dtype=str, header=0).dropna(how="all")
         if df is None or df.empty:
             result = {"users": []}
         else:
@@ -3352,7 +5557,7 @@ def save_users(obj: dict):
     
     # 2) Guardar en archivo local (backup)
     try:
-        USERS_FILE.write_text(json.dumps(obj, indent=2, ensure_ascii=False), encoding="utf-8")
+        guardar_json(USERS_FILE, obj)
     except Exception as e:
         st.error(f"Error guardando usuarios localmente: {e}")
 
@@ -3367,16 +5572,99 @@ def sync_usuarios_local_to_gsheet():
     except Exception as e:
         st.error(f"Error sincronizando usuarios: {e}")
 
+# --- Directorio de usuarios y control de intentos de login ---
+# Índice compartido entre sesiones {usuario/email normalizado: usuario}. Se recarga al
+# guardar, si cambia users.json o cada DIRECTORIO_TTL_S (Sheets), no en cada rerun.
+DIRECTORIO_TTL_S = 300
+LOGIN_VENTANA_S = 15 * 60
+# Fallos por usuario: desde una misma IP y en total. Sin límite por IP sola: detrás de un
+# proxy toda la oficina comparte IP y un solo usuario bloquearía a todos.
+LOGIN_MAX_FALLOS_USUARIO_IP = 5
+LOGIN_MAX_FALLOS_USUARIO = 20
+_DIRECTORIO_USUARIOS = _estado_compartido("directorio_usuarios")
+_INTENTOS_LOGIN = _estado_compartido("intentos_login")
+
+def _norm_usuario(identifier: str) -> str:
+    return (identifier or "").strip().lower()
+
+def _firma_users_file():
+    try:
+        st_ = USERS_FILE.stat()
+        return (st_.st_mtime_ns, st_.st_size)
+    except Exception:
+        return None
+
+def directorio_usuarios(force_reload: bool = False) -> dict:
+    """{"data": {"users": [...]}, "indice": {clave: usuario}}; 'user' y 'email' son claves."""
+    d = _DIRECTORIO_USUARIOS
+    firma = _firma_users_file()
+    vigente = ("indice" in d and d.get("firma") == firma
+               and (time.time() - d.get("ts", 0)) < DIRECTORIO_TTL_S)
+    if force_reload or not vigente:
+        data = load_users()
+        indice = {}
+        for u in data.get("users", []):
+            for campo in ("email", "user"):  # 'user' gana si coincide con el email de otro
+                clave = _norm_usuario(u.get(campo, ""))
+                if clave:
+                    indice[clave] = u
+        d.update(data=data, indice=indice, firma=firma, ts=time.time())
+    return d
+
+def invalidar_directorio_usuarios() -> None:
+    _DIRECTORIO_USUARIOS.pop("indice", None)
+    limpiar_cache_usuarios()
+
+def _ip_cliente() -> str:
+    try:
+        return st.context.ip_address or ""
+    except Exception:
+        return ""
+
+def _fallos_recientes(clave: tuple, ahora: float) -> list:
+    fallos = [t for t in _INTENTOS_LOGIN.get(clave, []) if ahora - t < LOGIN_VENTANA_S]
+    if fallos:
+        _INTENTOS_LOGIN[clave] = fallos
+    else:
+        _INTENTOS_LOGIN.pop(clave, None)
+    return fallos
+
+def _claves_intento_login(identifier: str, ip: str) -> tuple:
+    """((clave, límite), ...): el usuario desde esta IP y el usuario desde cualquier IP."""
+    usuario = _norm_usuario(identifier)
+    if not usuario:
+        return ()
+    return ((("uip", usuario, ip or ""), LOGIN_MAX_FALLOS_USUARIO_IP), (("u", usuario), LOGIN_MAX_FALLOS_USUARIO))
+
+def login_bloqueado(identifier: str, ip: str = "") -> float:
+    """Segundos que faltan para poder intentar de nuevo (0 si no hay bloqueo)."""
+    ahora = time.time()
+    espera = 0.0
+    for clave, limite in _claves_intento_login(identifier, ip):
+        fallos = _fallos_recientes(clave, ahora)
+        if len(fallos) >= limite:
+            espera = max(espera, fallos[-limite] + LOGIN_VENTANA_S - ahora)
+    return espera
+
+def registrar_intento_login(identifier: str, ip: str, exito: bool) -> None:
+    """Cuenta fallos por usuario (y usuario + IP); un login correcto los limpia."""
+    claves = [clave for clave, _ in _claves_intento_login(identifier, ip)]
+    if exito:
+        for clave in claves:
+            _INTENTOS_LOGIN.pop(clave, None)
+        return
+    ahora = time.time()
+    if len(_INTENTOS_LOGIN) > 10_000:  # acotar memoria ante barridos de usuarios
+        for clave in list(_INTENTOS_LOGIN):
+            _fallos_recientes(clave, ahora)
+    for clave in claves:
+        _INTENTOS_LOGIN.setdefault(clave, []).append(ahora)
+
 def get_user(identifier: str) -> dict | None:
     """Buscar usuario por username o por email (compatibilidad backward).
     identifier: lo que ingresa el usuario (username); busca en 'user' o 'email'.
     """
-    ident = (identifier or "").strip().lower()
-    data = load_users()
-    for u in data.get("users", []):
-        if u.get("user", "").lower() == ident or u.get("email", "").lower() == ident:
-            return u
-    return None
+    return directorio_usuarios()["indice"].get(_norm_usuario(identifier))
 
 def add_user(username: str, password: str, role: str = "member") -> tuple[bool, str]:
     uname = (username or "").strip()
@@ -3384,33 +5672,43 @@ def add_user(username: str, password: str, role: str = "member") -> tuple[bool,
         return False, "Usuario y contraseña son obligatorios."
     if role not in ("admin", "member"):
         return False, "Rol inválido."
-    data = load_users()
     # comprueba duplicados en 'user' y en el antiguo 'email'
-    lower_uname = uname.lower()
-    if any((u.get("user","") or u.get("email","" )).lower() == lower_uname for u in data.get("users", [])):
+    d = directorio_usuarios(force_reload=True)
+    if _norm_usuario(uname) in d["indice"]:
         return False, "Ese usuario ya existe."
-    salt_hex, hash_hex = _hash_pw_pbkdf2(password)
+    salt_hex, hash_hex = _hash_pw(password)
+    data = {"users": list(d["data"].get("users", []))}
     data["users"].append({"user": uname, "role": role, "salt": salt_hex, "hash": hash_hex})
     save_users(data)
     # Limpiar caché para forzar recarga
-    limpiar_cache_usuarios()
+    invalidar_directorio_usuarios()
     return True, "Usuario creado."
 
 def delete_user(username: str) -> tuple[bool, str]:
-    name = (username or "").strip().lower()
+    name = _norm_usuario(username)
     if not name:
         return False, "Usuario inválido."
-    data = load_users()
-    users = data.get("users", [])
-    for i, u in enumerate(users):
-        if (u.get("user","") or u.get("email","" )).lower() == name:
-            users.pop(i)
-            data["users"] = users
-            save_users(data)
-            # Limpiar caché para forzar recarga
-            limpiar_cache_usuarios()
-            return True, "Usuario eliminado."
-    return False, "Usuario no encontrado."
+    d = directorio_usuarios(force_reload=True)
+    objetivo = d["indice"].get(name)
+    if objetivo is None:
+        return False, "Usuario no encontrado."
+    data = {"users": [u for u in d["data"].get("users", []) if u is not objetivo]}
+    save_users(data)
+    # Limpiar caché para forzar recarga
+    invalidar_directorio_usuarios()
+    return True, "Usuario eliminado."
+
+def rehash_usuario(identifier: str, password: str) -> bool:
+    """Tras un login correcto, guarda el hash con los parámetros actuales si cambiaron."""
+    d = directorio_usuarios()
+    u = d["indice"].get(_norm_usuario(identifier))
+    if u is None or not pw_necesita_rehash(u.get("hash", "")):
+        return False
+    salt_hex, hash_hex = _ejecutor_hash().submit(_hash_pw, password).result()
+    data = {"users": [{**x, "salt": salt_hex, "hash": hash_hex} if x is u else x for x in d["data"].get("users", [])]}
+    save_users(data)
+    invalidar_directorio_usuarios()
+    return True
 
 def maybe_migrate_legacy_admin():
     legacy = DATA_DIR / "admin.json"
@@ -3436,9 +5734,98 @@ def maybe_migrate_legacy_admin():
 
 maybe_migrate_legacy_admin()
 
+# --- Tokens de sesión ---
+# "<usuario b64>.<expira>.<firma>" con HMAC-SHA256 y un secreto del servidor. La firma
+# incluye una huella del hash de la contraseña y la época de sesión del usuario: cambiar
+# la contraseña o cerrar sesión (que sube la época) invalida los tokens emitidos.
+SESSION_TTL_S = 12 * 3600
+SESSION_SECRET_FILE = DATA_DIR / ".session_secret"
+SESSION_EPOCAS_FILE = DATA_DIR / "sesiones.json"
+_SESION = _estado_compartido("sesion")
+
+def _secreto_sesion() -> bytes:
+    if "secreto" not in _SESION:
+        secreto = ""
+        try:
+            secreto = st.secrets.get("SESSION_SECRET", "")
+        except Exception:
+            pass
+        if not secreto:
+            try:
+                # Se crea ya con 0600 y bajo candado: todos los procesos leen el mismo secreto del disco
+                with bloqueo_archivo(SESSION_SECRET_FILE):
+                    if not SESSION_SECRET_FILE.exists():
+                        fd = os.open(SESSION_SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                            fh.write(secrets.token_hex(32))
+                    secreto = SESSION_SECRET_FILE.read_text(encoding="utf-8").strip()
+            except Exception:
+                secreto = secrets.token_hex(32)  # solo vale mientras viva el proceso
+        _SESION["secreto"] = str(secreto).encode("utf-8")
+    return _SESION["secreto"]
+
+def _leer_epocas_sesion() -> dict:
+    try:
+        return json.loads(SESSION_EPOCAS_FILE.read_text(encoding="utf-8"))
+    except Exception:
+        return {}
+
+def epoca_sesion(usuario: str) -> int:
+    """Época de sesión vigente del usuario (0 si nunca cerró sesión); se relee si cambia el archivo."""
+    try:
+        st_ = SESSION_EPOCAS_FILE.stat()
+        firma = (st_.st_mtime_ns, st_.st_size)
+    except Exception:
+        firma = None
+    if _SESION.get("epocas_firma") != firma or "epocas" not in _SESION:
+        _SESION["epocas"] = _leer_epocas_sesion()
+        _SESION["epocas_firma"] = firma
+    return int(_SESION["epocas"].get(_norm_usuario(usuario), 0))
+
+def revocar_sesiones(usuario: str) -> None:
+    """Sube la época de sesión del usuario: todo token emitido antes deja de ser válido."""
+    with bloqueo_archivo(SESSION_EPOCAS_FILE), archivo_atomico(SESSION_EPOCAS_FILE) as tmp:
+        epocas = _leer_epocas_sesion()
+        clave = _norm_usuario(usuario)
+        epocas[clave] = int(epocas.get(clave, 0)) + 1
+        tmp.write_text(json.dumps(epocas, ensure_ascii=False, indent=2), encoding="utf-8")
+    _SESION.pop("epocas", None)
+
+def _firma_sesion(usuario: str, expira: int, u: dict) -> str:
+    import hmac
+    huella = hashlib.sha256((u.get("hash") or "").encode("utf-8")).hexdigest()[:16]
+    epoca = epoca_sesion(usuario)
+    return hmac.new(_secreto_sesion(), f"{usuario}|{expira}|{huella}|{epoca}".encode("utf-8"), "sha256").hexdigest()
+
+def emitir_token_sesion(u: dict) -> str:
+    usuario = u.get("user") or u.get("email") or ""
+    expira = int(time.time()) + SESSION_TTL_S
+    usuario_b64 = base64.urlsafe_b64encode(usuario.encode("utf-8")).decode("ascii").rstrip("=")
+    return f"{usuario_b64}.{expira}.{_firma_sesion(usuario, expira, u)}"
+
+def validar_token_sesion(token: str | None) -> dict | None:
+    """auth_user si el token es válido, vigente y el usuario sigue existiendo; None si no."""
+    try:
+        usuario_b64, expira, firma = (token or "").split(".")
+        expira = int(expira)
+        if expira < time.time():
+            return None
+        usuario = base64.urlsafe_b64decode(usuario_b64 + "=" * (-len(usuario_b64) % 4)).decode("utf-8")
+        u = get_user(usuario)
+        if u is None or not secrets.compare_digest(firma, _firma_sesion(usuario, expira, u)):
+            return None
+        return {"user": u.get("user") or u.get("email"), "role": u.get("role", "member")}
+    except Exception:
+        return None
+
 # session state for auth
 if "auth_user" not in st.session_state:
     st.session_state["auth_user"] = None  # dict: {"email":..., "role":...}
+# Sesión nueva (reconexión, otra pestaña): restaurar desde el token de la URL sin pedir contraseña
+if st.session_state["auth_user"] is None and st.query_params.get(SESSION_PARAM):
+    st.session_state["auth_user"] = validar_token_sesion(st.query_params.get(SESSION_PARAM))
+    if st.session_state["auth_user"] is None:
+        st.query_params.pop(SESSION_PARAM, None)
 
 def current_user():
     return st.session_state.get("auth_user")
@@ -3472,11 +5859,11 @@ def maybe_migrate_users_to_gsheet():
     except Exception as e:
         st.sidebar.warning(f"⚠️ Error migrando usuarios: {e}")
 
-# Setup inicial: si no hay usuarios, crear primer admin
-maybe_migrate_users_to_gsheet()
-users_data = load_users()
-# Setup inicial: si no hay usuarios, crear primer admin
-users_data = load_users()
+# Setup inicial: si no hay usuarios, crear primer admin (la migración se revisa una vez por proceso)
+if not _DIRECTORIO_USUARIOS.get("migrado"):
+    maybe_migrate_users_to_gsheet()
+    _DIRECTORIO_USUARIOS["migrado"] = True
+users_data = directorio_usuarios()["data"]
 if not users_data.get("users"):
     with st.sidebar.expander("Configurar administrador", expanded=True):
         st.warning("No hay usuarios. Crea el primer administrador.")
@@ -3506,10 +5893,24 @@ if not current_user():
         submitted = st.form_submit_button("Entrar")
 
     if submitted:
-        u = get_user(luser)
-        if u and _verify_pw(lpw, u.get("salt",""), u.get("hash","")):
+        ip = _ip_cliente()
+        espera = login_bloqueado(luser, ip)
+        u = get_user(luser) if not espera else None
+        # Usuario inexistente: no se calcula el PBKDF2
+        ok = bool(u) and _verify_pw(lpw, u.get("salt",""), u.get("hash",""))
+        if not espera:
+            registrar_intento_login(luser, ip, ok)
+        if ok:
+            try:
+                rehash_usuario(luser, lpw)
+            except Exception:
+                pass
+        if espera:
+            st.error(f"Demasiados intentos fallidos. Intenta de nuevo en {int(espera // 60) + 1} min.")
+        elif ok:
             # establecer usuario y limpiar estado sensible
             st.session_state["auth_user"] = {"user": u.get("user") or u.get("email"), "role": u["role"]}
+            st.query_params[SESSION_PARAM] = emitir_token_sesion(get_user(luser) or u)
             for _k in ("login_pw", "login_user"):
                 st.session_state.pop(_k, None)
             # quitar el formulario al instante; no forzar rerun inmediato (evita pantalla en blanco)
@@ -3526,7 +5927,12 @@ if not current_user():
 u = current_user()
 st.sidebar.markdown(f"**Usuario:** {u.get('user') or u.get('email')} — _{u['role']}_")
 if st.sidebar.button("Cerrar sesión"):
+    try:
+        revocar_sesiones(u.get("user") or u.get("email") or "")
+    except Exception:
+        pass
     st.session_state["auth_user"] = None
+    st.query_params.pop(SESSION_PARAM, None)
     # Limpiar filtros y campos de login/alta para evitar que queden visibles
     for k in ("f_suc","f_est","f_ases","ases_q","suc_q","est_q",
               "login_user","login_pw",
@@ -3561,6 +5967,48 @@ if is_admin():
 
     # Mostrar lista de usuarios opcionalmente (toggle apagado por defecto)
     # -- Sincronización Usuarios (admin) --
+    with st.sidebar.expander("📈 Uso de Google Sheets", expanded=False):
+        m = metricas_gsheets()
+        c1, c2 = st.columns(2)
+        c1.metric("Lecturas", m["lecturas"])
+        c2.metric("Escrituras", m["escrituras"])
+        c1.metric("Coalescidas", m["coalescidas"])
+        c2.metric("Reintentos", m["reintentos"])
+        st.caption(f"Espera por cupo: {m['espera_s']:.1f} s · Errores: {m['errores']}")
+        if m["ultimo_error"]:
+            st.caption(f"Último error: {m['ultimo_error']}")
+
+    with st.sidebar.expander("🗂️ Réplica de clientes", expanded=False):
+        _rep_cli = replica_clientes()
+        c1, c2 = st.columns(2)
+        c1.metric("Filas", len(_rep_cli["df"]))
+        c2.metric("Pendientes", len(_rep_cli["pendientes"]))
+        if _rep_cli.get("ultima_sync"):
+            st.caption(f"Última conciliación: hace {int(time.time() - _rep_cli['ultima_sync'])} s")
+        if _rep_cli.get("error"):
+            st.caption(f"Último error: {_rep_cli['error']}")
+        if st.button("Conciliar ahora", key="replica_sync"):
+            with st.spinner("Conciliando con Google Sheets..."):
+                _res_sync = sincronizar_replica_clientes()
+            if not _res_sync:
+                # Resumen vacío: la ronda falló (o Google Sheets está desactivado)
+                st.error(f"No se pudo conciliar: {_rep_cli.get('error') or 'Google Sheets no está activo'}")
+            else:
+                st.success(f"Subidas: {_res_sync.get('subidas', 0)} · Borradas: {_res_sync.get('borradas', 0)} · Conflictos: {_res_sync.get('conflictos', 0)}")
+        _conf = conflictos_replica(20)
+        if not _conf.empty:
+            st.caption("Conflictos recientes (se conservó el valor local):")
+            st.dataframe(_conf, hide_index=True, use_container_width=True)
+
+    with st.sidebar.expander("🔒 Candados de archivos", expanded=False):
+        _mb = metricas_bloqueos()
+        c1, c2 = st.columns(2)
+        c1.metric("Escrituras", _mb["adquisiciones"])
+        c2.metric("Con espera", _mb["con_espera"])
+        st.caption(f"Espera total: {_mb['espera_s']:.2f} s · Máxima: {_mb['max_s']:.2f} s")
+        for _arch, _seg in sorted(_mb["por_archivo"].items(), key=lambda x: -x[1])[:5]:
+            st.caption(f"{_arch}: {_seg:.2f} s")
+
     with st.sidebar.expander("🔄 Sincronización Usuarios", expanded=False):
         st.caption("Sincronizar usuarios entre Google Sheets y archivo local")
         
@@ -3575,17 +6023,14 @@ if is_admin():
             if st.button("📥 Desde Google Sheets", key="sync_from_gs"):
                 gsheet_data = cargar_usuarios_gsheet()
                 if gsheet_data.get("users"):
-                    USERS_FILE.write_text(
-                        json.dumps(gsheet_data, indent=2, ensure_ascii=False), 
-                        encoding="utf-8"
-                    )
+                    guardar_json(USERS_FILE, gsheet_data)
                     st.success("Usuarios sincronizados desde Google Sheets")
                     # Forzar rerun para recargar usuarios
                     do_rerun()
 
     show_users = st.sidebar.checkbox("Mostrar usuarios registrados", value=False, key="admin_show_users")
     if show_users:
-        data = load_users()
+        data = directorio_usuarios()["data"]
         if data.get("users"):
             st.sidebar.caption("Usuarios registrados")
             st.sidebar.caption("Siempre dar doble click para confirmar.")
@@ -3686,10 +6131,10 @@ if is_admin():
 
     # -- Gestión unificada (solo admin) -- (OPTIMIZADA)
     with st.sidebar.expander("⚙️ Gestión de Catálogos", expanded=False):
-        st.caption("Administrar sucursales, asesores, estatus y segundo estatus")
+        st.caption("Administrar sucursales, asesores, estatus, segundo estatus y pesos del modelo financiero")
         
         # Tabs para organizar mejor la gestión
-        tab_suc, tab_ases, tab_est, tab_seg = st.tabs(["🏢 Sucursales", "👥 Asesores", "📊 Estatus", "📈 2° Estatus"])
+        tab_suc, tab_ases, tab_est, tab_seg, tab_modelo = st.tabs(["🏢 Sucursales", "👥 Asesores", "📊 Estatus", "📈 2° Estatus", "🎯 Modelo"])
         
         # === TAB SUCURSALES ===
         with tab_suc:
@@ -3868,6 +6313,25 @@ if is_admin():
                                 save_segundo_estatus(SEGUNDO_ESTATUS_OPCIONES)
                                 st.toast(f"✅ 2° Estatus '{seg_est}' eliminado")
                                 st.rerun()
+        
+        # === TAB MODELO FINANCIERO ===
+        with tab_modelo:
+            st.caption("Pesos por estatus: probabilidad de conversión, factor de retorno y riesgo (%)")
+            modelo_actual = load_modelo_riesgo()
+            df_pesos = pd.DataFrame.from_dict(modelo_actual["estatus"], orient="index")[MODELO_PESOS]
+            df_pesos = df_pesos.reindex(list(dict.fromkeys(list(df_pesos.index) + ESTATUS_OPCIONES)))
+            df_pesos = df_pesos.rename_axis("estatus").reset_index()
+            ed_pesos = st.data_editor(df_pesos, key="ed_modelo_riesgo", hide_index=True, num_rows="dynamic", use_container_width=True)
+            st.caption("Sin pesos: RECH*/REC* usan los valores de rechazo y el resto los valores por defecto.")
+            if st.button("💾 Guardar pesos", key="save_modelo_riesgo"):
+                nuevo_modelo = {"estatus": {}, "rechazo": modelo_actual["rechazo"], "default": modelo_actual["default"]}
+                for _, fila in ed_pesos.iterrows():
+                    est = str(fila.get("estatus") or "").strip()
+                    if est and not any(pd.isna(fila.get(c)) for c in MODELO_PESOS):
+                        nuevo_modelo["estatus"][est] = {c: float(fila[c]) for c in MODELO_PESOS}
+                save_modelo_riesgo(nuevo_modelo)
+                st.toast("✅ Pesos del modelo guardados")
+                st.rerun()
 
 # ---------- Sidebar (filtros + acciones) ----------
 st.sidebar.title("👤 CRM")
@@ -3952,6 +6416,8 @@ def _force_refresh():
         _CLIENTES_CACHE_TIME = 0
         _HISTORIAL_CACHE = None
         _HISTORIAL_CACHE_TIME = 0
+        # Conciliar la réplica de clientes ahora (no esperar al hilo de fondo)
+        sincronizar_replica_clientes()
         # Reset filtros también
         _reset_filters()
         # Marcar que se necesita actualizar (sin llamar st.rerun() en callback)
@@ -4043,109 +6509,57 @@ st.sidebar.subheader("📊 Resumen filtrado")
 st.sidebar.metric("Clientes visibles", len(df_ver))
 st.sidebar.metric("Total en base", len(df_cli))
 
-# Añadir botón para descargar Excel del resumen filtrado (df_ver)
+# Botones de descarga del resumen filtrado (df_ver): el archivo se genera solo al hacer clic
 try:
-    bio = io.BytesIO()
-    engine = None
-    try:
-        import xlsxwriter  # type: ignore
-        engine = "xlsxwriter"
-    except Exception:
-        try:
-            import openpyxl  # type: ignore
-            engine = "openpyxl"
-        except Exception:
-            engine = None
-
-    if engine is None:
+    formatos_export = formatos_exportacion()
+    if "xlsx" not in formatos_export:
         st.sidebar.info("Instala 'openpyxl' o 'xlsxwriter' para habilitar descarga XLSX.")
-    else:
-        # Preparar DataFrame a exportar (ordenado por fechas si procede)
+    fmt_export = st.sidebar.selectbox(
+        "Formato de descarga",
+        list(formatos_export.keys()),
+        format_func=lambda f: formatos_export[f][0],
+        key="fmt_export_sidebar",
+        help="CSV o Parquet son más livianos para exportaciones grandes"
+    )
+    nombre_fmt, ext_fmt, mime_fmt = formatos_export[fmt_export]
+    if st.sidebar.download_button(
+        f"⬇️ Descargar {nombre_fmt} (filtrados)",
+        data=lambda df=df_ver, fmt=fmt_export: exportar_clientes(df, fmt),
+        file_name=f"clientes_filtrados.{ext_fmt}",
+        mime=mime_fmt,
+        key="dl_filtrados_sidebar"
+    ):
         try:
-            df_export = sort_df_by_dates(df_ver) if (isinstance(df_ver, pd.DataFrame) and not df_ver.empty) else df_ver.copy()
+            actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
+            append_historial(
+            "", "", "", "", "", "",
+            f"Descarga de {nombre_fmt} filtrados",
+            action="DESCARGA ZIP",  # o "DOCUMENTOS", según quieras categorizarlo
+            actor=actor
+            )
         except Exception:
-            df_export = df_ver.copy() if isinstance(df_ver, pd.DataFrame) else pd.DataFrame()
+                pass
 
-        with pd.ExcelWriter(bio, engine=engine) as writer:
-            try:
-                df_export.to_excel(writer, index=False, sheet_name="Filtrados")
-            except Exception:
-                # fallback: intentar convertir todo a strings y volver a escribir
-                try:
-                    df_export.astype(str).to_excel(writer, index=False, sheet_name="Filtrados")
-                except Exception:
-                    pass
-        bio.seek(0)
+    # Descarga Excel por pestañas de asesores
+    if "xlsx" in formatos_export and not df_ver.empty and "asesor" in df_ver.columns:
         if st.sidebar.download_button(
-            "⬇️ Descargar Excel (filtrados)",
-            data=bio.getvalue(),
-            file_name="clientes_filtrados.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            key="dl_filtrados_sidebar"
+            "📊 Descargar Excel (por asesores)",
+            data=lambda df=df_ver: exportar_clientes(df, "xlsx", por_asesor=True),
+            file_name="clientes_por_asesores.xlsx",
+            mime=formatos_export["xlsx"][2],
+            key="dl_asesores_sidebar",
+            help="Descarga Excel con una pestaña por cada asesor"
         ):
             try:
                 actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
                 append_historial(
                 "", "", "", "", "", "",
-                "Descarga de Excel filtrados",
-                action="DESCARGA ZIP",  # o "DOCUMENTOS", según quieras categorizarlo
+                "Descarga de Excel por asesores",
+                action="DESCARGA ZIP ASESOR",
                 actor=actor
                 )
             except Exception:
-                    pass
-        
-        # NUEVO: Descarga Excel por pestañas de asesores
-        bio_asesores = io.BytesIO()
-        try:
-            # Preparar datos por asesor
-            df_for_asesores = df_export.copy()
-            if not df_for_asesores.empty and 'asesor' in df_for_asesores.columns:
-                # Normalizar asesores vacíos
-                df_for_asesores['asesor'] = df_for_asesores['asesor'].fillna("(Sin asesor)").replace({"": "(Sin asesor)"})
-                
-                # Obtener lista de asesores únicos
-                asesores_unicos = sorted(df_for_asesores['asesor'].unique().tolist())
-                
-                if len(asesores_unicos) > 0:
-                    with pd.ExcelWriter(bio_asesores, engine=engine) as writer:
-                        # Crear una pestaña por cada asesor
-                        for asesor in asesores_unicos:
-                            try:
-                                # Filtrar datos por asesor
-                                df_asesor = df_for_asesores[df_for_asesores['asesor'] == asesor].copy()
-                                if not df_asesor.empty:
-                                    # Limpiar nombre del asesor para usar como nombre de pestaña (máximo 31 caracteres)
-                                    sheet_name = str(asesor)[:31] if asesor else "Sin_asesor"
-                                    # Reemplazar caracteres problemáticos para nombres de pestaña
-                                    sheet_name = sheet_name.replace("/", "_").replace("\\", "_").replace("*", "_").replace("?", "_").replace(":", "_").replace("[", "_").replace("]", "_")
-                                    
-                                    df_asesor.to_excel(writer, index=False, sheet_name=sheet_name)
-                            except Exception:
-                                # Si falla crear la pestaña, continúa con el siguiente asesor
-                                continue
-                    
-                    bio_asesores.seek(0)
-                    if st.sidebar.download_button(
-                        "📊 Descargar Excel (por asesores)",
-                        data=bio_asesores.getvalue(),
-                        file_name="clientes_por_asesores.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        key="dl_asesores_sidebar",
-                        help="Descarga Excel con una pestaña por cada asesor"
-                    ):
-                        try:
-                            actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
-                            append_historial(
-                            "", "", "", "", "", "",
-                            "Descarga de Excel por asesores",
-                            action="DESCARGA ZIP ASESOR",
-                            actor=actor
-                            )
-                        except Exception:
-                            pass
-        except Exception:
-            # Si algo falla en la creación del Excel por asesores, no mostrar el botón
-            pass
+                pass
 except Exception:
     # no bloquear la UI si algo falla
     pass
@@ -4171,33 +6585,50 @@ with tab_dash:
         with col_titulo:
             st.subheader("📊 KPIs Principales")
         with col_pptx:
-            # Generar PowerPoint del dashboard
-            pptx_data = generar_presentacion_dashboard(df_cli)
-            st.download_button(
-                label="📊 Descargar",
-                data=pptx_data,
-                file_name=f"dashboard_kapitaliza_{datetime.now().strftime('%Y%m%d_%H%M')}.pptx",
-                mime="application/vnd.openxmlformats-officedocument.presentationml.presentation",
-                help="Descargar presentación completa con gráficas"
-            )
+            # PowerPoint del dashboard: se sirve la versión pre-generada; si aún no existe se genera al descargar
+            modelo_pptx = load_modelo_riesgo()
+            with st.popover("📊 Descargar"):
+                variantes_pptx = variantes_reporte(df_cli)
+                alcance = st.selectbox(
+                    "Alcance",
+                    list(variantes_pptx.keys()),
+                    format_func=lambda v: "Global" if v[0] == "global" else f"{v[0].capitalize()}: {v[1]}",
+                    key="pptx_alcance"
+                )
+                # Solo se pre-generan los alcances que alguien elige, no todas las sucursales y asesores
+                solicitar_reporte(alcance)
+                clave_global = clave_reporte(df_cli, modelo_pptx)
+                programar_reportes(df_cli, modelo_pptx, clave=clave_global)
+                df_pptx = variantes_pptx[alcance]
+                pptx_archivo = reporte_cacheado(df_pptx, modelo_pptx, clave=clave_global if alcance[0] == "global" else None)
+                sufijo = "" if alcance[0] == "global" else "_" + safe_name(alcance[1])
+                # El archivo se lee (o la presentación se genera) solo al hacer clic
+                st.download_button(
+                    label="📊 Descargar presentación",
+                    data=lambda a=pptx_archivo, d=df_pptx: a.read_bytes() if a is not None and a.exists() else generar_presentacion_dashboard(d, modelo_pptx),
+                    file_name=f"dashboard_kapitaliza{sufijo}_{datetime.now().strftime('%Y%m%d_%H%M')}.pptx",
+                    mime="application/vnd.openxmlformats-officedocument.presentationml.presentation",
+                    help="Descargar presentación completa con gráficas",
+                    key="pptx_descargar"
+                )
+                if pptx_archivo is None:
+                    st.caption("⏳ Se genera al descargar (la versión pre-generada se está preparando).")
         
-        # Preparar datos para KPIs
-        total_clientes = len(df_cli)
-        estatus_counts = df_cli["estatus"].fillna("").value_counts()
+        # Preparar datos para KPIs: todo sale del cubo materializado (una rebanada por gráfica)
+        cubo = cubo_kpi(df_cli)
+        total_clientes = int(cubo["clientes"].sum())
+        por_estatus = cubo.groupby("estatus")[CUBO_MEDIDAS].sum()
 
         # Calcular KPIs principales con lógica corregida
-        dispersados = estatus_counts.get("DISPERSADO", 0)
+        dispersados = int(por_estatus["clientes"].get("DISPERSADO", 0))
 
         # Clasificar automáticamente todos los estatus que empiecen con "RECH" como rechazados
-        rechazados = sum([
-            count for estatus, count in estatus_counts.items()
-            if estatus and (estatus.startswith("RECH") or estatus.startswith("REC"))
-        ])
+        es_rechazo = por_estatus.index.str.startswith(("RECH", "REC"))
+        rechazados = int(por_estatus.loc[es_rechazo, "clientes"].sum())
 
         # === NUEVO: calcular propuestas (clientes con monto de propuesta) ===
-        analisis_tmp = calcular_analisis_financiero(df_cli)
-        total_propuestas = int(analisis_tmp.get('clientes_con_monto', 0))
-        dispersados_con_monto = int(analisis_tmp.get('dispersados_con_monto', 0))
+        total_propuestas = int(por_estatus["con_propuesta"].sum())
+        dispersados_con_monto = int(por_estatus["con_final"].get("DISPERSADO", 0))
 
         # Propuestas que aún no se han dispersado
         propuestas_no_dispersadas = max(0, total_propuestas - dispersados_con_monto)
@@ -4244,31 +6675,23 @@ with tab_dash:
         # 💹 Top Estatus por Monto
         st.markdown("##### 💹 Top Estatus por Monto")
         
-        # Calcular métricas financieras para el ranking
-        analisis_financiero = calcular_analisis_financiero(df_cli)
-        
         # Mostrar total de presupuesto general
-        total_presupuesto = analisis_financiero['total_propuesto']
+        total_presupuesto = por_estatus["monto_propuesta"].sum()
         st.markdown(f"**Total Presupuesto General: {formatear_monto(total_presupuesto)}**")
         
-        if not analisis_financiero['montos_por_estatus'].empty:
-            # Filtrar solo estatus con monto > 0
-            estatus_con_monto = analisis_financiero['montos_por_estatus'][
-                analisis_financiero['montos_por_estatus'][('monto_propuesta_num', 'sum')] > 0
-            ]
-            
+        # Filtrar solo estatus con monto > 0
+        estatus_con_monto = por_estatus[por_estatus["monto_propuesta"] > 0]
+        if not estatus_con_monto.empty:
             # Obtener top estatus por monto propuesto
-            top_estatus = estatus_con_monto.sort_values(
-                ('monto_propuesta_num', 'sum'), ascending=False
-            ).head(5)
+            top_estatus = estatus_con_monto.sort_values("monto_propuesta", ascending=False).head(5)
             
             col1, col2 = st.columns(2)
             
             # Dividir en dos columnas para mostrar mejor con texto más pequeño
             for i, (estatus, data) in enumerate(top_estatus.iterrows()):
-                monto_total = data[('monto_propuesta_num', 'sum')]
-                cantidad = data[('monto_propuesta_num', 'count')]
-                promedio = data[('monto_propuesta_num', 'mean')]
+                monto_total = data["monto_propuesta"]
+                cantidad = data["clientes"]
+                promedio = monto_total / cantidad if cantidad else 0
                 
                 with col1 if i % 2 == 0 else col2:
                     # Usar markdown para texto más pequeño
@@ -4304,36 +6727,26 @@ with tab_dash:
         st.markdown("---")
         
         # �🔄 TABS SECUNDARIAS PARA ANÁLISIS DETALLADO
-        dash_tab1, dash_tab2, dash_tab3 = st.tabs([
+        dash_tab1, dash_tab2, dash_tab3, dash_tab4 = st.tabs([
             "📊 Por Estatus", 
             "📅 Por Fecha", 
-            "🏢 Por Sucursal/Asesor"
+            "🏢 Por Sucursal/Asesor",
+            "🔀 Embudo"
         ])
         
         # 📊 TAB 1: POR ESTATUS
         with dash_tab1:
             st.subheader("Análisis por Estatus")
             
-            # Solo mostrar estatus con valores > 0 (más limpio)
-            # Primero limpiar y normalizar estatus vacíos o nulos
-            df_temp = df_cli.copy()
-            df_temp["estatus_clean"] = df_temp["estatus"].fillna("(Sin estatus)").replace("", "(Sin estatus)")
-            df_temp["estatus_clean"] = df_temp["estatus_clean"].apply(lambda x: x.strip() if str(x).strip() else "(Sin estatus)")
+            # Solo mostrar estatus con valores > 0 (el cubo ya normaliza vacíos como "(Sin estatus)")
+            estatus_df = cubo_conteo(cubo, "estatus")
             
-            estatus_data = df_temp["estatus_clean"].value_counts()
-            estatus_data = estatus_data[estatus_data > 0]  # Filtrar solo valores > 0
-            
-            if estatus_data.empty:
+            if estatus_df.empty:
                 st.info("No hay datos de estatus para mostrar.")
             else:
-                # Convertir a DataFrame y agregar porcentajes
-                estatus_df = estatus_data.reset_index()
-                estatus_df.columns = ["estatus", "cantidad"]
+                # Agregar porcentajes (ya viene ordenado por cantidad descendente)
                 estatus_df["porcentaje"] = (estatus_df["cantidad"] / total_clientes * 100).round(1)
                 
-                # Ordenar por cantidad (descendente)
-                estatus_df = estatus_df.sort_values("cantidad", ascending=False)
-                
                 col1, col2 = st.columns([1, 2])
                 
                 with col1:
@@ -4409,23 +6822,12 @@ with tab_dash:
                     index=0
                 )
             
-            # Determinar fechas según selección
-            date_col = None
-            for c in ("fecha_ingreso", "fecha_dispersion"):
-                if c in df_cli.columns:
-                    date_col = c
-                    break
-            
-            if date_col is None:
+            # Fechas de ingreso ya parseadas en las filas del cubo (con su mes precalculado)
+            date_col = "fecha"
+            if "fecha_ingreso" not in df_cli.columns:
                 st.warning("No se encontraron columnas de fecha válidas.")
             else:
-                df_temp = df_cli.copy()
-                # Aplicar el manejo flexible de fechas
-                try:
-                    df_temp[date_col] = parse_dates_flexible(df_temp[date_col])
-                except Exception:
-                    df_temp[date_col] = pd.to_datetime(df_temp[date_col], errors="coerce")
-                df_temp = df_temp.dropna(subset=[date_col])
+                df_temp = filas_kpi(df_cli).dropna(subset=[date_col])
                 
                 if df_temp.empty:
                     st.warning("No hay datos con fechas válidas.")
@@ -4459,7 +6861,7 @@ with tab_dash:
                     
                     # Filtrar datos por período
                     mask = (df_temp[date_col].dt.date >= fecha_inicio) & (df_temp[date_col].dt.date <= fecha_fin)
-                    df_periodo = df_temp[mask].copy()
+                    df_periodo = df_temp[mask]
                     
                     if df_periodo.empty:
                         st.info("No hay datos en el período seleccionado.")
@@ -4485,10 +6887,8 @@ with tab_dash:
                         # Gráfico de evolución temporal (por mes)
                         st.markdown("**Evolución mensual:**")
                         
-                        df_mensual = df_periodo.copy()
-                        df_mensual["año_mes"] = df_mensual[date_col].dt.to_period("M")
-                        evolucion = df_mensual.groupby("año_mes").size().reset_index(name="cantidad")
-                        evolucion["fecha"] = evolucion["año_mes"].astype(str)
+                        evolucion = df_periodo.groupby("mes", sort=True).size().reset_index(name="cantidad")
+                        evolucion["fecha"] = evolucion["mes"]
                         
                         if len(evolucion) > 0:
                             line_chart = alt.Chart(evolucion).mark_line(
@@ -4508,7 +6908,7 @@ with tab_dash:
                         # Gráfico de dona: Distribución por estatus en el período
                         st.markdown("**Distribución por estatus en el período:**")
                         
-                        estatus_periodo = df_periodo["estatus"].fillna("(Sin estatus)").value_counts()
+                        estatus_periodo = df_periodo["estatus"].value_counts()
                         estatus_periodo_df = estatus_periodo.reset_index()
                         estatus_periodo_df.columns = ["estatus", "cantidad"]
                         # Agregar porcentaje como columna calculada
@@ -4541,14 +6941,11 @@ with tab_dash:
             
             # SUB-TAB: SUCURSALES
             with sub_tab1:
-                sucursal_counts = df_cli["sucursal"].fillna("(Sin sucursal)").value_counts()
-                sucursal_counts = sucursal_counts[sucursal_counts > 0]
+                sucursal_df = cubo_conteo(cubo, "sucursal")
                 
-                if sucursal_counts.empty:
+                if sucursal_df.empty:
                     st.info("No hay datos de sucursales para mostrar.")
                 else:
-                    sucursal_df = sucursal_counts.reset_index()
-                    sucursal_df.columns = ["sucursal", "cantidad"]
                     sucursal_df["porcentaje"] = (sucursal_df["cantidad"] / total_clientes * 100).round(1)
                     
                     col1, col2 = st.columns([1, 2])
@@ -4587,45 +6984,26 @@ with tab_dash:
                 # Para la sección de asesores del dashboard, usar datos filtrados EXCEPTO por asesor
                 # para mostrar todos los asesores (misma lógica que en tab_asesores)
                 try:
-                    # Aplicar filtros SIN incluir el filtro de asesor
-                    sucursal_for_filter = df_cli["sucursal"].fillna("").replace({"": "(Sin sucursal)"})
-                    fuente_for_filter = df_cli["fuente"].fillna("").replace({"": "(Sin fuente)"})
-                    
-                    # Aplicar solo filtros de sucursal, estatus y fuente (NO asesor)
-                    if not f_suc or len(f_suc) == 0 or set(f_suc) == set(SUC_ALL):
-                        suc_mask_dash = pd.Series(True, index=df_cli.index)
-                    else:
-                        suc_mask_dash = sucursal_for_filter.isin(f_suc)
-
-                    if not f_est or len(f_est) == 0 or set(f_est) == set(EST_ALL):
-                        est_mask_dash = pd.Series(True, index=df_cli.index)
-                    else:
-                        est_mask_dash = df_cli["estatus"].isin(f_est)
-
-                    if not f_fuente or len(f_fuente) == 0 or set(f_fuente) == set(FUENTE_ALL):
-                        fuente_mask_dash = pd.Series(True, index=df_cli.index)
-                    else:
-                        fuente_mask_dash = fuente_for_filter.isin(f_fuente)
-                    
-                    # Datos filtrados para asesores (sin filtro de asesor)
-                    df_asesor_dash = df_cli[suc_mask_dash & est_mask_dash & fuente_mask_dash]
+                    # Aplicar solo filtros de sucursal, estatus y fuente (NO asesor) sobre el cubo
+                    cubo_ases = cubo
+                    if f_suc and set(f_suc) != set(SUC_ALL):
+                        cubo_ases = cubo_ases[cubo_ases["sucursal"].isin(f_suc)]
+                    if f_est and set(f_est) != set(EST_ALL):
+                        cubo_ases = cubo_ases[cubo_ases["estatus"].isin(f_est)]
+                    if f_fuente and set(f_fuente) != set(FUENTE_ALL):
+                        cubo_ases = cubo_ases[cubo_ases["fuente"].isin(f_fuente)]
                 except Exception:
                     # Fallback: usar todos los datos
-                    df_asesor_dash = df_cli
+                    cubo_ases = cubo
                 
-                asesor_counts = df_asesor_dash["asesor"].fillna("(Sin asesor)").value_counts()
-                asesor_counts = asesor_counts[asesor_counts > 0]
+                asesor_df = cubo_conteo(cubo_ases, "asesor")
                 
-                if asesor_counts.empty:
+                if asesor_df.empty:
                     st.info("No hay datos de asesores para mostrar.")
                 else:
                     # Mostrar TODOS los asesores (sin límite de Top 10)
-                    asesor_final = asesor_counts
-                    
-                    asesor_df = asesor_final.reset_index()
-                    asesor_df.columns = ["asesor", "cantidad"]
                     # Usar el total de clientes filtrados para calcular porcentajes
-                    total_filtrados = len(df_asesor_dash)
+                    total_filtrados = int(cubo_ases["clientes"].sum())
                     asesor_df["porcentaje"] = (asesor_df["cantidad"] / total_filtrados * 100).round(1) if total_filtrados > 0 else 0
                     
                     col1, col2 = st.columns([1, 2])
@@ -4663,14 +7041,11 @@ with tab_dash:
             
             # SUB-TAB: FUENTES
             with sub_tab3:
-                fuente_counts = df_cli["fuente"].fillna("(Sin fuente)").value_counts()
-                fuente_counts = fuente_counts[fuente_counts > 0]
+                fuente_df = cubo_conteo(cubo, "fuente")
                 
-                if fuente_counts.empty:
+                if fuente_df.empty:
                     st.info("No hay datos de fuentes para mostrar.")
                 else:
-                    fuente_df = fuente_counts.reset_index()
-                    fuente_df.columns = ["fuente", "cantidad"]
                     fuente_df["porcentaje"] = (fuente_df["cantidad"] / total_clientes * 100).round(1)
                     
                     col1, col2 = st.columns([1, 2])
@@ -4705,100 +7080,75 @@ with tab_dash:
                         
                         st.altair_chart(chart_fuente, use_container_width=True)
 
+        # 🔀 TAB 4: EMBUDO Y COHORTES (a partir de las transiciones del historial)
+        with dash_tab4:
+            st.subheader("Embudo de Conversión y Cohortes")
+            if st.toggle("Calcular embudo desde el historial", key="embudo_on", help="Reconstruye la línea de tiempo de cada cliente con los cambios de estatus registrados"):
+                embudo = analisis_embudo()
+                etapas = embudo["etapas"]
+                if etapas.empty:
+                    st.info("El historial aún no tiene cambios de estatus registrados.")
+                else:
+                    col1, col2 = st.columns([1, 1])
+                    with col1:
+                        st.markdown("**Conversión por etapa (llegan después a DISPERSADO):**")
+                        st.dataframe(
+                            etapas.rename(columns={
+                                "estatus": "Estatus", "clientes": "Clientes", "convertidos": "Dispersados",
+                                "conversion_pct": "Conversión (%)", "mediana_dias": "Mediana días en etapa"
+                            }).round({"Mediana días en etapa": 1}),
+                            use_container_width=True,
+                            hide_index=True
+                        )
+                    with col2:
+                        chart_embudo = alt.Chart(etapas).mark_bar().encode(
+                            x=alt.X("conversion_pct:Q", axis=alt.Axis(title="Conversión (%)")),
+                            y=alt.Y("estatus:N", sort="-x", axis=alt.Axis(title="Estatus")),
+                            tooltip=[
+                                alt.Tooltip("estatus:N", title="Estatus"),
+                                alt.Tooltip("clientes:Q", title="Clientes"),
+                                alt.Tooltip("conversion_pct:Q", title="Conversión (%)", format=".1f"),
+                                alt.Tooltip("mediana_dias:Q", title="Mediana días", format=".1f")
+                            ]
+                        ).properties(height=max(250, len(etapas) * 28), title="Conversión por Etapa")
+                        st.altair_chart(chart_embudo, use_container_width=True)
+
+                    cohortes = embudo["cohortes"]
+                    if not cohortes.empty:
+                        st.markdown("**Curvas por cohorte mensual (% dispersado al cierre de cada mes):**")
+                        chart_cohorte = alt.Chart(cohortes).mark_line(point=True).encode(
+                            x=alt.X("mes:Q", axis=alt.Axis(title="Meses desde el primer cambio", tickMinStep=1)),
+                            y=alt.Y("pct_dispersado:Q", axis=alt.Axis(title="% Dispersado")),
+                            color=alt.Color("cohorte:N", title="Cohorte"),
+                            tooltip=[
+                                alt.Tooltip("cohorte:N", title="Cohorte"),
+                                alt.Tooltip("mes:Q", title="Mes"),
+                                alt.Tooltip("clientes:Q", title="Clientes"),
+                                alt.Tooltip("pct_dispersado:Q", title="% Dispersado", format=".1f")
+                            ]
+                        ).properties(height=300)
+                        st.altair_chart(chart_cohorte, use_container_width=True)
+            else:
+                st.caption("Activa el interruptor para calcular el embudo (usa el historial completo).")
+
         # 💰 ANÁLISIS FINANCIERO AVANZADO - CARTERA KAPITALIZA
         st.markdown("---")
         st.subheader(" Análisis Financiero — Cartera Kapitaliza")
         
-        # Preparar datos con limpieza
-        df_temp = df_cli.copy()
-        
-        def limpiar_monto_simple(monto_str):
-            if pd.isna(monto_str) or str(monto_str).strip() == "":
-                return 0.0
-            try:
-                import re
-                clean = re.sub(r'[,$\s]', '', str(monto_str))
-                return float(clean)
-            except:
-                return 0.0
-        
-        # Usar monto_final para dispersados, monto_propuesta para el resto
-        df_temp['monto_analisis'] = df_temp.apply(
-            lambda row: limpiar_monto_simple(row['monto_final']) if row['estatus'] == 'DISPERSADO' 
-            else limpiar_monto_simple(row['monto_propuesta']), axis=1
-        )
-        
-        # Filtrar solo clientes con monto > 0
-        df_analisis = df_temp[df_temp['monto_analisis'] > 0].copy()
+        # Modelo financiero vectorizado sobre el cubo; pesos configurables en data/modelo_riesgo.json
+        modelo_riesgo = load_modelo_riesgo()
+        resultado_modelo = modelo_financiero(df_cli, modelo_riesgo)
+        tabla_modelo = resultado_modelo["tabla"]
         
-        if df_analisis.empty:
+        if tabla_modelo.empty:
             st.info("No hay datos con montos registrados para análisis.")
         else:
-            # === MODELO FINANCIERO REFINADO ===
-            # Tres componentes: Probabilidad de Conversión, Factor de Retorno, Riesgo
-            prob_conversion = {
-                "DISPERSADO": 1.00,
-                "APROB. CON PROPUESTA": 0.75,
-                "PROPUESTA": 0.75,  # Alias para propuesta
-                "PEND. ACEPT. CLIENTE": 0.65,
-                "PENDIENTE CLIENTE": 0.65,  # Alias
-                "PEND. DOC. PARA EVALUACION": 0.45,
-                "PENDIENTE DOC": 0.45,  # Alias
-                "EN ONBOARDING": 0.55,
-                "RECH. CLIENTE CANCELA": 0.10,
-                "RECH. SOBREENDEUDAMIENTO": 0.05,
-            }
-            
-            factor_retorno = {
-                "DISPERSADO": 1.00,
-                "APROB. CON PROPUESTA": 0.85,
-                "PROPUESTA": 0.85,
-                "PEND. ACEPT. CLIENTE": 0.80,
-                "PENDIENTE CLIENTE": 0.80,
-                "PEND. DOC. PARA EVALUACION": 0.70,
-                "PENDIENTE DOC": 0.70,
-                "EN ONBOARDING": 0.75,
-                "RECH. CLIENTE CANCELA": 0.00,
-                "RECH. SOBREENDEUDAMIENTO": 0.00,
-            }
-            
-            riesgo_pct = {
-                "DISPERSADO": 5,
-                "APROB. CON PROPUESTA": 20,
-                "PROPUESTA": 20,
-                "PEND. ACEPT. CLIENTE": 30,
-                "PENDIENTE CLIENTE": 30,
-                "PEND. DOC. PARA EVALUACION": 45,
-                "PENDIENTE DOC": 45,
-                "EN ONBOARDING": 40,
-                "RECH. CLIENTE CANCELA": 90,
-                "RECH. SOBREENDEUDAMIENTO": 95,
-            }
-            
-            # Para otros estatus de rechazo, aplicar valores altos
-            for estatus in df_analisis['estatus'].unique():
-                if estatus and (estatus.startswith("RECH") or estatus.startswith("REC")):
-                    if estatus not in prob_conversion:
-                        prob_conversion[estatus] = 0.05
-                        factor_retorno[estatus] = 0.00
-                        riesgo_pct[estatus] = 95
-            
-            # Aplicar modelo refinado
-            df_analisis["Probabilidad de Conversión"] = df_analisis["estatus"].map(prob_conversion).fillna(0.5)
-            df_analisis["Factor Retorno"] = df_analisis["estatus"].map(factor_retorno).fillna(0.5)
-            df_analisis["Riesgo (%)"] = df_analisis["estatus"].map(riesgo_pct).fillna(50)
-            
-            # Cálculos financieros
-            df_analisis["Monto Esperado"] = df_analisis["monto_analisis"] * df_analisis["Probabilidad de Conversión"]
-            df_analisis["Retorno Esperado"] = df_analisis["monto_analisis"] * df_analisis["Factor Retorno"]
-            df_analisis["Riesgo Estimado (%)"] = df_analisis["Riesgo (%)"]  # Para compatibilidad
-            
             # === MÉTRICAS GLOBALES REFINADAS ===
-            total_cartera = df_analisis["monto_analisis"].sum()
-            total_monto_esperado = df_analisis["Monto Esperado"].sum()
-            total_retorno = df_analisis["Retorno Esperado"].sum()
-            prom_riesgo = df_analisis["Riesgo (%)"].mean()
-            prom_conversion = df_analisis["Probabilidad de Conversión"].mean() * 100
+            total_cartera = resultado_modelo["total_cartera"]
+            total_monto_esperado = resultado_modelo["total_monto_esperado"]
+            total_retorno = resultado_modelo["total_retorno"]
+            prom_riesgo = resultado_modelo["prom_riesgo"]
+            prom_conversion = resultado_modelo["prom_conversion"]
             
             # === DIAGNÓSTICO EJECUTIVO AUTOMATIZADO ===
             st.markdown("##### 🧠 Diagnóstico Financiero")
@@ -4811,6 +7161,8 @@ with tab_dash:
             - Retorno esperado: **{formatear_monto(total_retorno)}**
             - Riesgo promedio: **{prom_riesgo:.1f}%**
             - Conversión media: **{prom_conversion:.1f}%**
+            - Exposición ponderada por riesgo: **{formatear_monto(resultado_modelo["exposicion_riesgo"])}**
+            - Valor del pipeline (en proceso): **{formatear_monto(resultado_modelo["valor_pipeline"])}**
             """)
             
             st.markdown("---")
@@ -4825,23 +7177,15 @@ with tab_dash:
             
             # Análisis específico de oportunidades (incluir todos los pendientes)
             # Definir estatus que se consideran "pendientes" o en proceso
-            estatus_pendientes = df_analisis[~df_analisis['estatus'].str.contains('DISPERSADO|RECHAZADO', na=False, case=False)]
+            estatus_pendientes = tabla_modelo[~tabla_modelo['estatus'].str.contains('DISPERSADO|RECHAZADO', na=False, case=False)]
             
             if not estatus_pendientes.empty:
-                total_pendientes = len(estatus_pendientes)
-                monto_pendientes = estatus_pendientes['monto_analisis'].sum()
-                pct_pendientes = (total_pendientes / len(df_analisis) * 100)
-                
-                # Obtener breakdown por estatus pendiente
-                breakdown_pendientes = estatus_pendientes.groupby('estatus').agg({
-                    'nombre': 'count',
-                    'monto_analisis': 'sum'
-                }).rename(columns={'nombre': 'cantidad'})
+                total_pendientes = int(estatus_pendientes['clientes'].sum())
+                monto_pendientes = estatus_pendientes['monto'].sum()
+                pct_pendientes = (total_pendientes / tabla_modelo['clientes'].sum() * 100)
                 
                 # Crear texto detallado con los estatus pendientes
-                detalle_estatus = []
-                for estatus, row in breakdown_pendientes.iterrows():
-                    detalle_estatus.append(f"{row['cantidad']} {estatus}")
+                detalle_estatus = [f"{int(row['clientes'])} {row['estatus']}" for _, row in estatus_pendientes.sort_values('estatus').iterrows()]
                 
                 detalle_texto = ", ".join(detalle_estatus[:3])  # Mostrar los primeros 3
                 if len(detalle_estatus) > 3:
@@ -4854,18 +7198,12 @@ with tab_dash:
             
             with col_tabla:
                 st.markdown("##### 🔍 Distribución por Estatus")
-                resumen = df_analisis.groupby("estatus").agg({
-                    "monto_analisis": "sum",
-                    "Retorno Esperado": "sum",
-                    "Riesgo Estimado (%)": "mean",
-                    "nombre": "count"  # Contar clientes
-                }).rename(columns={"nombre": "Clientes"}).reset_index()
+                resumen_display = tabla_modelo.sort_values("estatus").rename(columns={"clientes": "Clientes"})
                 
                 # Formatear para mostrar
-                resumen_display = resumen.copy()
-                resumen_display["Monto Total"] = resumen_display["monto_analisis"].apply(lambda x: f"${x:,.0f}")
-                resumen_display["Retorno Esperado"] = resumen_display["Retorno Esperado"].apply(lambda x: f"${x:,.0f}")
-                resumen_display["Riesgo (%)"] = resumen_display["Riesgo Estimado (%)"].apply(lambda x: f"{x:.1f}%")
+                resumen_display["Monto Total"] = resumen_display["monto"].map(lambda x: f"${x:,.0f}")
+                resumen_display["Retorno Esperado"] = resumen_display["retorno_esperado"].map(lambda x: f"${x:,.0f}")
+                resumen_display["Riesgo (%)"] = resumen_display["riesgo_pct"].map(lambda x: f"{x:.1f}%")
                 
                 st.dataframe(
                     resumen_display[["estatus", "Clientes", "Monto Total", "Retorno Esperado", "Riesgo (%)"]],
@@ -4874,7 +7212,25 @@ with tab_dash:
                 )
             
             with col_grafico:
-                pass  # Columna vacía
+                # Sensibilidad: variar un peso de un estatus y ver el efecto en los totales
+                st.markdown("##### 🎚️ Sensibilidad del modelo")
+                sens_est = st.selectbox("Estatus", tabla_modelo["estatus"].tolist(), key="sens_estatus")
+                sens_campo = st.selectbox(
+                    "Peso a variar",
+                    MODELO_PESOS,
+                    format_func=lambda c: {"prob_conversion": "Probabilidad de conversión", "factor_retorno": "Factor de retorno", "riesgo_pct": "Riesgo (%)"}[c],
+                    key="sens_campo"
+                )
+                tope = 100.0 if sens_campo == "riesgo_pct" else 1.0
+                valores = [tope * i / 20 for i in range(21)]
+                sens = sensibilidad_modelo(resultado_modelo, sens_est, sens_campo, valores)
+                medida = "exposicion_riesgo" if sens_campo == "riesgo_pct" else ("total_retorno" if sens_campo == "factor_retorno" else "total_monto_esperado")
+                chart_sens = alt.Chart(sens).mark_line(point=True).encode(
+                    x=alt.X(f"{sens_campo}:Q", axis=alt.Axis(title="Peso")),
+                    y=alt.Y(f"{medida}:Q", axis=alt.Axis(title="Total ($)")),
+                    tooltip=[alt.Tooltip(f"{sens_campo}:Q", format=".2f"), alt.Tooltip(f"{medida}:Q", format=",.0f")]
+                ).properties(height=250)
+                st.altair_chart(chart_sens, use_container_width=True)
             
             st.markdown("---")
             st.caption("© CRM Kapitaliza ")
@@ -4885,6 +7241,7 @@ with tab_cli:
     df_cli = cargar_y_corregir_clientes()
     
     st.subheader("➕ Agregar cliente")
+    leido_alta = lectura_mostrada("_leido_alta_cliente")
     with st.expander("Formulario de alta", expanded=False):  # UI más limpia
 
         # --- NEW: eliminar el selectbox "Asesor" (se pide quitar el "botoncito").
@@ -4993,7 +7350,7 @@ with tab_cli:
                             "fuente": fuente_n.strip(),
                         }
                         base = pd.concat([df_cli, pd.DataFrame([nuevo])], ignore_index=True)
-                        guardar_clientes(base)
+                        guardar_clientes(base, leido=leido_alta)
                         # registrar creación en historial
                         actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
                         append_historial(cid, nuevo.get("nombre", ""), "", nuevo.get("estatus", ""), "", nuevo.get("segundo_estatus", ""), f"Creado por {actor}", action="CLIENTE AGREGADO", actor=actor)
@@ -5020,7 +7377,8 @@ with tab_cli:
                         do_rerun()  # NEW: refresca todo
 
     st.subheader("📋 Lista de clientes")
-    
+    panel_conflictos_clientes()
+
     # Usar los datos ya filtrados del sidebar (df_ver)
     # que incluye todos los filtros aplicados correctamente
     df_clientes_mostrar = df_ver.copy()
@@ -5060,6 +7418,10 @@ with tab_cli:
                     df_clientes_mostrar[_dcol] = df_temp_col.dt.date.astype(str).replace("NaT", "")
                 except Exception:
                     df_clientes_mostrar[_dcol] = df_clientes_mostrar[_dcol].astype(str).fillna("")
+        # Lectura contra la que se guardará: la de cuando empezó la edición (control optimista)
+        _ed_previo = st.session_state.get("editor_clientes") or {}
+        if "_leido_editor_clientes" not in st.session_state or not any(_ed_previo.get(k) for k in ("edited_rows", "added_rows", "deleted_rows")):
+            st.session_state["_leido_editor_clientes"] = _CLIENTES_LEIDO
         ed = st.data_editor(
             df_clientes_mostrar,
             use_container_width=True,
@@ -5092,62 +7454,44 @@ with tab_cli:
                 nuevo_seg = st.selectbox("Segundo estatus", SEGUNDO_ESTATUS_OPCIONES, index=SEGUNDO_ESTATUS_OPCIONES.index(seg_actual) if seg_actual in SEGUNDO_ESTATUS_OPCIONES else 0)
             with col_q4:
                 obs_q = st.text_input("Observaciones (opcional)")
+                leido_quick = lectura_mostrada("_leido_estatus_rapido")
                 if st.button("Actualizar estatus"):
-                    base = df_cli.set_index("id")
-                    base.at[cid_quick, "estatus"] = nuevo_estatus
-                    base.at[cid_quick, "segundo_estatus"] = nuevo_seg
-                    df_cli = base.reset_index()
-                    guardar_clientes(df_cli)
-                    # registrar en historial quién hizo el cambio (modificar)
-                    actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
-                    append_historial(cid_quick, nombre_q, estatus_actual, nuevo_estatus, seg_actual, nuevo_seg, obs_q, action="ESTATUS MODIFICADO", actor=actor)
-                    st.success(f"Estatus actualizado para {cid_quick} ✅")
-                    do_rerun()
+                    # Compare-and-set por celda contra lo que se mostró: no pisa un cambio de otro usuario
+                    cambios = pd.DataFrame([(cid_quick, "estatus", estatus_actual, nuevo_estatus),
+                                            (cid_quick, "segundo_estatus", seg_actual, nuevo_seg)], columns=CAMBIOS_COLS)
+                    aplicados = guardar_cambios_clientes(cambios, leido=leido_quick)
+                    previos = dict(zip(aplicados["columna"], aplicados["anterior"]))
+                    # Si chocó con otro usuario no se registra nada: queda en «Conflictos de edición»
+                    if not (aplicados.empty and (cambios["anterior"] != cambios["nuevo"]).any()):
+                        # registrar en historial quién hizo el cambio (modificar)
+                        actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
+                        append_historial(
+                            cid_quick, nombre_q,
+                            previos.get("estatus", estatus_actual), nuevo_estatus if "estatus" in previos else estatus_actual,
+                            previos.get("segundo_estatus", seg_actual), nuevo_seg if "segundo_estatus" in previos else seg_actual,
+                            obs_q, action="ESTATUS MODIFICADO", actor=actor,
+                        )
+                        st.success(f"Estatus actualizado para {cid_quick} ✅")
+                        do_rerun()
 
         col_save, col_del = st.columns([1,1])
         with col_save:
             if st.button("💾 Guardar cambios"):
-                # conservar copia original para detectar cambios y registrar historial
-                original_df = df_cli.copy()
-                base = df_cli.set_index("id")
-                for _, row in ed.iterrows():
-                    cid = row["id"]
-                    for k in COLUMNS:
-                        if k == "id":
-                            continue
-                        base.at[cid, k] = str(row.get(k, ""))
-                # NORMALIZAR/UNIFICAR asesores en el dataframe antes de guardar
-                for idx in base.index:
-                    base.at[idx, "asesor"] = find_matching_asesor(base.at[idx, "asesor"], base.reset_index())
-                df_cli = base.reset_index()
-                # registrar en historial los cambios por fila (si hay diferencias relevantes)
+                # Conjunto de cambios (id, columna, anterior, nuevo): una sola comparación del editor
+                # contra lo que mostró; las filas no tocadas no se recorren
+                cambios = diff_clientes(df_clientes_mostrar, ed, original=df_cli)
+                # NORMALIZAR/UNIFICAR asesores editados contra los ya registrados
+                sel_ases = (cambios["columna"] == "asesor").to_numpy()
+                if sel_ases.any():
+                    cambios.loc[sel_ases, "nuevo"] = [find_matching_asesor(v, df_cli) for v in cambios.loc[sel_ases, "nuevo"]]
+                    cambios = cambios[cambios["anterior"] != cambios["nuevo"]].reset_index(drop=True)
+                aplicados = guardar_cambios_clientes(cambios, leido=st.session_state.pop("_leido_editor_clientes", None))
+                # registrar en historial un evento por cliente modificado (solo celdas aplicadas, sin choques)
                 try:
                     actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
-                    for idx in df_cli.index:
-                        cid = df_cli.at[idx, "id"]
-                        old_row = original_df[original_df["id"] == cid]
-                        if not old_row.empty:
-                            old_row = old_row.iloc[0]
-                            # comparar estatus y segundo estatus y también detectar cambios en otras columnas
-                            diffs = []
-                            for c in COLUMNS:
-                                if c == "id":
-                                    continue
-                                oldv = str(old_row.get(c, ""))
-                                newv = str(df_cli.at[idx, c])
-                                if oldv != newv:
-                                    diffs.append(c)
-                            if diffs:
-                                est_old = old_row.get("estatus", "")
-                                est_new = df_cli.at[idx, "estatus"] if "estatus" in df_cli.columns else ""
-                                seg_old = old_row.get("segundo_estatus", "")
-                                seg_new = df_cli.at[idx, "segundo_estatus"] if "segundo_estatus" in df_cli.columns else ""
-                                obs = "Campos cambiados: " + ",".join(diffs)
-                                append_historial(cid, df_cli.at[idx, "nombre"], est_old, est_new, seg_old, seg_new, obs, action="ESTATUS MODIFICADO", actor=actor)
+                    append_historial_many(historial_desde_cambios(aplicados, df_cli, actor=actor))
                 except Exception:
                     pass
-
-                guardar_clientes(df_cli)
                 st.success("Cambios guardados ✅")
                 # Forzar reconstrucción de filtros de asesores en el sidebar
                 try:
@@ -5201,6 +7545,15 @@ with tab_docs:
     if df_cli.empty:
         st.info("No hay clientes aún.")
     else:
+        if is_admin():
+            if st.button("🔄 Reindexar documentos", key="reindex_docs", help="Reconstruye el índice si se copiaron o borraron archivos fuera del CRM"):
+                n_docs = reindexar_docs(df_cli)
+                n_dup, liberados = deduplicar_docs()
+                st.success(f"Índice actualizado: {n_docs} documentos · {n_dup} duplicados convertidos en referencias ({liberados/1024/1024:.1f} MB liberados).")
+            if st.session_state.get("drive_creds") is not None and st.button("🔁 Reconciliar carpetas de Drive", key="reconciliar_drive", help="Quita carpetas borradas del registro y renombra las de clientes que cambiaron de nombre"):
+                with st.spinner("Revisando carpetas en Drive..."):
+                    r = reconciliar_carpetas_drive(df_cli)
+                st.success(f"Carpetas verificadas: {r['verificadas']} · renombradas: {r['renombradas']} · quitadas del registro: {r['eliminadas']}.")
         ids = (df_cli["id"].tolist() if (isinstance(df_cli, pd.DataFrame) and "id" in df_cli.columns) else [])
         ids = [x for x in ids if str(x).strip()]
         try:
@@ -5213,6 +7566,30 @@ with tab_docs:
             format_func=lambda x: "—" if x == "" else f"{x} - {get_nombre_by_id(x)}",
             key="docs_cid_sel"
         )
+
+        # ZIP masivo: documentos de todos los clientes de un asesor o sucursal
+        with st.expander("📦 ZIP masivo por asesor o sucursal"):
+            campo_zip = st.radio("Agrupar por", ["asesor", "sucursal"], horizontal=True, format_func=str.capitalize, key="zip_masivo_campo")
+            valores_campo = df_cli[campo_zip].fillna("").astype(str).str.strip() if campo_zip in df_cli.columns else pd.Series("", index=df_cli.index)
+            valor_zip = st.selectbox(campo_zip.capitalize(), [""] + sorted(v for v in valores_campo.unique() if v), key="zip_masivo_valor")
+            if valor_zip:
+                ids_zip = df_cli.loc[valores_campo == valor_zip, "id"].astype(str).tolist()
+                archivos_zip = archivos_clientes(ids_zip)
+                st.caption(f"{len(ids_zip)} clientes · {len(archivos_zip)} archivos")
+                if archivos_zip:
+                    def _registrar_zip_masivo(campo=campo_zip, valor=valor_zip, n=len(archivos_zip)):
+                        actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
+                        append_historial("", "", "", "", "", "", f"ZIP {campo} {valor} preparado ({n} archivos)", action="DESCARGA ZIP ASESOR" if campo == "asesor" else "DESCARGA ZIP", actor=actor)
+                    panel_exportacion(
+                        "📦 Preparar ZIP",
+                        f"zip_masivo_{campo_zip}_{safe_name(valor_zip)}",
+                        f"documentos_{campo_zip}_{safe_name(valor_zip)}.zip",
+                        "application/zip",
+                        generador_zip(archivos_zip),
+                        clave=f"zip:{campo_zip}:{valor_zip}:{manifiesto_archivos(archivos_zip)}",
+                        al_encolar=_registrar_zip_masivo
+                    )
+
         if cid_sel:
             estatus_cliente_sel = get_field_by_id(cid_sel, "estatus")
             st.markdown("#### Subir documentos")
@@ -5289,20 +7666,14 @@ with tab_docs:
             tok_key = f"docs_token_{cid_sel}"
             tok = st.session_state.get(tok_key, 0)
 
-            files = listar_docs_cliente(cid_sel)
+            docs_sel = docs_indexados([cid_sel])
+            files = [DOCS_DIR / c / n for c, n in zip(docs_sel["carpeta"], docs_sel["nombre"])]
             if files:
                 st.markdown("#### Archivos del cliente")
-                # mapping explícito de prefijos usados al guardar
-                prefix_map = {
-                    "estado_cuenta": "estado_",
-                    "buro_credito": "buro_",
-                    "solicitud": "solic_",
-                    "contrato": "contrato_",
-                    "otros": "otros_",
-                }
+                # Archivos por categoría desde el índice (la categoría se asigna al indexar)
                 for cat in DOC_CATEGORIAS.keys():
-                    pref = prefix_map.get(cat, cat.split('_')[0] + "_")
-                    cat_files = [f for f in files if f.name.startswith(pref)]
+                    cat_docs = docs_sel[docs_sel["categoria"] == cat]
+                    cat_files = [DOCS_DIR / c / n for c, n in zip(cat_docs["carpeta"], cat_docs["nombre"])]
                     if cat_files:
                         st.write(f"• {cat.replace('_',' ').title()}:")
                         for f in cat_files:
@@ -5313,14 +7684,10 @@ with tab_docs:
                                     blob_key = f"dl_blob_{cid_sel}_{f.name}"
                                     btn_label = f"{f.name}"
                                     #if st.button(btn_label, key=req_key):
-                                    try:
-                                        data_bytes = f.read_bytes()
-                                    except Exception:
-                                        data_bytes = b""
-
+                                    # El archivo se lee solo al hacer clic
                                     if st.download_button(
                                         f"⬇️Descargar {f.name}",
-                                        data=data_bytes,
+                                        data=lambda f=f: f.read_bytes() if f.exists() else b"",
                                         file_name=f.name,
                                         key=f"dl_btn_{cid_sel}_{tok}_{f.name}"
                                     ):
@@ -5349,6 +7716,7 @@ with tab_docs:
                                             try:
                                                 # borrar archivo físico
                                                 f.unlink()
+                                                desindexar_doc(f)
                                                 # limpiar blobs relacionados
                                                 st.session_state.pop(blob_key, None)
                                                 # forzar refresh de botones
@@ -5365,28 +7733,18 @@ with tab_docs:
 
                             
                 # Después de listar todas las categorías, ofrecer ZIP del cliente (una sola vez)
-                if st.button("📦 Descargar carpeta (ZIP)", key=f"zip_cliente_{cid_sel}"):
-                    zip_buffer = io.BytesIO()
-                    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-                        for f in files:
-                            if f.is_file():
-                                zf.write(f, arcname=f.name)
-                    zip_buffer.seek(0)
-                    # registrar en historial la descarga del ZIP del cliente
-                    try:
-                        actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
-                        append_historial(str(cid_sel), get_nombre_by_id(cid_sel), "", "", "", "", f"ZIP cliente preparado ({len(files)} archivos)", action="DESCARGA ZIP CLIENTE", actor=actor)
-                    except Exception:
-                        pass
-                    st.session_state[f"_last_zip_{cid_sel}"] = zip_buffer.getvalue()
-                if st.session_state.get(f"_last_zip_{cid_sel}"):
-                    st.download_button(
-                        "⬇️ Descargar ZIP del cliente",
-                        data=st.session_state.get(f"_last_zip_{cid_sel}"),
-                        file_name=f"{safe_name(cid_sel)}_{safe_name(get_nombre_by_id(cid_sel))}.zip",
-                        mime="application/zip",
-                        key=f"dl_zip_cliente_{cid_sel}"
-                    )
+                def _registrar_zip_cliente(cid=cid_sel, n=len(files)):
+                    actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
+                    append_historial(str(cid), get_nombre_by_id(cid), "", "", "", "", f"ZIP cliente preparado ({n} archivos)", action="DESCARGA ZIP CLIENTE", actor=actor)
+                panel_exportacion(
+                    "📦 Descargar carpeta (ZIP)",
+                    f"zip_cliente_{cid_sel}",
+                    f"{safe_name(cid_sel)}_{safe_name(get_nombre_by_id(cid_sel))}.zip",
+                    "application/zip",
+                    generador_zip([f for f in files if f.is_file()]),
+                    clave=f"zip:cliente:{cid_sel}:{manifiesto_archivos([f for f in files if f.is_file()])}",
+                    al_encolar=_registrar_zip_cliente
+                )
 
             if can("delete_client"):
                 st.markdown("---")
@@ -5571,6 +7929,8 @@ with tab_import:
 
             actualizados = 0
             agregados = 0
+            actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
+            registros_hist = []
 
             df_norm_obj = locals().get('df_norm', None)
             if df_norm_obj is not None and (not getattr(df_norm_obj, 'empty', True)):
@@ -5597,9 +7957,8 @@ with tab_import:
                             base.at[idx, k] = v
                         actualizados += 1
                         try:
-                            actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
                             cid_up = base.at[idx, "id"] if "id" in base.columns else (registro.get("id","") or "")
-                            append_historial(cid_up, registro.get("nombre",""), "", registro.get("estatus",""), "", registro.get("segundo_estatus",""), f"Importación - actualizado", action="ESTATUS MODIFICADO", actor=actor)
+                            registros_hist.append(registro_historial(cid_up, registro.get("nombre",""), "", registro.get("estatus",""), "", registro.get("segundo_estatus",""), f"Importación - actualizado", action="ESTATUS MODIFICADO", actor=actor))
                         except Exception:
                             pass
                     else:
@@ -5610,17 +7969,15 @@ with tab_import:
                         nuevo = {"id": new_id, **registro}
                         base = pd.concat([base, pd.DataFrame([nuevo])], ignore_index=True)
                         agregados += 1
-                        try:
-                            actor = (current_user() or {}).get("user") or (current_user() or {}).get("email")
-                            append_historial(new_id, nuevo.get("nombre",""), "", nuevo.get("estatus",""), "", nuevo.get("segundo_estatus",""), f"Importación - creado", action="CLIENTE AGREGADO", actor=actor)
-                        except Exception:
-                            pass
+                        registros_hist.append(registro_historial(new_id, nuevo.get("nombre",""), "", nuevo.get("estatus",""), "", nuevo.get("segundo_estatus",""), f"Importación - creado", action="CLIENTE AGREGADO", actor=actor))
 
             try:
                 base = _fix_missing_or_duplicate_ids(base)
             except Exception:
                 pass
             guardar_clientes(base)
+            # Un solo lote de historial para toda la importación
+            append_historial_many(registros_hist)
             st.success(f"Importación completada ✅  |  Agregados: {agregados}  ·  Actualizados: {actualizados}")
 
             # Limpieza del estado del mapeo para que no “se quede” la UI
@@ -5740,15 +8097,20 @@ with tab_hist:
                 st.dataframe(df_show.reset_index(drop=True), use_container_width=True, hide_index=True)
 
                 try:
-                    csv_bytes = df_show.to_csv(index=False, encoding="utf-8")
-                    st.download_button("⬇️ Descargar historial filtrado (CSV)", data=csv_bytes, file_name="historial_filtrado.csv", mime="text/csv")
+                    panel_exportacion(
+                        "⬇️ Descargar historial filtrado (CSV)",
+                        "historial_filtrado",
+                        "historial_filtrado.csv",
+                        "text/csv",
+                        generador_csv(df_show.reset_index(drop=True)),
+                        clave=f"historial:{version_datos(df_show)}"
+                    )
                 except Exception:
                     pass
                 if st.button("🗑️ Borrar historial"):
                     try:
                         # Crear un CSV vacío con las columnas correctas
-                        cols = ["id","nombre","estatus_old","estatus_new","segundo_old","segundo_new","observaciones","action","actor","ts"]
-                        pd.DataFrame(columns=cols).to_csv(HISTORIAL_CSV, index=False, encoding="utf-8")
+                        escribir_atomico(HISTORIAL_CSV, pd.DataFrame(columns=HIST_COLUMNS).to_csv(index=False))
                         st.success("Historial eliminado correctamente.")
                         do_rerun()
                     except Exception as e:
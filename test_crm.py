@@ -6,6 +6,7 @@
 
 import pytest
 import pandas as pd
+from types import SimpleNamespace
 from datetime import date, datetime
 from pathlib import Path
 
@@ -383,6 +384,16 @@ class TestNuevoIdCliente:
         
         assert nuevo_id == "C1002", f"Debe ser C1002, obtuvo {nuevo_id}"
 
+    def test_funcion_de_crm(self):
+        """La función real de crm.py existe y genera los mismos IDs"""
+        import re
+        nuevo_id_crm = extraer_de_crm("nuevo_id_cliente", re=re)["nuevo_id_cliente"]
+        df = pd.DataFrame({"id": ["C1000", "C1005", "X9", ""], "nombre": ["a", "b", "c", "d"]})
+
+        assert nuevo_id_crm(pd.DataFrame(columns=COLUMNS)) == "C1000"
+        assert nuevo_id_crm(df) == "C1006"
+        assert nuevo_id_crm(pd.DataFrame({"id": ["A1", "B2"]})) == "C1002", "Sin IDs C<n> evita chocar con las filas"
+
 
 # ============================================================
 # TEST 4: Búsqueda y normalización de asesores
@@ -775,6 +786,1841 @@ class TestSafeRerun:
         assert op_id1 != op_id2, "Operaciones diferentes deben tener op_ids diferentes"
 
 
+# ============================================================
+# TESTS SOBRE FUNCIONES REALES DE crm.py
+# (se extrae el código fuente para no ejecutar la app de Streamlit)
+# ============================================================
+
+CRM_PATH = Path(__file__).parent / "crm.py"
+
+
+def extraer_de_crm(*nombres, **globales) -> dict:
+    """
+    Ejecuta en un namespace aislado las funciones (def) y constantes de una línea
+    de crm.py indicadas en `nombres`. `globales` permite inyectar dependencias.
+    """
+    lineas = CRM_PATH.read_text(encoding="utf-8").splitlines()
+    ns = {"pd": pd, "Path": Path, **globales}
+    for nombre in nombres:
+        inicio = None
+        for i, linea in enumerate(lineas):
+            if linea.startswith(f"def {nombre}(") or linea.startswith(f"{nombre} = "):
+                inicio = i
+        assert inicio is not None, f"No se encontró {nombre} en crm.py"
+        fin = inicio + 1
+        while fin < len(lineas) and (not lineas[fin] or lineas[fin][0] in " \t)]}"):
+            fin += 1
+        exec("\n".join(lineas[inicio:fin]), ns)
+    return ns
+
+
+def almacen_archivos() -> dict:
+    """Candados y escritura atómica de crm.py (con sus @contextmanager) para inyectar en otros tests."""
+    import fcntl, json, os, secrets, threading, time
+    from contextlib import contextmanager
+    ns = extraer_de_crm(
+        "ARCHIVO_LOCK_TIMEOUT_S", "_registrar_espera_bloqueo", "metricas_bloqueos", "bloqueo_archivo",
+        "archivo_atomico", "escribir_atomico", "guardar_json",
+        fcntl=fcntl, json=json, os=os, secrets=secrets, threading=threading, time=time, _BLOQUEOS_ARCHIVOS={},
+    )
+    ns["bloqueo_archivo"] = contextmanager(ns["bloqueo_archivo"])
+    ns["archivo_atomico"] = contextmanager(ns["archivo_atomico"])
+    return {k: ns[k] for k in ("bloqueo_archivo", "archivo_atomico", "escribir_atomico", "guardar_json", "metricas_bloqueos")}
+
+
+# ============================================================
+# TEST 5: Historial en lote (append_historial_many)
+# ============================================================
+
+class TestAppendHistorialMany:
+    """Tests para el registro de historial en lote"""
+
+    def _ns(self, tmp_path, eventos_gsheet):
+        import os
+        ns = extraer_de_crm(
+            "HIST_COLUMNS", "registro_historial", "append_historial_many", "append_historial",
+            HISTORIAL_CSV=tmp_path / "historial.csv",
+            USE_GSHEETS=True,
+            _HISTORIAL_CACHE="viejo",
+            current_user=lambda: {"user": "ana"},
+            append_historial_gsheet_many=lambda evs: eventos_gsheet.append(list(evs)),
+            os=os, **almacen_archivos(),
+        )
+        return ns
+
+    def test_un_solo_append_por_lote(self, tmp_path):
+        """Varios registros generan una sola llamada a Sheets y un solo encabezado"""
+        eventos = []
+        ns = self._ns(tmp_path, eventos)
+        regs = [ns["registro_historial"](f"C{i}", f"Cliente {i}", "A", "B", "", "", "obs") for i in range(3)]
+
+        assert ns["append_historial_many"](regs) == 3
+        assert len(eventos) == 1, "Debe haber una sola llamada a Sheets"
+        assert [e["id"] for e in eventos[0]] == ["C0", "C1", "C2"]
+
+        ns["append_historial_many"]([ns["registro_historial"]("C9", "Otro", "", "", "", "")])
+        dfh = pd.read_csv(tmp_path / "historial.csv", dtype=str).fillna("")
+        assert list(dfh.columns) == ns["HIST_COLUMNS"]
+        assert list(dfh["id"]) == ["C0", "C1", "C2", "C9"], "El CSV debe crecer por append"
+        assert ns["_HISTORIAL_CACHE"] is None, "La caché del historial debe invalidarse"
+
+    def test_completa_actor_y_ts(self, tmp_path):
+        """Sin actor explícito se usa el usuario actual; ts siempre se llena"""
+        ns = self._ns(tmp_path, [])
+        ns["append_historial"]("C1", "Ana", "", "NUEVO", "", "", action="CLIENTE AGREGADO")
+        dfh = pd.read_csv(tmp_path / "historial.csv", dtype=str).fillna("")
+        assert dfh.at[0, "actor"] == "ana"
+        assert dfh.at[0, "ts"] != ""
+
+    def test_lote_vacio(self, tmp_path):
+        """Un lote vacío no escribe nada"""
+        eventos = []
+        ns = self._ns(tmp_path, eventos)
+        assert ns["append_historial_many"]([]) == 0
+        assert not (tmp_path / "historial.csv").exists()
+        assert eventos == []
+
+
+# ============================================================
+# TEST 6: Motor de análisis financiero (montos vectorizados)
+# ============================================================
+
+import hashlib
+
+
+def _ns_motor():
+    return extraer_de_crm(
+        "_cache_guardar", "version_datos", "montos_a_numero", "montos_numericos", "_calcular_montos",
+        "calcular_analisis_financiero",
+        hashlib=hashlib,
+        _MONTOS_CACHE={},
+        _ANALISIS_CACHE={},
+    )
+
+
+class TestMotorAnalisisFinanciero:
+    """Tests para el parseo único de montos y su caché"""
+
+    def setup_method(self):
+        self.df = pd.DataFrame({
+            "id": ["C1", "C2", "C3", "C4"],
+            "estatus": ["DISPERSADO", "PROPUESTA", "PROPUESTA", "RECH. CLIENTE CANCELA"],
+            "monto_propuesta": ["$100,000", "50000", "", "abc"],
+            "monto_final": ["80,000.50", "", None, "10"],
+        })
+
+    def test_montos_a_numero(self):
+        """Símbolos, comas y espacios se ignoran; vacíos e inválidos valen 0"""
+        ns = _ns_motor()
+        res = ns["montos_a_numero"](pd.Series(["$1,200.50", " 300 ", "", None, "xyz"]))
+        assert list(res) == [1200.5, 300.0, 0.0, 0.0, 0.0]
+
+    def test_monto_analisis_por_estatus(self):
+        """DISPERSADO usa monto_final; el resto usa monto_propuesta"""
+        ns = _ns_motor()
+        num = ns["montos_numericos"](self.df)
+        assert list(num["monto_analisis"]) == [80000.5, 50000.0, 0.0, 0.0]
+
+    def test_cache_por_version(self):
+        """Mismos datos reutilizan la caché; datos distintos la invalidan"""
+        ns = _ns_motor()
+        a = ns["calcular_analisis_financiero"](self.df)
+        assert ns["calcular_analisis_financiero"](self.df.copy()) is a
+        df2 = self.df.copy()
+        df2.at[1, "monto_propuesta"] = "60000"
+        b = ns["calcular_analisis_financiero"](df2)
+        assert b is not a
+        assert b["total_propuesto"] == a["total_propuesto"] + 10000
+
+    def test_metricas(self):
+        """Las métricas coinciden con el cálculo fila por fila anterior"""
+        ns = _ns_motor()
+        r = ns["calcular_analisis_financiero"](self.df)
+        assert r["total_propuesto"] == 150000.0
+        assert r["total_dispersado"] == 80000.5
+        assert r["clientes_con_monto"] == 2
+        assert r["dispersados_con_monto"] == 1
+        assert r["montos_por_estatus"].loc["PROPUESTA", ("monto_propuesta_num", "count")] == 2
+
+
+# ============================================================
+# TEST 7: Cubo de KPIs materializado
+# ============================================================
+
+def _ns_cubo(*extra):
+    return extraer_de_crm(
+        *extra,
+        "_cache_guardar", "version_datos", "montos_a_numero", "montos_numericos", "_calcular_montos",
+        "parse_dates_flexible", "_ensure_columns",
+        "CUBO_DIMENSIONES", "CUBO_MEDIDAS", "CUBO_COLUMNAS_ORIGEN",
+        "_cubo_filas", "_agregar_cubo", "_clave_cubo", "_datos_cubo", "cubo_kpi", "filas_kpi",
+        "cubo_conteo", "_ids_cambiados", "actualizar_cubo_kpi",
+        hashlib=hashlib,
+        _MONTOS_CACHE={},
+        _CUBO_CACHE={},
+    )
+
+
+class TestCuboKpi:
+    """Tests para el cubo de KPIs y su actualización incremental"""
+
+    def setup_method(self):
+        self.df = pd.DataFrame({
+            "id": ["C1", "C2", "C3", "C4"],
+            "nombre": ["A", "B", "C", "D"],
+            "sucursal": ["CDMX", "GDL", "CDMX", ""],
+            "asesor": ["Juan", "Ana", "Juan", "(sin asesor)"],
+            "fuente": ["WEB", "", "WEB", "REFERIDO"],
+            "fecha_ingreso": ["01/15/2025", "02/03/2025", "01/20/2025", ""],
+            "estatus": ["DISPERSADO", "PROPUESTA", "PROPUESTA", ""],
+            "monto_propuesta": ["100000", "50000", "20000", ""],
+            "monto_final": ["90000", "", "", ""],
+        })
+
+    def _ordenar(self, cubo):
+        return cubo.sort_values(list(cubo.columns[:5])).reset_index(drop=True)
+
+    def test_rebanadas(self):
+        """Los conteos por dimensión salen del cubo con etiquetas normalizadas"""
+        ns = _ns_cubo()
+        cubo = ns["cubo_kpi"](self.df)
+        assert int(cubo["clientes"].sum()) == 4
+        suc = ns["cubo_conteo"](cubo, "sucursal").set_index("sucursal")["cantidad"]
+        assert suc["CDMX"] == 2 and suc["(Sin sucursal)"] == 1
+        ases = ns["cubo_conteo"](cubo, "asesor").set_index("asesor")["cantidad"]
+        assert ases["(Sin asesor)"] == 1
+        meses = ns["filas_kpi"](self.df).groupby("mes").size()
+        assert meses["2025-01"] == 2 and meses["2025-02"] == 1
+        assert cubo.loc[cubo["estatus"] == "DISPERSADO", "monto_analisis"].sum() == 90000
+
+    def test_actualizacion_incremental_igual_a_reconstruir(self):
+        """Aplicar el delta produce el mismo cubo que reconstruirlo desde cero"""
+        ns = _ns_cubo()
+        ns["cubo_kpi"](self.df)
+        nuevo = self.df.copy()
+        nuevo.loc[1, ["estatus", "monto_final"]] = ["DISPERSADO", "45000"]
+        nuevo = nuevo[nuevo["id"] != "C4"]
+        nuevo = pd.concat([nuevo, pd.DataFrame([{**self.df.iloc[0].to_dict(), "id": "C5", "sucursal": "MTY"}])], ignore_index=True)
+
+        assert ns["actualizar_cubo_kpi"](self.df, nuevo) is True
+        incremental = ns["cubo_kpi"](nuevo)
+        reconstruido = _ns_cubo()["cubo_kpi"](nuevo)
+        pd.testing.assert_frame_equal(self._ordenar(incremental), self._ordenar(reconstruido), check_dtype=False)
+
+    def test_sin_cubo_previo_no_hace_nada(self):
+        """Sin cubo en caché para la versión anterior no se actualiza nada"""
+        ns = _ns_cubo()
+        assert ns["actualizar_cubo_kpi"](self.df, self.df) is False
+
+
+# ============================================================
+# TEST 8: Modelo de retorno esperado y riesgo
+# ============================================================
+
+class TestModeloRiesgo:
+    """Tests para los pesos por estatus y la sensibilidad del modelo"""
+
+    def _ns(self):
+        return _ns_cubo(
+            "MODELO_PESOS", "MODELO_RIESGO_DEFAULT", "pesos_por_estatus", "modelo_financiero",
+            "_totales_modelo", "sensibilidad_modelo",
+        )
+
+    def test_pesos_vectorizados(self):
+        """Estatus conocidos usan su peso; RECH*/REC* desconocidos usan 'rechazo'; el resto 'default'"""
+        ns = self._ns()
+        pesos = ns["pesos_por_estatus"](pd.Series(["DISPERSADO", "REC EDAD", "RECH. OTRO", "NUEVO"]))
+        assert list(pesos["prob_conversion"]) == [1.0, 0.05, 0.05, 0.5]
+        assert list(pesos["riesgo_pct"]) == [5, 95, 95, 50]
+
+    def test_modelo_y_sensibilidad(self):
+        """Los totales salen de los agregados y la sensibilidad reescala solo un estatus"""
+        ns = self._ns()
+        df = pd.DataFrame({
+            "id": ["C1", "C2", "C3"],
+            "estatus": ["DISPERSADO", "PROPUESTA", "REC EDAD"],
+            "monto_propuesta": ["100", "200", "300"],
+            "monto_final": ["100", "", ""],
+            "sucursal": "", "asesor": "", "fuente": "", "fecha_ingreso": "",
+        })
+        res = ns["modelo_financiero"](df)
+        assert res["total_cartera"] == 600
+        assert res["total_monto_esperado"] == 100 * 1.0 + 200 * 0.75 + 300 * 0.05
+        assert res["valor_pipeline"] == 200 * 0.75, "Solo PROPUESTA está en proceso"
+        sens = ns["sensibilidad_modelo"](res, "PROPUESTA", "prob_conversion", [0.0, 1.0])
+        assert list(sens["total_monto_esperado"]) == [115.0, 315.0]
+
+
+# ============================================================
+# TEST 9: Embudo y cohortes sobre el historial
+# ============================================================
+
+class TestEmbudoHistorial:
+    """Tests para las líneas de tiempo, conversión por etapa y cohortes"""
+
+    def _ns(self):
+        import numpy as np
+        return extraer_de_crm(
+            "HIST_COLUMNS", "EMBUDO_ESTATUS_FINAL", "_hash_filas_historial", "eventos_estatus",
+            "lineas_tiempo_estatus", "metricas_embudo", "curvas_cohorte", "analisis_embudo",
+            np=np, _EMBUDO_CACHE={},
+        )
+
+    def _historial(self, filas):
+        cols = ["id", "nombre", "estatus_old", "estatus_new", "segundo_old", "segundo_new", "observaciones", "action", "actor", "ts"]
+        return pd.DataFrame(
+            [dict(zip(["id", "estatus_old", "estatus_new", "ts"], f)) for f in filas]
+        ).reindex(columns=cols, fill_value="")
+
+    def setup_method(self):
+        self.filas = [
+            ("1", "", "EN ONBOARDING", "2024-01-05T10:00:00"),
+            ("1", "EN ONBOARDING", "APROBADO", "2024-01-15T10:00:00"),
+            ("1", "APROBADO", "DISPERSADO", "2024-03-02T10:00:00"),
+            ("2", "", "EN ONBOARDING", "2024-02-01T10:00:00"),
+            ("2", "EN ONBOARDING", "EN ONBOARDING", "2024-02-03T10:00:00"),
+            ("2", "EN ONBOARDING", "RECHAZADO", "2024-02-11T10:00:00"),
+        ]
+
+    def test_conversion_y_mediana(self):
+        """Cada etapa cuenta quién entró y quién llegó después a DISPERSADO"""
+        res = self._ns()["analisis_embudo"](self._historial(self.filas))
+        assert len(res["lineas"]) == 5, "Los cambios sin transición real se ignoran"
+        etapas = res["etapas"].set_index("estatus")
+        assert etapas.loc["EN ONBOARDING", "clientes"] == 2
+        assert etapas.loc["EN ONBOARDING", "conversion_pct"] == 50.0
+        assert etapas.loc["EN ONBOARDING", "mediana_dias"] == 10.0
+        assert etapas.loc["RECHAZADO", "convertidos"] == 0
+
+    def test_cohortes_mensuales(self):
+        """El estado al cierre de cada mes define la curva de la cohorte"""
+        res = self._ns()["analisis_embudo"](self._historial(self.filas))
+        ene = res["cohortes"][res["cohortes"]["cohorte"] == "2024-01"].set_index("mes")["pct_dispersado"]
+        assert list(ene) == [0.0, 0.0, 100.0]
+
+    def test_incremental_igual_a_reconstruir(self):
+        """Procesar solo las filas nuevas da el mismo resultado que recalcular todo"""
+        ns = self._ns()
+        ns["analisis_embudo"](self._historial(self.filas[:4]))
+        incremental = ns["analisis_embudo"](self._historial(self.filas))
+        completo = self._ns()["analisis_embudo"](self._historial(self.filas))
+        pd.testing.assert_frame_equal(incremental["etapas"], completo["etapas"])
+        pd.testing.assert_frame_equal(incremental["cohortes"], completo["cohortes"])
+        # Si se borran filas ya procesadas se reconstruye
+        reducido = ns["analisis_embudo"](self._historial(self.filas[3:]))
+        assert set(reducido["lineas"]["id"]) == {"2"}
+
+
+# ============================================================
+# TEST 10: Gráficas de la presentación
+# ============================================================
+
+class TestGraficasPresentacion:
+    """Tests para la caché de imágenes por (tipo, hash de datos)"""
+
+    def _ns(self):
+        import hashlib
+        return extraer_de_crm(
+            "_cache_guardar", "spec_grafica", "_etiqueta_valor", "formatear_monto",
+            "renderizar_grafica", "renderizar_graficas",
+            hashlib=hashlib, _GRAFICAS_CACHE={},
+        )
+
+    def test_clave_estable(self):
+        """Mismos datos (numpy o nativos) producen la misma clave; datos distintos, otra"""
+        import numpy as np
+        ns = self._ns()
+        a = ns["spec_grafica"]("barras_h", (8, 5), etiquetas=["A", "B"], valores=list(np.array([1, 2])), color="#000")
+        b = ns["spec_grafica"]("barras_h", (8, 5), etiquetas=["A", "B"], valores=[1.0, 2.0], color="#000")
+        c = ns["spec_grafica"]("barras_h", (8, 5), etiquetas=["A", "B"], valores=[1.0, 3.0], color="#000")
+        assert a["clave"] == b["clave"] != c["clave"]
+
+    def test_solo_renderiza_lo_que_cambio(self):
+        """Las gráficas en caché no se vuelven a dibujar"""
+        ns = self._ns()
+        llamadas = []
+        ns["renderizar_grafica"] = lambda spec: llamadas.append(spec["clave"]) or b"png"
+        datos = dict(etiquetas=["A"], eje="", titulo="", formato="entero", color="#000")
+        specs = {
+            "x": ns["spec_grafica"]("barras_h", (8, 5), valores=[1], **datos),
+            "y": ns["spec_grafica"]("barras_h", (8, 5), valores=[2], **datos),
+        }
+        assert ns["renderizar_graficas"](specs) == {"x": b"png", "y": b"png"}
+        specs["y"] = ns["spec_grafica"]("barras_h", (8, 5), valores=[5], **datos)
+        ns["renderizar_graficas"](specs)
+        assert len(llamadas) == 3
+
+    def test_render_png(self):
+        """La API orientada a objetos produce un PNG válido"""
+        ns = self._ns()
+        spec = ns["spec_grafica"]("pastel", (4, 3), valores=[1, 2, 0], etiquetas=["a", "b", "c"], colores=["#111", "#222", "#333"])
+        assert ns["renderizar_grafica"](spec).startswith(b"\x89PNG")
+
+
+# ============================================================
+# TEST 11: Plantilla de la presentación
+# ============================================================
+
+class TestPlantillaPptx:
+    """Tests para el registro de la plantilla .pptx"""
+
+    def test_ruta_configurada_y_recarga_por_mtime(self, tmp_path):
+        """La ruta explícita tiene prioridad y el archivo solo se relee si cambia"""
+        import os
+        plantilla = tmp_path / "plantilla.pptx"
+        plantilla.write_bytes(b"v1")
+        ns = extraer_de_crm("plantilla_pptx", PPTX_PLANTILLA=str(plantilla),
+                            PPTX_PLANTILLA_CANDIDATAS=[tmp_path / "no_existe.pptx"], _PLANTILLA_CACHE={})
+        assert ns["plantilla_pptx"]() == b"v1"
+        firma = ns["_PLANTILLA_CACHE"]["firma"]
+        assert ns["plantilla_pptx"]() == b"v1" and ns["_PLANTILLA_CACHE"]["firma"] == firma
+
+        plantilla.write_bytes(b"v2!")
+        os.utime(plantilla, ns=(firma[1] + 10**9, firma[1] + 10**9))
+        assert ns["plantilla_pptx"]() == b"v2!"
+
+    def test_sin_plantilla(self, tmp_path):
+        """Sin ruta configurada ni candidatas existentes no hay plantilla (no se recorre el repo)"""
+        ns = extraer_de_crm("plantilla_pptx", PPTX_PLANTILLA=None,
+                            PPTX_PLANTILLA_CANDIDATAS=[tmp_path / "a.pptx"], _PLANTILLA_CACHE={})
+        assert ns["plantilla_pptx"]() is None
+
+
+# ============================================================
+# TEST 12: Reportes pre-generados
+# ============================================================
+
+class TestReportesPregenerados:
+    """Tests para la construcción y reutilización de presentaciones por hash"""
+
+    def _ns(self, tmp_path, generadas):
+        import hashlib, json, os, threading, time
+        from datetime import date
+        return extraer_de_crm(
+            "version_datos", "clave_reporte", "variantes_reporte", "_archivo_reporte", "REPORTES_INTERVALO_HORAS",
+            "REPORTES_SOLICITUD_DIAS", "solicitar_reporte", "reportes_solicitados", "construir_reportes",
+            "programar_reportes", "reporte_cacheado", "_lock_reportes",
+            hashlib=hashlib, json=json, os=os, time=time, threading=threading, date=date, REPORTES_DIR=tmp_path / "reportes",
+            _REPORTES_CACHE={}, _PLANTILLA_CACHE={}, plantilla_pptx=lambda: None,
+            generar_presentacion_dashboard=lambda df, modelo=None: generadas.append(len(df)) or b"pptx",
+        )
+
+    def test_variantes_y_reutilizacion(self, tmp_path):
+        """Se genera global + cada sucursal/asesor una sola vez y se sirve desde disco"""
+        generadas = []
+        ns = self._ns(tmp_path, generadas)
+        df = pd.DataFrame({"id": ["1", "2", "3"], "sucursal": ["CDMX", "GDL", "CDMX"], "asesor": ["Ana", "", "Luis"]})
+        indice = ns["construir_reportes"](df)
+        assert set(indice) == {("global", ""), ("sucursal", "CDMX"), ("sucursal", "GDL"), ("asesor", "Ana"), ("asesor", "Luis")}
+        assert len(generadas) == 5
+        assert ns["reporte_cacheado"](df.iloc[::-1]).read_bytes() == b"pptx", "El orden de filas no cambia la clave"
+        assert ns["reporte_cacheado"](df, clave=ns["clave_reporte"](df)) == ns["reporte_cacheado"](df)
+
+        ns["construir_reportes"](df)
+        assert len(generadas) == 5, "Sin cambios no se regenera nada"
+
+        df2 = df[df["id"] != "2"]
+        ns["construir_reportes"](df2)
+        assert ns["reporte_cacheado"](df) is None, "Las versiones obsoletas se eliminan"
+        # global y sucursal CDMX tienen ahora el mismo contenido: comparten archivo
+        assert len(list((tmp_path / "reportes").glob("*.pptx"))) == 3
+
+    def test_solo_alcances_solicitados(self, tmp_path):
+        """En segundo plano solo se generan el global y los alcances que alguien pidió"""
+        import time
+        generadas, encolados = [], []
+        ns = self._ns(tmp_path, generadas)
+        ns["_ejecutor_reportes"] = lambda: SimpleNamespace(
+            submit=lambda f, *a: encolados.append(a) or SimpleNamespace(done=lambda: True))
+        df = pd.DataFrame({"id": ["1", "2", "3"], "sucursal": ["CDMX", "GDL", "CDMX"], "asesor": ["Ana", "", "Luis"]})
+
+        ns["programar_reportes"](df)
+        ns["programar_reportes"](df, clave=ns["clave_reporte"](df))
+        assert len(encolados) == 1 and encolados[0][2] == {("global", "")}
+        ns["solicitar_reporte"](("asesor", "Ana"))
+        ns["programar_reportes"](df)
+        assert len(encolados) == 2, "un alcance nuevo dispara la construcción"
+        indice = ns["construir_reportes"](*encolados[1])
+        assert set(indice) == {("global", ""), ("asesor", "Ana")} and len(generadas) == 2
+
+        ns["_REPORTES_CACHE"]["solicitados"][("asesor", "Ana")] = time.time() - (ns["REPORTES_SOLICITUD_DIAS"] + 1) * 86400
+        assert ns["reportes_solicitados"]() == {("global", "")}
+
+    def test_programar_concurrente(self, tmp_path):
+        """Varias sesiones a la vez encolan una sola construcción"""
+        import threading, time
+        encolados = []
+
+        def submit(f, *a):
+            time.sleep(0.01)  # ventana en la que otra sesión vería el estado a medias
+            encolados.append(a)
+            return SimpleNamespace(done=lambda: False)
+        ns = self._ns(tmp_path, [])
+        ns["_ejecutor_reportes"] = lambda: SimpleNamespace(submit=submit)
+        df = pd.DataFrame({"id": ["1", "2"], "sucursal": ["CDMX", "GDL"]})
+        clave = ns["clave_reporte"](df)
+        hilos = [threading.Thread(target=ns["programar_reportes"], args=(df, None, clave)) for _ in range(8)]
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+        assert len(encolados) == 1
+
+
+# ============================================================
+# TEST 13: Exportaciones del sidebar
+# ============================================================
+
+class TestExportaciones:
+    """Tests para la exportación perezosa a XLSX/CSV"""
+
+    def _ns(self):
+        import io, os, re
+        ns = _ns_motor()
+        ns.update(extraer_de_crm(
+            "_nombre_hoja", "hojas_por_asesor", "escribir_xlsx", "exportar_clientes",
+            io=io, os=os, re=re, _EXPORTACIONES_CACHE={}, _cache_guardar=ns["_cache_guardar"],
+            version_datos=ns["version_datos"], sort_df_by_dates=lambda df: df.copy(),
+        ))
+        return ns
+
+    def setup_method(self):
+        self.df = pd.DataFrame({
+            "id": ["1", "2", "3"],
+            "asesor": ["Ana", "", "Ana/López"],
+            "monto": [100.5, None, 3],
+            "fecha": pd.to_datetime(["2025-01-02", None, "2025-03-04"]),
+        })
+
+    def test_xlsx_por_asesor(self):
+        """Una hoja por asesor con nombres válidos y celdas vacías para nulos"""
+        import io
+        import openpyxl
+        ns = self._ns()
+        datos = ns["exportar_clientes"](self.df, "xlsx", por_asesor=True)
+        wb = openpyxl.load_workbook(io.BytesIO(datos))
+        assert wb.sheetnames == ["(Sin asesor)", "Ana", "Ana_López"]
+        filas = list(wb["Ana"].values)
+        assert filas[0] == ("id", "asesor", "monto", "fecha")
+        assert filas[1][2] == 100.5 and filas[1][3].year == 2025
+        assert list(wb["(Sin asesor)"].values)[1][2:] == (None, None)
+
+    def test_nombres_de_hoja_unicos(self):
+        """Nombres que colisionan al recortar a 31 caracteres reciben sufijo"""
+        ns = self._ns()
+        usados = set()
+        a = ns["_nombre_hoja"]("X" * 40, usados)
+        b = ns["_nombre_hoja"]("X" * 35, usados)
+        assert len(a) == len(b) == 31 and a != b
+
+    def test_cache_por_firma(self):
+        """La misma selección reutiliza el archivo; CSV con BOM para Excel"""
+        ns = self._ns()
+        csv1 = ns["exportar_clientes"](self.df, "csv")
+        assert csv1.startswith("\ufeff".encode("utf-8"))
+        assert ns["exportar_clientes"](self.df.copy(), "csv") is csv1
+        assert ns["exportar_clientes"](self.df.iloc[:2], "csv") is not csv1
+
+
+# ============================================================
+# TEST 14: Trabajos de exportación en segundo plano
+# ============================================================
+
+class TestTrabajosExportacion:
+    """Tests para la cola de exportaciones a archivos temporales"""
+
+    def _ns(self, tmp_path, **extra):
+        import concurrent.futures, os, secrets, time, zipfile
+        ejecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        ns = extraer_de_crm(
+            "_ejecutar_trabajo", "encolar_exportacion", "estado_exportacion", "limpiar_exportaciones",
+            "generador_csv", "ZIP_SIN_COMPRIMIR", "_entradas_zip", "manifiesto_archivos", "generador_zip",
+            os=os, hashlib=hashlib, secrets=secrets, time=time, zipfile=zipfile, EXPORTS_DIR=tmp_path / "exports",
+            EXPORT_MAX_EDAD_S=3600, EXPORT_MAX_BYTES=10**9, _TRABAJOS_EXPORT={},
+            _ejecutor_exportaciones=lambda: ejecutor, **extra,
+        )
+        return ns, ejecutor
+
+    def test_csv_en_segundo_plano_y_reutilizacion(self, tmp_path):
+        """El CSV se escribe a disco con progreso 100% y la misma clave reutiliza el trabajo"""
+        ns, ejecutor = self._ns(tmp_path)
+        df = pd.DataFrame({"a": range(12), "b": ["x"] * 12})
+        jid = ns["encolar_exportacion"]("h.csv", "text/csv", ns["generador_csv"](df, bloque=5), clave="k")
+        ejecutor.shutdown(wait=True)
+        t = ns["estado_exportacion"](jid)
+        assert t["estado"] == "listo" and t["progreso"] == 1.0
+        pd.testing.assert_frame_equal(pd.read_csv(t["ruta"]), df)
+        assert ns["encolar_exportacion"]("h.csv", "text/csv", None, clave="k") == jid
+        # Mismo contenido para otro cliente (documentos deduplicados): no entrega el archivo ajeno
+        assert ns["encolar_exportacion"]("otro.csv", "text/csv", ns["generador_csv"](df), clave="k") != jid
+
+    def test_error_y_desalojo_por_tamano(self, tmp_path):
+        """Un generador que falla queda en error; al superar el tope se descartan los más viejos"""
+        ns, ejecutor = self._ns(tmp_path)
+        def falla(destino, progreso):
+            raise RuntimeError("boom")
+        mal = ns["encolar_exportacion"]("x.zip", "application/zip", falla)
+        origen = tmp_path / "doc.txt"
+        origen.write_text("contenido" * 100)
+        ids = [ns["encolar_exportacion"](f"{i}.zip", "application/zip", ns["generador_zip"]([origen])) for i in range(3)]
+        ejecutor.shutdown(wait=True)
+        assert ns["estado_exportacion"](mal)["error"] == "boom"
+
+        tamano = ns["estado_exportacion"](ids[0])["tamano"]
+        ns["EXPORT_MAX_BYTES"] = tamano * 2
+        ns["limpiar_exportaciones"]()
+        assert [ns["estado_exportacion"](i) is None for i in ids] == [True, False, False]
+        assert len(list((tmp_path / "exports").glob("*.out"))) == 2
+
+    def test_zip_stored_para_comprimidos_y_manifiesto(self, tmp_path):
+        """PDF/JPG van sin recomprimir; el manifiesto cambia al modificar un archivo"""
+        import os, zipfile
+        ns, ejecutor = self._ns(tmp_path)
+        pdf = tmp_path / "estado.pdf"
+        txt = tmp_path / "notas.txt"
+        pdf.write_bytes(b"%PDF" + b"0" * 500)
+        txt.write_text("hola " * 100)
+        entradas = [pdf, (txt, "cliente_1/notas.txt")]
+        antes = ns["manifiesto_archivos"](entradas)
+        jid = ns["encolar_exportacion"]("c.zip", "application/zip", ns["generador_zip"](entradas), clave=antes)
+        ejecutor.shutdown(wait=True)
+        with zipfile.ZipFile(ns["estado_exportacion"](jid)["ruta"]) as zf:
+            tipos = {i.filename: i.compress_type for i in zf.infolist()}
+        assert tipos == {"estado.pdf": zipfile.ZIP_STORED, "cliente_1/notas.txt": zipfile.ZIP_DEFLATED}
+
+        assert ns["manifiesto_archivos"](list(reversed(entradas))) == antes
+        os.utime(txt, ns=(1, 1))
+        assert ns["manifiesto_archivos"](entradas) != antes
+
+
+# ============================================================
+# TEST 15: Índice de documentos
+# ============================================================
+
+class TestIndiceDocumentos:
+    """Tests para el catálogo SQLite de documentos por cliente"""
+
+    def _ns(self, tmp_path, df):
+        import hashlib, re, time
+        from datetime import datetime
+        docs = tmp_path / "docs"
+        docs.mkdir()
+        return extraer_de_crm(
+            "SAFE_NAME_RE", "safe_name", "DOC_PREFIJOS", "_docs_db", "categoria_doc", "_sha256_archivo",
+            "indexar_doc", "desindexar_doc", "desindexar_cliente", "mover_carpeta_indice", "reindexar_docs",
+            "_asegurar_indice_docs", "docs_indexados", "conteo_docs_por_categoria", "listar_docs_cliente",
+            hashlib=hashlib, re=re, time=time, datetime=datetime, df_cli=df,
+            DOCS_DIR=docs, DOCS_INDEX_DB=tmp_path / "documentos.sqlite", _DOCS_INDEX_ESTADO={},
+        )
+
+    def test_indexado_inicial_y_consultas(self, tmp_path):
+        """Las carpetas existentes se indexan una vez y se consultan por cliente y categoría"""
+        df = pd.DataFrame({"id": ["C1", "C2"], "nombre": ["Ana Pérez", ""]})
+        ns = self._ns(tmp_path, df)
+        (ns["DOCS_DIR"] / "Ana Pérez").mkdir()
+        (ns["DOCS_DIR"] / "Ana Pérez" / "estado_enero.pdf").write_bytes(b"1")
+        (ns["DOCS_DIR"] / "Ana Pérez" / "buro_x.pdf").write_bytes(b"22")
+        (ns["DOCS_DIR"] / "C2").mkdir()
+        (ns["DOCS_DIR"] / "C2" / "foto.jpg").write_bytes(b"333")
+
+        assert [f.name for f in ns["listar_docs_cliente"]("C1")] == ["buro_x.pdf", "estado_enero.pdf"]
+        assert [f.name for f in ns["listar_docs_cliente"]("C2")] == ["foto.jpg"]
+        conteo = ns["conteo_docs_por_categoria"]().set_index(["cliente_id", "categoria"])["cantidad"]
+        assert conteo[("C1", "estado_cuenta")] == 1 and conteo[("C2", "otros")] == 1
+
+        # Un archivo nuevo fuera del CRM no aparece hasta indexarlo
+        nuevo = ns["DOCS_DIR"] / "C2" / "solic_1.pdf"
+        nuevo.write_bytes(b"abc")
+        assert len(ns["listar_docs_cliente"]("C2")) == 1
+        ns["indexar_doc"]("C2", nuevo)
+        fila = ns["docs_indexados"](["C2"]).set_index("nombre").loc["solic_1.pdf"]
+        assert fila["categoria"] == "solicitud" and fila["tamano"] == 3
+        assert fila["sha256"] == hashlib.sha256(b"abc").hexdigest()
+
+    def test_borrado_movimiento_y_drive(self, tmp_path):
+        """Borrar, renombrar carpeta y documentos en Drive actualizan el índice"""
+        df = pd.DataFrame({"id": ["C1"], "nombre": ["Luis"]})
+        ns = self._ns(tmp_path, df)
+        ns["_asegurar_indice_docs"]()
+        (ns["DOCS_DIR"] / "C1").mkdir()
+        f = ns["DOCS_DIR"] / "C1" / "otros_a.pdf"
+        f.write_bytes(b"x")
+        ns["indexar_doc"]("C1", f)
+        (ns["DOCS_DIR"] / "C1").rename(ns["DOCS_DIR"] / "Luis")
+        ns["mover_carpeta_indice"]("C1", "Luis")
+        assert ns["listar_docs_cliente"]("C1") == [ns["DOCS_DIR"] / "Luis" / "otros_a.pdf"]
+
+        ns["indexar_doc"]("C1", datos=b"pdf", ubicacion="drive", nombre="contrato_1.pdf", enlace="https://drive/x")
+        assert len(ns["listar_docs_cliente"]("C1")) == 1, "Drive no aparece como archivo local"
+        assert len(ns["docs_indexados"](["C1"], ubicacion=None)) == 2
+
+        ns["desindexar_doc"](ns["DOCS_DIR"] / "Luis" / "otros_a.pdf")
+        assert ns["listar_docs_cliente"]("C1") == []
+        ns["desindexar_cliente"]("C1")
+        assert ns["docs_indexados"](["C1"], ubicacion=None).empty
+
+
+# ============================================================
+# TEST 16: Almacén de documentos por contenido
+# ============================================================
+
+class TestAlmacenBlobs:
+    """Tests para la deduplicación de documentos con blobs sha256"""
+
+    def _ns(self, tmp_path):
+        import hashlib, os, re, secrets, shutil, time
+        from datetime import datetime
+        docs = tmp_path / "docs"
+        docs.mkdir()
+        return extraer_de_crm(
+            "SAFE_NAME_RE", "safe_name", "DOC_PREFIJOS", "_docs_db", "categoria_doc", "_sha256_archivo",
+            "indexar_doc", "desindexar_doc", "desindexar_cliente", "ruta_blob", "_vincular",
+            "guardar_doc_en_blob", "referencias_blob", "liberar_blob", "deduplicar_docs",
+            hashlib=hashlib, os=os, re=re, secrets=secrets, shutil=shutil, time=time, datetime=datetime,
+            DOCS_DIR=docs, BLOBS_DIR=tmp_path / "blobs", DOCS_INDEX_DB=tmp_path / "documentos.sqlite",
+            _DOCS_INDEX_ESTADO={},
+        )
+
+    def test_subida_repetida_comparte_blob(self, tmp_path):
+        """El mismo contenido para dos clientes se guarda una vez y se libera con la última referencia"""
+        ns = self._ns(tmp_path)
+        a = ns["DOCS_DIR"] / "A" / "estado_1.pdf"
+        b = ns["DOCS_DIR"] / "B" / "estado_1.pdf"
+        a.parent.mkdir(); b.parent.mkdir()
+        sha = ns["guardar_doc_en_blob"](a, b"contenido")
+        assert ns["guardar_doc_en_blob"](b, b"contenido") == sha
+        ns["indexar_doc"]("A", a, sha256=sha)
+        ns["indexar_doc"]("B", b, sha256=sha)
+        blob = ns["ruta_blob"](sha)
+        assert blob.read_bytes() == b"contenido" and b.read_bytes() == b"contenido"
+        assert len(list(ns["BLOBS_DIR"].glob("*/*"))) == 1
+        assert ns["referencias_blob"](sha) == 2
+
+        a.unlink()
+        ns["desindexar_doc"](a)
+        assert blob.exists(), "B aún lo referencia"
+        b.unlink()
+        ns["desindexar_doc"](b)
+        assert not blob.exists()
+
+    def test_deduplicar_existentes(self, tmp_path):
+        """Los archivos repetidos ya indexados pasan a ser referencias al mismo blob"""
+        ns = self._ns(tmp_path)
+        for cid in ("A", "B", "C"):
+            (ns["DOCS_DIR"] / cid).mkdir()
+            f = ns["DOCS_DIR"] / cid / "buro_1.pdf"
+            f.write_bytes(b"x" * 100 if cid != "C" else b"otro")
+            ns["indexar_doc"](cid, f)
+        n, liberados = ns["deduplicar_docs"]()
+        assert (n, liberados) == (1, 100)
+        assert len(list(ns["BLOBS_DIR"].glob("*/*"))) == 2
+        assert (ns["DOCS_DIR"] / "B" / "buro_1.pdf").read_bytes() == b"x" * 100
+        assert ns["deduplicar_docs"]() == (0, 0), "idempotente"
+
+
+# ============================================================
+# TEST 17: Subidas a Google Drive
+# ============================================================
+
+class _DriveFalso:
+    """Servicio de Drive mínimo que registra las llamadas"""
+
+    def __init__(self, llamadas, carpetas=None):
+        self.llamadas = llamadas
+        self.carpetas = {} if carpetas is None else carpetas
+
+    def _req(self, tipo, resultado, chunks=0):
+        llamadas = self.llamadas
+
+        class _Req:
+            def execute(self, num_retries=0):
+                llamadas.append(tipo)
+                if isinstance(resultado, Exception):
+                    raise resultado
+                return resultado
+
+            def next_chunk(self, num_retries=0):
+                llamadas.append("chunk")
+                self.n = getattr(self, "n", 0) + 1
+                return (None, resultado if self.n >= chunks else None)
+        return _Req()
+
+    def files(self):
+        return self
+
+    def about(self):
+        return SimpleNamespace(get=lambda fields: self._req("about", {"user": {"emailAddress": "ana@x.com"}}))
+
+    def list(self, **kw):
+        return self._req("list", {"files": []})
+
+    def get(self, fileId, fields=None):
+        if fileId not in self.carpetas:
+            return self._req("get", _Error404())
+        return self._req("get", {"id": fileId, **self.carpetas[fileId]})
+
+    def update(self, fileId, body, fields=None):
+        self.carpetas[fileId]["name"] = body["name"]
+        return self._req("update", {"id": fileId})
+
+    def create(self, body=None, media_body=None, fields=None, fileId=None):
+        if fileId:
+            return self._req("permiso", {"id": fileId})
+        nombre = body["name"]
+        padre = (body.get("parents") or [None])[0]
+        if media_body is None:
+            fid = f"id-{nombre}" if f"id-{nombre}" not in self.carpetas else f"id-{nombre}-{len(self.carpetas)}"
+            self.carpetas[fid] = {"name": nombre, "trashed": False}
+            return self._req("create", {"id": fid})
+        if padre is not None and padre not in self.carpetas:
+            return self._req("create", _Error404())
+        en_papelera = padre is not None and self.carpetas[padre]["trashed"]
+        chunks = 2 if media_body.resumable() else 0
+        return self._req("create", {"id": f"id-{nombre}", "webViewLink": f"https://drive/{nombre}", "trashed": en_papelera}, chunks)
+
+    def delete(self, fileId):
+        return self._req("delete", {})
+
+    def permissions(self):
+        return self
+
+    def new_batch_http_request(self, callback=None):
+        llamadas = self.llamadas
+
+        class _Batch(list):
+            def add(self, req, request_id=None):
+                self.append((req, request_id))
+
+            def execute(self):
+                llamadas.append("batch")
+                for req, rid in self:
+                    try:
+                        callback(rid, req.execute(), None)
+                    except Exception as e:
+                        callback(rid, None, e)
+        return _Batch()
+
+
+class _Error404(Exception):
+    resp = SimpleNamespace(status=404)
+
+
+class TestSubidasDrive:
+    """Tests para el servicio, el registro de carpetas y la subida en paralelo a Drive"""
+
+    def _ns(self, tmp_path, llamadas, construidos, carpetas=None):
+        import concurrent.futures, io, json, os, re, threading
+        from googleapiclient.http import MediaIoBaseUpload
+        st = SimpleNamespace(session_state={"drive_creds": object()})
+        ejecutor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        carpetas = {} if carpetas is None else carpetas
+
+        def build(*a, **kw):
+            construidos.append(threading.get_ident())
+            return _DriveFalso(llamadas, carpetas)
+        return extraer_de_crm(
+            "DRIVE_CARPETA_RAIZ", "DRIVE_MAX_HILOS", "DRIVE_RESUMABLE_MIN", "DRIVE_CHUNK", "_DRIVE_HILO",
+            "drive_service", "_drive_service_hilo", "_buscar_o_crear_carpeta_drive",
+            "DRIVE_REGISTRO_COLS", "_nombre_carpeta_drive", "cuenta_drive", "_registro_drive",
+            "_guardar_registro_drive_local", "registrar_carpeta_drive", "_sincronizar_registro_drive_gsheet",
+            "olvidar_carpeta_drive", "_carpeta_drive_no_disponible", "crear_carpeta_cliente_drive", "reconciliar_carpetas_drive",
+            "_subir_bytes_drive", "publicar_en_drive", "subir_varios_a_drive",
+            st=st, build=build, io=io, json=json, os=os, re=re, threading=threading, datetime=datetime,
+            MediaIoBaseUpload=MediaIoBaseUpload, _ejecutor_drive=lambda: ejecutor,
+            USE_GSHEETS=False, DRIVE_REGISTRO_FILE=tmp_path / "drive_carpetas.json", _DRIVE_REGISTRO={},
+            **almacen_archivos(),
+        )
+
+    def test_registro_de_carpetas_y_permisos_en_batch(self, tmp_path):
+        """La carpeta se resuelve una vez, queda registrada por cuenta y los permisos van en un batch"""
+        llamadas, construidos = [], []
+        ns = self._ns(tmp_path, llamadas, construidos)
+        items = [(f"doc{i}.pdf", b"x" * 10, "application/pdf") for i in range(3)]
+        res = ns["subir_varios_a_drive"](items, "C1", "Ana / Pérez")
+        assert res == [(f"doc{i}.pdf", f"https://drive/doc{i}.pdf") for i in range(3)]
+        assert llamadas.count("list") == 2 and llamadas.count("create") == 5
+        assert llamadas[-4:] == ["batch", "permiso", "permiso", "permiso"]
+        assert ns["_registro_drive"]()[("ana@x.com", "C1")]["carpeta_id"] == "id-Ana _ Pérez"
+        # Servicio de la sesión + a lo más uno por hilo del pool
+        assert len(construidos) <= 1 + ns["DRIVE_MAX_HILOS"]
+
+        # Otra sesión (registro recargado del disco) y cliente renombrado: cero búsquedas
+        llamadas.clear()
+        ns2 = self._ns(tmp_path, llamadas, [])
+        assert ns2["crear_carpeta_cliente_drive"]("C1", "Ana Renombrada") == "id-Ana _ Pérez"
+        assert llamadas == ["about"]
+
+    def test_carpeta_borrada_o_en_papelera(self, tmp_path):
+        """Si la carpeta registrada ya no sirve, se resuelve de nuevo y la subida se reintenta una vez"""
+        llamadas, carpetas = [], {}
+        ns = self._ns(tmp_path, llamadas, [], carpetas)
+        registro = lambda: ns["_registro_drive"]()[("ana@x.com", "C1")]["carpeta_id"]
+        items = [("a.pdf", b"x", "application/pdf"), ("b.pdf", b"y", "application/pdf")]
+        assert all(link for _, link in ns["subir_varios_a_drive"](items, "C1", "Ana"))
+        original = registro()
+
+        carpetas[original]["trashed"] = True
+        res = ns["subir_varios_a_drive"](items, "C1", "Ana")
+        assert [link for _, link in res] == ["https://drive/a.pdf", "https://drive/b.pdf"]
+        assert llamadas.count("delete") == 2, "los archivos que cayeron en la papelera se borran"
+        nueva = registro()
+        assert nueva != original and not carpetas[nueva]["trashed"]
+
+        del carpetas[nueva]
+        res = ns["subir_varios_a_drive"](items, "C1", "Ana")
+        assert all(link for _, link in res) and registro() not in (original, nueva)
+        import json
+        assert json.loads((tmp_path / "drive_carpetas.json").read_text(encoding="utf-8"))[-1]["carpeta_id"] == registro()
+
+    def test_reconciliar(self, tmp_path):
+        """Reconciliar renombra carpetas de clientes renombrados y quita las borradas"""
+        llamadas, carpetas = [], {}
+        ns = self._ns(tmp_path, llamadas, [], carpetas)
+        ns["crear_carpeta_cliente_drive"]("C1", "Ana")
+        ns["crear_carpeta_cliente_drive"]("C2", "Luis")
+        del carpetas["id-Luis"]
+        df = pd.DataFrame({"id": ["C1", "C2"], "nombre": ["Ana María", "Luis"]})
+        r = ns["reconciliar_carpetas_drive"](df)
+        assert r == {"verificadas": 2, "renombradas": 1, "eliminadas": 1}
+        assert carpetas["id-Ana"]["name"] == "Ana María"
+        assert ("ana@x.com", "C2") not in ns["_registro_drive"]()
+        assert ns["_registro_drive"]()[("ana@x.com", "C1")]["nombre"] == "Ana María"
+
+    def test_archivo_grande_reanudable(self, tmp_path):
+        """Los archivos grandes se suben por bloques con una sesión reanudable"""
+        llamadas, construidos = [], []
+        ns = self._ns(tmp_path, llamadas, construidos)
+        grande = b"x" * ns["DRIVE_RESUMABLE_MIN"]
+        fid, link = ns["_subir_bytes_drive"](ns["st"].session_state["drive_creds"], "g.pdf", grande, "application/pdf", None)
+        assert fid == "id-g.pdf" and llamadas == ["chunk", "chunk"]
+
+
+# ============================================================
+# TEST 18: Directorio de usuarios y límite de intentos
+# ============================================================
+
+class TestDirectorioUsuarios:
+    """Tests para el índice de usuarios y el bloqueo por intentos fallidos"""
+
+    def _ns(self, tmp_path, cargas):
+        import json, time
+        users_file = tmp_path / "users.json"
+        users_file.write_text(json.dumps({"users": [
+            {"user": "Ana", "role": "admin", "salt": "s", "hash": "h"},
+            {"email": "luis@x.com", "role": "member", "salt": "s", "hash": "h"},
+        ]}), encoding="utf-8")
+
+        def load_users():
+            cargas.append(1)
+            return json.loads(users_file.read_text(encoding="utf-8"))
+
+        def save_users(obj):
+            users_file.write_text(json.dumps(obj), encoding="utf-8")
+        return extraer_de_crm(
+            "DIRECTORIO_TTL_S", "LOGIN_VENTANA_S", "LOGIN_MAX_FALLOS_USUARIO_IP", "LOGIN_MAX_FALLOS_USUARIO",
+            "_norm_usuario", "_firma_users_file", "directorio_usuarios", "invalidar_directorio_usuarios",
+            "_fallos_recientes", "_claves_intento_login", "login_bloqueado", "registrar_intento_login",
+            "get_user", "add_user", "delete_user",
+            json=json, time=time, USERS_FILE=users_file, load_users=load_users, save_users=save_users,
+            limpiar_cache_usuarios=lambda: None, _hash_pw=lambda pw: ("sal", "hash"),
+            _DIRECTORIO_USUARIOS={}, _INTENTOS_LOGIN={},
+        )
+
+    def test_busqueda_sin_recargar(self, tmp_path):
+        """Las búsquedas usan el índice; solo altas/bajas o cambios del archivo recargan"""
+        cargas = []
+        ns = self._ns(tmp_path, cargas)
+        assert ns["get_user"](" ana ")["role"] == "admin"
+        assert ns["get_user"]("LUIS@x.com")["role"] == "member"
+        assert ns["get_user"]("nadie") is None
+        assert len(cargas) == 1
+
+        assert ns["add_user"]("ana", "pw") == (False, "Ese usuario ya existe.")
+        assert ns["add_user"]("Eva", "pw")[0]
+        assert ns["get_user"]("eva")["salt"] == "sal"
+        assert ns["delete_user"]("luis@x.com") == (True, "Usuario eliminado.")
+        assert ns["get_user"]("luis@x.com") is None
+        assert [u.get("user") for u in ns["directorio_usuarios"]()["data"]["users"]] == ["Ana", "Eva"]
+
+    def test_bloqueo_por_usuario_e_ip(self, tmp_path):
+        """Tras varios fallos se bloquea el usuario desde esa IP (o en total) hasta que pase la ventana"""
+        ns = self._ns(tmp_path, [])
+        for _ in range(ns["LOGIN_MAX_FALLOS_USUARIO_IP"]):
+            assert ns["login_bloqueado"]("ana", "1.1.1.1") == 0
+            ns["registrar_intento_login"]("ana", "1.1.1.1", False)
+        assert ns["login_bloqueado"]("ANA", "1.1.1.1") > 0
+        assert ns["login_bloqueado"]("ana", "2.2.2.2") == 0, "otra IP no hereda el bloqueo por usuario + IP"
+        assert ns["login_bloqueado"]("eva", "1.1.1.1") == 0
+
+        # Detrás de un proxy todos comparten IP: muchos fallos de otros usuarios no bloquean a nadie más
+        for i in range(100):
+            ns["registrar_intento_login"](f"u{i}", "9.9.9.9", False)
+        assert ns["login_bloqueado"]("eva", "9.9.9.9") == 0
+
+        # Intentos distribuidos contra un mismo usuario: límite total
+        for i in range(ns["LOGIN_MAX_FALLOS_USUARIO"] - ns["LOGIN_MAX_FALLOS_USUARIO_IP"]):
+            ns["registrar_intento_login"]("ana", f"10.0.0.{i}", False)
+        assert ns["login_bloqueado"]("ana", "3.3.3.3") > 0
+
+        # Al vencer la ventana se libera
+        for clave in [c for c in ns["_INTENTOS_LOGIN"] if c[1] == "ana"]:
+            ns["_INTENTOS_LOGIN"][clave] = [t - ns["LOGIN_VENTANA_S"] for t in ns["_INTENTOS_LOGIN"][clave]]
+        assert ns["login_bloqueado"]("ana", "1.1.1.1") == 0
+        ns["registrar_intento_login"]("eva", "9.9.9.9", False)
+        ns["registrar_intento_login"]("eva", "9.9.9.9", True)
+        assert not any(c[1] == "eva" for c in ns["_INTENTOS_LOGIN"]), "un login correcto limpia sus contadores"
+
+
+# ============================================================
+# TEST 19: Hash de contraseñas versionado
+# ============================================================
+
+class TestHashContrasenas:
+    """Tests para el formato con parámetros, la compatibilidad y el re-hash al iniciar sesión"""
+
+    def _ns(self, **extra):
+        import concurrent.futures, hashlib, secrets
+        ejecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return extraer_de_crm(
+            "PW_PARAMETROS", "PW_PARAMETROS_LEGADO", "_separar_hash_pw", "_derivar_pw", "_hash_pw",
+            "_verify_pw", "pw_necesita_rehash", "rehash_usuario",
+            hashlib=hashlib, secrets=secrets, _ejecutor_hash=lambda: ejecutor, **extra,
+        )
+
+    def test_formatos(self):
+        """Se verifican hashes del formato anterior, pbkdf2 y scrypt versionados"""
+        ns = self._ns()
+        salt = "ab" * 16
+        legado = hashlib.pbkdf2_hmac("sha256", b"pw", bytes.fromhex(salt), 100_000).hex()
+        assert ns["_verify_pw"]("pw", salt, legado)
+        assert not ns["_verify_pw"]("otra", salt, legado)
+
+        ns["PW_PARAMETROS"] = "scrypt$1024$8$1"
+        salt2, h = ns["_hash_pw"]("pw")
+        assert h.startswith("scrypt$1024$8$1$")
+        assert ns["_verify_pw"]("pw", salt2, h) and not ns["_verify_pw"]("x", salt2, h)
+        assert ns["pw_necesita_rehash"](legado) and not ns["pw_necesita_rehash"](h)
+        assert not ns["_verify_pw"]("pw", salt2, "bcrypt$12$abc"), "esquema desconocido"
+
+    def test_rehash_al_iniciar_sesion(self):
+        """Con parámetros nuevos, el login correcto guarda el hash actualizado"""
+        guardados = []
+        salt = "cd" * 16
+        ana = {"user": "Ana", "role": "admin", "salt": salt, "hash": f"pbkdf2_sha256$1000${hashlib.pbkdf2_hmac('sha256', b'pw', bytes.fromhex(salt), 1000).hex()}"}
+        eva = {"user": "Eva", "role": "member", "salt": "s", "hash": "h"}
+        ns = self._ns(
+            save_users=guardados.append, invalidar_directorio_usuarios=lambda: None,
+            directorio_usuarios=lambda: {"data": {"users": [ana, eva]}, "indice": {"ana": ana, "eva": eva}},
+            _norm_usuario=lambda x: x.strip().lower(),
+        )
+
+        assert ns["_verify_pw"]("pw", ana["salt"], ana["hash"])
+        assert ns["rehash_usuario"]("ana", "pw")
+        [data] = guardados
+        nuevo = data["users"][0]
+        assert nuevo["hash"].startswith(ns["PW_PARAMETROS"] + "$") and data["users"][1] is eva
+        assert ns["_verify_pw"]("pw", nuevo["salt"], nuevo["hash"])
+
+
+# ============================================================
+# TEST 20: Tokens de sesión
+# ============================================================
+
+class TestTokensSesion:
+    """Tests para emitir y validar tokens de sesión firmados"""
+
+    def _ns(self, tmp_path, usuarios):
+        import base64, json, os, secrets, time
+        st = SimpleNamespace(secrets={})
+        return extraer_de_crm(
+            "SESSION_TTL_S", "_secreto_sesion", "_norm_usuario", "_leer_epocas_sesion", "epoca_sesion",
+            "revocar_sesiones", "_firma_sesion", "emitir_token_sesion", "validar_token_sesion",
+            **almacen_archivos(), base64=base64, hashlib=hashlib, json=json, os=os, secrets=secrets, time=time, st=st,
+            SESSION_SECRET_FILE=tmp_path / ".session_secret", SESSION_EPOCAS_FILE=tmp_path / "sesiones.json",
+            _SESION={}, get_user=lambda x: usuarios.get(x.strip().lower()),
+        )
+
+    def test_token_valido_y_revocaciones(self, tmp_path):
+        """El token restaura la sesión; expirado, alterado o tras cambiar la contraseña no"""
+        ana = {"user": "Ana", "role": "admin", "hash": "h1"}
+        usuarios = {"ana": ana}
+        ns = self._ns(tmp_path, usuarios)
+        token = ns["emitir_token_sesion"](ana)
+        assert ns["validar_token_sesion"](token) == {"user": "Ana", "role": "admin"}
+
+        # Otro proceso con el mismo secreto persistido también lo acepta
+        assert self._ns(tmp_path, usuarios)["validar_token_sesion"](token) is not None
+
+        usuario_b64, expira, firma = token.split(".")
+        assert ns["validar_token_sesion"](f"{usuario_b64}.{int(expira) + 10}.{firma}") is None
+        assert ns["validar_token_sesion"]("basura") is None and ns["validar_token_sesion"](None) is None
+        ns["SESSION_TTL_S"] = -1
+        assert ns["validar_token_sesion"](ns["emitir_token_sesion"](ana)) is None
+
+        ana["role"] = "member"
+        assert ns["validar_token_sesion"](token)["role"] == "member", "el rol se toma del directorio"
+        ana["hash"] = "h2"
+        assert ns["validar_token_sesion"](token) is None
+        usuarios.clear()
+        assert ns["validar_token_sesion"](token) is None
+
+    def test_secreto_unico_y_privado(self, tmp_path):
+        """Sesiones que arrancan a la vez comparten un solo secreto, creado ya con permisos 0600"""
+        import os, stat, threading
+        secretos = []
+        hilos = [threading.Thread(target=lambda: secretos.append(self._ns(tmp_path, {})["_secreto_sesion"]()))
+                 for _ in range(8)]
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+        assert len(secretos) == 8 and len(set(secretos)) == 1
+        assert secretos[0] == (tmp_path / ".session_secret").read_bytes()
+        assert stat.S_IMODE(os.stat(tmp_path / ".session_secret").st_mode) == 0o600
+
+    def test_cerrar_sesion_revoca_tokens(self, tmp_path):
+        """Cerrar sesión sube la época: los tokens emitidos antes dejan de valer, también en otro proceso"""
+        ana = {"user": "Ana", "role": "admin", "hash": "h1"}
+        eva = {"user": "eva", "role": "member", "hash": "h2"}
+        usuarios = {"ana": ana, "eva": eva}
+        ns = self._ns(tmp_path, usuarios)
+        otro = self._ns(tmp_path, usuarios)
+        viejo, de_eva = ns["emitir_token_sesion"](ana), ns["emitir_token_sesion"](eva)
+        assert otro["validar_token_sesion"](viejo) is not None
+
+        ns["revocar_sesiones"]("ANA")
+        assert ns["validar_token_sesion"](viejo) is None
+        assert otro["validar_token_sesion"](viejo) is None, "la época se relee del archivo"
+        assert ns["validar_token_sesion"](de_eva) is not None, "solo se revocan los tokens de ese usuario"
+        assert otro["validar_token_sesion"](ns["emitir_token_sesion"](ana)) is not None
+        import json
+        assert json.loads((tmp_path / "sesiones.json").read_text(encoding="utf-8")) == {"ana": 1}
+
+
+class TestNonceOAuth:
+    """Tests para el `state` de OAuth como nonce de un solo uso"""
+
+    def _ns(self, estados, sesion, query, cookies):
+        import secrets, time
+        st = SimpleNamespace(session_state=sesion, query_params=query, context=SimpleNamespace(cookies=cookies))
+        return extraer_de_crm(
+            "SESSION_PARAM", "OAUTH_STATE_TTL_S", "_huella_navegador", "nonce_oauth", "consumir_nonce_oauth",
+            "_limpiar_query_params", st=st, secrets=secrets, time=time, _estados_oauth=lambda: estados,
+        )
+
+    def test_nonce_de_un_solo_uso_ligado_al_navegador(self):
+        """El nonce guarda el token en el servidor, se consume una vez y nunca se copia a `s`"""
+        estados = {}
+        ns = self._ns(estados, {}, {"s": "tok-ana"}, {"_streamlit_xsrf": "cookie-ana"})
+        nonce = ns["nonce_oauth"]()
+        assert nonce != "tok-ana" and ns["nonce_oauth"]() == nonce, "un nonce por sesión, sin el token"
+        assert estados[nonce]["token"] == "tok-ana" and estados[nonce]["huella"]
+
+        assert self._ns({}, {}, {}, {"_streamlit_xsrf": object()})["_huella_navegador"]() == "", "cookie no textual"
+        atacante = self._ns(estados, {}, {}, {"_streamlit_xsrf": "cookie-eva"})
+        assert atacante["_huella_navegador"]() != estados[nonce]["huella"]
+        assert ns["consumir_nonce_oauth"](nonce)["token"] == "tok-ana"
+        assert ns["consumir_nonce_oauth"](nonce) is None and ns["consumir_nonce_oauth"]("inventado") is None
+
+        estados["viejo"] = {"token": "t", "huella": "h", "ts": 0}
+        assert ns["consumir_nonce_oauth"]("viejo") is None
+
+    def test_limpiar_url_no_usa_state_como_sesion(self):
+        """Un `?state=` ajeno no inicia sesión; el token propio se conserva"""
+        query = {"state": "token-del-atacante", "code": "x"}
+        self._ns({}, {}, query, {})["_limpiar_query_params"]()
+        assert query == {}
+        query = {"s": "tok", "state": "n", "code": "x"}
+        self._ns({}, {}, query, {})["_limpiar_query_params"]()
+        assert query == {"s": "tok"}
+
+
+# ============================================================
+# TEST 21: Lectura inicial en batch de Google Sheets
+# ============================================================
+
+class TestBootstrapGsheets:
+    """Tests para la lectura de varias pestañas en un solo batchGet"""
+
+    def _ns(self, respuesta, llamadas):
+        class _Libro:
+            def values_batch_get(self, ranges, params=None):
+                llamadas.append(ranges)
+                if isinstance(respuesta, Exception):
+                    raise respuesta
+                return respuesta
+
+        def _no_abrir(*a, **kw):
+            llamadas.append("worksheet")
+            return None
+        return extraer_de_crm(
+            "GSHEET_USERSTAB", "GSHEET_SUCURSALES_TAB", "GSHEET_ESTATUS_TAB", "GSHEET_SEGUNDO_ESTATUS_TAB",
+            "GSHEET_BOOTSTRAP_TABS", "bootstrap_gsheets", "_gs_bootstrap_valores", "_df_desde_valores",
+            "load_catalog_from_gsheet",
+            GSHEET_TAB="clientes", USE_GSHEETS=True, _gs_spreadsheet=lambda: _Libro(), _gs_open_worksheet=_no_abrir, _GS_BOOTSTRAP={},
+            _CATALOGS_CACHE={}, _CATALOGS_CACHE_TIME={},
+        )
+
+    def test_una_peticion_para_todas_las_pestanas(self):
+        """Los cargadores usan los valores del batch sin abrir cada pestaña"""
+        llamadas = []
+        respuesta = {"valueRanges": [
+            {"values": [["id", "nombre", "estatus"], ["C1", "Ana"], [], ["C2", "Luis", "DISPERSADO"]]},
+            {"values": [["user", "role", "salt", "hash"], ["ana", "admin", "s", "h"]]},
+            {"values": [["valor"], ["CDMX"], ["GDL"]]},
+            {"values": [["valor"], ["DISPERSADO"]]},
+            {},
+        ]}
+        ns = self._ns(respuesta, llamadas)
+        ns["bootstrap_gsheets"]()
+        assert llamadas == [["'clientes'", "'users'", "'sucursales'", "'estatus'", "'segundo_estatus'"]]
+
+        assert ns["load_catalog_from_gsheet"]("sucursales", ["X"]) == ["CDMX", "GDL"]
+        assert ns["load_catalog_from_gsheet"]("segundo_estatus", ["X"]) == ["X"], "pestaña vacía → defaults"
+        df = ns["_df_desde_valores"](ns["_gs_bootstrap_valores"]("clientes"))
+        assert df.to_dict("records") == [
+            {"id": "C1", "nombre": "Ana", "estatus": ""},
+            {"id": "C2", "nombre": "Luis", "estatus": "DISPERSADO"},
+        ]
+        assert ns["_gs_bootstrap_valores"]("clientes") is None, "se entrega una sola vez"
+        assert "worksheet" not in llamadas
+
+    def test_fallo_del_batch(self):
+        """Si el batch falla, cada cargador vuelve a leer su pestaña"""
+        llamadas = []
+        ns = self._ns(RuntimeError("falta una pestaña"), llamadas)
+        ns["bootstrap_gsheets"]()
+        assert ns["_GS_BOOTSTRAP"] == {}
+        assert ns["load_catalog_from_gsheet"]("estatus", ["A"]) == ["A"]
+        assert llamadas[-1] == "worksheet"
+
+
+# ============================================================
+# TEST 22: Pool de clientes de Google Sheets
+# ============================================================
+
+class TestPoolGsheets:
+    """Tests para el cliente y las pestañas compartidos entre sesiones"""
+
+    def _ns(self, llamadas, creds):
+        import threading, time
+        from datetime import datetime
+
+        class _Lock:
+            """RLock que recuerda si está tomado (las llamadas de red no deben hacerse con él)"""
+            def __init__(self):
+                self.lock, self.tomado = threading.RLock(), 0
+
+            def __enter__(self):
+                self.lock.acquire()
+                self.tomado += 1
+
+            def __exit__(self, *exc):
+                self.tomado -= 1
+                self.lock.release()
+
+        def red(nombre):
+            assert not pool["lock"].tomado, f"{nombre} con el lock del pool tomado"
+            llamadas.append(nombre)
+
+        class _Ws:
+            def __init__(self, title):
+                self.title = title
+
+        class _Libro:
+            def __init__(self):
+                self.tabs = ["clientes", "users"]
+
+            def worksheets(self):
+                red("worksheets")
+                return [_Ws(t) for t in self.tabs]
+
+            def add_worksheet(self, title, rows, cols):
+                red("add")
+                if title in self.tabs:
+                    raise RuntimeError("ya existe")
+                self.tabs.append(title)
+                return _Ws(title)
+
+        libro = _Libro()
+
+        class _Gc:
+            def open_by_key(self, key):
+                red("open")
+                return libro
+
+        def authorize(c, **kw):
+            red("auth")
+            return _Gc()
+        pool = {"lock": _Lock(), "creds": None, "gc": None, "sh": None, "ws": {}, "ts_ws": 0.0}
+        return extraer_de_crm(
+            "GS_METADATA_TTL_S", "GS_TOKEN_MARGEN_S", "_gs_renovar_token", "_gs_reiniciar_pool",
+            "_gs_spreadsheet", "_gs_open_worksheet",
+            time=time, datetime=datetime, threading=threading, GSHEET_ID="x",
+            gspread=SimpleNamespace(authorize=authorize), Request=lambda: None,
+            _pool_gsheets=lambda: pool, _gs_credentials=lambda: creds,
+            ClienteHTTPProgramado=None,
+        )
+
+    def _creds(self, llamadas, valido=True, minutos=60):
+        from datetime import datetime, timedelta, timezone
+        ahora = datetime.now(timezone.utc).replace(tzinfo=None)
+        c = SimpleNamespace(valid=valido, expiry=ahora + timedelta(minutes=minutos))
+
+        def refresh(req):
+            llamadas.append("refresh")
+            c.valid, c.expiry = True, ahora + timedelta(minutes=60)
+        c.refresh = refresh
+        return c
+
+    def test_cliente_y_pestanas_reutilizados(self):
+        """Se autentica y lista pestañas una vez; solo una pestaña nueva vuelve a listar"""
+        llamadas = []
+        ns = self._ns(llamadas, self._creds(llamadas))
+        for _ in range(3):
+            assert ns["_gs_open_worksheet"]("clientes").title == "clientes"
+            assert ns["_gs_open_worksheet"]("users").title == "users"
+        assert llamadas == ["auth", "open", "worksheets"]
+
+        llamadas.clear()
+        assert ns["_gs_open_worksheet"]("nueva").title == "nueva"
+        assert llamadas == ["worksheets", "add"]
+        ns["_gs_open_worksheet"]("nueva")
+        assert llamadas == ["worksheets", "add"]
+
+        # Al vencer los metadatos se listan de nuevo (una llamada para todas)
+        ns["_pool_gsheets"]()["ts_ws"] -= ns["GS_METADATA_TTL_S"] + 1
+        ns["_gs_open_worksheet"]("users")
+        assert llamadas[-1] == "worksheets"
+
+    def test_renovacion_y_reinicio(self):
+        """El token se renueva antes de vencer y un error rehace el cliente"""
+        llamadas = []
+        ns = self._ns(llamadas, self._creds(llamadas, minutos=2))
+        ns["_gs_spreadsheet"]()
+        assert llamadas == ["refresh", "auth", "open"]
+        ns["_gs_spreadsheet"]()
+        assert llamadas.count("refresh") == 1
+
+        libro = ns["_pool_gsheets"]()["sh"]
+        libro.worksheets = lambda: 1 / 0
+        assert ns["_gs_open_worksheet"]("clientes") is None
+        assert ns["_pool_gsheets"]()["sh"] is None
+        del libro.worksheets
+        assert ns["_gs_open_worksheet"]("clientes").title == "clientes"
+        assert llamadas[-3:] == ["auth", "open", "worksheets"]
+
+    def test_red_fuera_del_lock(self):
+        """Renovar, abrir, listar y crear pestañas no retienen el lock del pool; una pestaña creada a la vez se reutiliza"""
+        llamadas = []
+        creds = self._creds(llamadas, valido=False)
+        ns = self._ns(llamadas, creds)
+        pool = ns["_pool_gsheets"]()
+        refresh = creds.refresh
+        creds.refresh = lambda req: (pool["lock"].tomado and 1 / 0, refresh(req))
+        assert ns["_gs_open_worksheet"]("nueva").title == "nueva"
+        assert llamadas == ["refresh", "auth", "open", "worksheets", "add"]
+
+        # Otra sesión creó la pestaña entre el listado y add_worksheet
+        libro, listar = pool["sh"], type(pool["sh"]).worksheets
+        libro.tabs.append("otra")
+        llamadas.clear()
+        # El primer listado aún no la ve; add_worksheet falla y el segundo listado la encuentra
+        libro.worksheets = lambda: (libro.__dict__.pop("worksheets"), [w for w in listar(libro) if w.title != "otra"])[1]
+        assert ns["_gs_open_worksheet"]("otra").title == "otra"
+        assert llamadas == ["worksheets", "add", "worksheets"]
+        assert "otra" in pool["ws"] and pool["sh"] is libro
+
+
+# ============================================================
+# TEST 23: Programador de llamadas a Google Sheets
+# ============================================================
+
+class TestProgramadorGsheets:
+    """Tests para el cupo por minuto, la coalescencia de lecturas y los reintentos"""
+
+    def _ns(self, esperas):
+        import threading, time
+        estado = {}
+        ns = extraer_de_crm(
+            "GS_CUOTA_LECTURAS_MIN", "GS_CUOTA_ESCRITURAS_MIN", "GS_MAX_ESPERA_S", "GS_MAX_REINTENTOS",
+            "GS_BACKOFF_BASE_S", "GS_BACKOFF_MAX_S", "GS_COALESCER_S",
+            "_contar_gsheets", "_tomar_cupo_gsheets", "_es_idempotente_gsheets", "_peticion_no_enviada",
+            "_es_reintentable_gsheets", "_espera_backoff",
+            "nueva_ronda_gsheets", "programar_gsheets", "metricas_gsheets",
+            threading=threading, time=SimpleNamespace(monotonic=time.monotonic, sleep=esperas.append),
+        )
+        exec(
+            "def _programador_gsheets():\n"
+            "    if not estado:\n"
+            "        estado.update(lock=threading.Lock(), hilo=threading.local(),\n"
+            "            cubetas={'lectura': [GS_CUOTA_LECTURAS_MIN, time.monotonic()], 'escritura': [GS_CUOTA_ESCRITURAS_MIN, time.monotonic()]},\n"
+            "            contadores={'lecturas': 0, 'escrituras': 0, 'coalescidas': 0, 'reintentos': 0, 'errores': 0, 'espera_s': 0.0, 'ultimo_error': ''})\n"
+            "    return estado\n",
+            {**ns, "estado": estado}, ns,
+        )
+        ns["nueva_ronda_gsheets"]()
+        return ns
+
+    def test_coalescencia_y_escrituras(self):
+        """Una lectura repetida en la ejecución no sale a la red; una escritura la invalida"""
+        ns = self._ns([])
+        red = []
+        leer = lambda: red.append("GET") or f"resp{len(red)}"
+        assert ns["programar_gsheets"]("GET", ("values", "A"), leer) == "resp1"
+        assert ns["programar_gsheets"]("GET", ("values", "A"), leer) == "resp1"
+        assert ns["programar_gsheets"]("GET", ("values", "B"), leer) == "resp2"
+        ns["programar_gsheets"]("POST", ("append", None), lambda: red.append("POST"))
+        assert ns["programar_gsheets"]("GET", ("values", "A"), leer) == "resp4"
+        ns["nueva_ronda_gsheets"]()
+        assert ns["programar_gsheets"]("GET", ("values", "B"), leer) == "resp5"
+        m = ns["metricas_gsheets"]()
+        assert (m["lecturas"], m["escrituras"], m["coalescidas"]) == (4, 1, 1)
+
+    def test_reintentos_429_y_error_final(self):
+        """429/5xx se reintentan con espera; un 400 o agotar reintentos se propaga"""
+        esperas = []
+        ns = self._ns(esperas)
+
+        def _error(codigo):
+            return Exception_con_codigo(codigo)
+        fallos = [_error(429), _error(503)]
+
+        def llamada():
+            if fallos:
+                raise fallos.pop(0)
+            return "ok"
+        assert ns["programar_gsheets"]("POST", ("batch", None), llamada, idempotente=True) == "ok"
+        assert len(esperas) == 2 and all(0 <= e <= ns["GS_BACKOFF_MAX_S"] for e in esperas)
+
+        with pytest.raises(Exception_con_codigo):
+            ns["programar_gsheets"]("POST", ("x", None), lambda: (_ for _ in ()).throw(_error(400)))
+        with pytest.raises(Exception_con_codigo):
+            ns["programar_gsheets"]("GET", ("y", None), lambda: (_ for _ in ()).throw(_error(429)))
+        m = ns["metricas_gsheets"]()
+        assert m["reintentos"] == 2 + ns["GS_MAX_REINTENTOS"] and m["errores"] == 2
+        assert "429" in m["ultimo_error"]
+
+    def test_escrituras_no_idempotentes(self):
+        """Un append o un borrado de filas solo se repite con 429 o si la petición no salió"""
+        import requests, urllib3
+        esperas = []
+        ns = self._ns(esperas)
+        base = "https://sheets.googleapis.com/v4/spreadsheets/X"
+        assert ns["_es_idempotente_gsheets"]("POST", f"{base}/values:batchUpdate")
+        assert ns["_es_idempotente_gsheets"]("PUT", f"{base}/values/A1") and ns["_es_idempotente_gsheets"]("GET", base)
+        assert not ns["_es_idempotente_gsheets"]("POST", f"{base}/values/clientes:append")
+        assert not ns["_es_idempotente_gsheets"]("POST", f"{base}:batchUpdate")
+
+        no_enviada = requests.exceptions.ConnectionError(
+            urllib3.exceptions.MaxRetryError(None, "/", urllib3.exceptions.NewConnectionError(None, "sin red")))
+        perdida = requests.exceptions.ConnectionError("Connection aborted: RemoteDisconnected")
+        for error, reintenta in ((Exception_con_codigo(429), True), (no_enviada, True),
+                                 (requests.exceptions.ConnectTimeout(), True), (perdida, False),
+                                 (requests.exceptions.ReadTimeout(), False), (Exception_con_codigo(503), False)):
+            assert ns["_es_reintentable_gsheets"](error, idempotente=False) is reintenta, error
+            assert ns["_es_reintentable_gsheets"](error, idempotente=True)
+
+        enviadas = []
+
+        def append():
+            enviadas.append(1)
+            raise Exception_con_codigo(503)
+        with pytest.raises(Exception_con_codigo):
+            ns["programar_gsheets"]("POST", ("append", None), append, idempotente=False)
+        assert len(enviadas) == 1 and esperas == [], "un 503 en un append no se repite"
+
+    def test_cupo_por_minuto(self):
+        """Agotada la cubeta, la siguiente petición espera lo necesario para un turno"""
+        esperas = []
+        ns = self._ns(esperas)
+        for _ in range(ns["GS_CUOTA_ESCRITURAS_MIN"]):
+            assert ns["_tomar_cupo_gsheets"]("escritura") == 0
+        assert esperas == []
+        ns["_tomar_cupo_gsheets"]("escritura")
+        assert esperas and 0 < esperas[0] <= 60 / ns["GS_CUOTA_ESCRITURAS_MIN"] + 0.01
+
+
+class Exception_con_codigo(Exception):
+    def __init__(self, codigo):
+        super().__init__(f"APIError: [{codigo}]")
+        self.code = codigo
+
+
+# ============================================================
+# TEST 24: Réplica local de clientes
+# ============================================================
+
+class _HojaClientesFalsa:
+    """Pestaña de clientes en memoria con la API de gspread que usa la réplica."""
+
+    def __init__(self, filas):
+        self.valores = [list(f) for f in filas]
+        self.id = 7
+        self.spreadsheet = SimpleNamespace(batch_update=self._borrar)
+        self.antes_de_releer = None  # simula otra escritura entre la lectura y la escritura
+
+    def get_all_values(self):
+        return [list(f) for f in self.valores]
+
+    def batch_get(self, rangos):
+        if self.antes_de_releer:
+            self.antes_de_releer()
+            self.antes_de_releer = None
+        return [[self.valores[int(r.split(":")[0][1:]) - 1]] for r in rangos]
+
+    def update(self, rango, valores):
+        self.valores[0] = list(valores[0])
+
+    def batch_update(self, cambios, value_input_option=None):
+        for c in cambios:
+            n = int(c["range"].split(":")[0][1:])
+            self.valores[n - 1] = list(c["values"][0])
+
+    def append_rows(self, filas, value_input_option=None):
+        self.valores.extend(list(f) for f in filas)
+
+    def _borrar(self, cuerpo):
+        for r in cuerpo["requests"]:
+            del self.valores[r["deleteDimension"]["range"]["startIndex"]]
+
+
+class TestReplicaClientes:
+    """Tests para la fusión a tres bandas y la conciliación con la hoja"""
+
+    def _ns(self, tmp_path, hoja):
+        import json, threading, time
+        import gspread
+        return extraer_de_crm(
+            "COLUMNS", "REPLICA_CAMBIO", "REPLICA_BORRADO", "_ensure_columns", "_replica_db", "_filas_por_id",
+            "replica_clientes", "_persistir_replica", "lectura_clientes", "_fusionar_guardado",
+            "registrar_cambios_replica", "fusionar_replica",
+            "_leer_hoja_clientes", "_aplicar_en_hoja", "sincronizar_replica_clientes", "conflictos_replica",
+            json=json, threading=threading, time=time, gspread=gspread, USE_GSHEETS=True, GSHEET_TAB="clientes",
+            REPLICA_DB=tmp_path / "replica.sqlite", _REPLICA={},
+            CLIENTES_CSV=tmp_path / "clientes.csv", CLIENTES_XLSX=tmp_path / "clientes.xlsx",
+            _gs_bootstrap_valores=lambda tab: None, _gs_open_worksheet=lambda tab: hoja,
+            _escribir_clientes_local=lambda df: df.to_csv(tmp_path / "clientes.csv", index=False),
+            actualizar_cubo_kpi=lambda a, b: None,
+        )
+
+    @staticmethod
+    def _fila(cols, id_, **valores):
+        return [valores.get(c, id_ if c == "id" else "") for c in cols]
+
+    def test_fusion_tres_bandas(self, tmp_path):
+        """Cambios de un solo lado se aplican; la misma celda en ambos lados gana local y se registra"""
+        ns = self._ns(tmp_path, None)
+        cols, f = ns["COLUMNS"], lambda id_, **v: tuple(self._fila(ns["COLUMNS"], id_, **v))
+        base = {"1": f("1", nombre="Ana", estatus="NUEVO"), "2": f("2", nombre="Beto"), "3": f("3", nombre="Ceci")}
+        local = {"1": f("1", nombre="Ana", estatus="DISPERSADO"), "2": f("2", nombre="Beto"), "4": f("4", nombre="Dani")}
+        remoto = {"1": f("1", nombre="Ana María", estatus="NUEVO"), "2": f("2", nombre="Roberto"), "3": f("3", nombre="Ceci")}
+        pend = {"1": (ns["REPLICA_CAMBIO"], 0), "3": (ns["REPLICA_BORRADO"], 0), "4": (ns["REPLICA_CAMBIO"], 0)}
+        res = ns["fusionar_replica"](local, base, remoto, pend)
+        assert res["filas"]["1"] == f("1", nombre="Ana María", estatus="DISPERSADO")
+        assert res["filas"]["2"][cols.index("nombre")] == "Roberto"
+        assert "3" not in res["filas"] and res["borrar"] == {"3"}
+        assert res["subir"] == {"1", "4"} and res["conflictos"] == []
+
+        local["1"] = f("1", nombre="Anita", estatus="NUEVO")
+        res = ns["fusionar_replica"](local, base, remoto, pend)
+        assert res["filas"]["1"][cols.index("nombre")] == "Anita"
+        assert res["conflictos"] == [("1", "nombre", "Anita", "Ana María")]
+
+        # Borrado local de una fila que la hoja editó: se conserva la edición
+        remoto["3"] = f("3", nombre="Cecilia")
+        res = ns["fusionar_replica"](local, base, remoto, pend)
+        assert res["filas"]["3"][cols.index("nombre")] == "Cecilia" and "3" not in res["borrar"]
+
+    def test_conciliacion_con_hoja(self, tmp_path):
+        """Guardar marca pendientes; la ronda sube, baja y borra en lote y deja la base persistida"""
+        cols = extraer_de_crm("COLUMNS")["COLUMNS"]
+        hoja = _HojaClientesFalsa([cols, self._fila(cols, "1", nombre="Ana"), self._fila(cols, "2", nombre="Beto"),
+                                   self._fila(cols, "3", nombre="Ceci")])
+        ns = self._ns(tmp_path, hoja)
+        assert ns["sincronizar_replica_clientes"]()["subidas"] == 0
+        rep = ns["_REPLICA"]
+        assert list(rep["df"]["nombre"]) == ["Ana", "Beto", "Ceci"] and len(rep["base"]) == 3
+
+        df = rep["df"].copy()
+        df.loc[df["id"] == "1", "estatus"] = "DISPERSADO"
+        df = df[df["id"] != "3"]
+        df = pd.concat([df, pd.DataFrame([self._fila(cols, "4", nombre="Dani")], columns=cols)], ignore_index=True)
+        assert ns["registrar_cambios_replica"](df) == (3, [])
+        assert set(rep["pendientes"]) == {"1", "3", "4"} and rep["versiones"]["1"] == 2  # llegada de la hoja + guardado
+        hoja.valores[2][cols.index("nombre")] = "Roberto"  # edición concurrente en la hoja
+
+        res = ns["sincronizar_replica_clientes"]()
+        assert (res["subidas"], res["borradas"], res["conflictos"]) == (2, 1, 0)
+        assert [f[1] for f in hoja.valores[1:]] == ["Ana", "Roberto", "Dani"]
+        assert hoja.valores[1][cols.index("estatus")] == "DISPERSADO"
+        assert list(rep["df"]["nombre"]) == ["Ana", "Roberto", "Dani"] and rep["pendientes"] == {}
+
+        # Un proceso nuevo recupera base y versiones de disco
+        ns2 = self._ns(tmp_path, hoja)
+        rep2 = ns2["replica_clientes"]()
+        assert set(rep2["base"]) == {"1", "2", "4"} and rep2["versiones"]["1"] == 2 and rep2["pendientes"] == {}
+        assert ns2["sincronizar_replica_clientes"]() == {"subidas": 0, "borradas": 0, "conflictos": 0, "omitidas": 0, "cambio_local": False}
+
+    def test_guardado_con_lectura_vieja_no_pisa(self, tmp_path):
+        """Compare-and-set local: lo que otro cambió desde la lectura se fusiona y el choque se devuelve"""
+        ns = self._ns(tmp_path, None)
+        cols, ns["USE_GSHEETS"] = ns["COLUMNS"], False
+        df0 = pd.DataFrame([self._fila(cols, "1", nombre="Ana", estatus="NUEVO"), self._fila(cols, "2", nombre="Beto")], columns=cols)
+        ns["registrar_cambios_replica"](df0)
+        df_a, leido_a = ns["lectura_clientes"]()
+        df_b, leido_b = ns["lectura_clientes"]()
+
+        # Otro usuario guarda primero: estatus de 1 y un cliente nuevo
+        df_b.loc[df_b["id"] == "1", "estatus"] = "DISPERSADO"
+        df_b = pd.concat([df_b, pd.DataFrame([self._fila(cols, "3", nombre="Ceci")], columns=cols)], ignore_index=True)
+        assert ns["registrar_cambios_replica"](df_b, leido_b) == (2, [])
+
+        # Este usuario guarda su marco completo leído antes: nombre de 1 y estatus de 2
+        df_a.loc[df_a["id"] == "1", "nombre"] = "Ana María"
+        df_a.loc[df_a["id"] == "2", "estatus"] = "PROPUESTA"
+        n, conflictos = ns["registrar_cambios_replica"](df_a, leido_a)
+        assert n == 2 and conflictos == []
+        filas = ns["_filas_por_id"](ns["_REPLICA"]["df"])
+        assert filas["1"][cols.index("nombre")] == "Ana María" and filas["1"][cols.index("estatus")] == "DISPERSADO"
+        assert "3" in filas, "el cliente que agregó el otro usuario no se borra"
+
+        # Misma celda en ambos lados: se queda el valor actual y se reporta
+        df_c = df_a.copy()
+        df_c.loc[df_c["id"] == "1", "estatus"] = "RECHAZADO"
+        n, conflictos = ns["registrar_cambios_replica"](df_c, leido_a)
+        assert [(c["id"], c["columna"], c["mio"], c["actual"]) for c in conflictos] == [("1", "estatus", "RECHAZADO", "DISPERSADO")]
+        assert ns["_filas_por_id"](ns["_REPLICA"]["df"])["1"][cols.index("estatus")] == "DISPERSADO"
+
+    def test_hoja_cambiada_antes_de_escribir(self, tmp_path):
+        """Compare-and-set en la hoja: una fila que cambió tras la lectura no se pisa y se fusiona después"""
+        cols = extraer_de_crm("COLUMNS")["COLUMNS"]
+        hoja = _HojaClientesFalsa([cols, self._fila(cols, "1", nombre="Ana"), self._fila(cols, "2", nombre="Beto")])
+        ns = self._ns(tmp_path, hoja)
+        ns["sincronizar_replica_clientes"]()
+        df = ns["_REPLICA"]["df"].copy()
+        df.loc[df["id"] == "1", "estatus"] = "DISPERSADO"
+        df.loc[df["id"] == "2", "estatus"] = "PROPUESTA"
+        ns["registrar_cambios_replica"](df)
+
+        def _otro():
+            hoja.valores[1][cols.index("telefono")] = "555"
+        hoja.antes_de_releer = _otro
+        res = ns["sincronizar_replica_clientes"]()
+        assert (res["subidas"], res["omitidas"]) == (1, 1)
+        assert hoja.valores[1][cols.index("estatus")] == "" and hoja.valores[2][cols.index("estatus")] == "PROPUESTA"
+        assert set(ns["_REPLICA"]["pendientes"]) == {"1"} and ns["_REPLICA"]["repetir"]
+
+        ns["sincronizar_replica_clientes"]()
+        assert hoja.valores[1][cols.index("estatus")] == "DISPERSADO" and hoja.valores[1][cols.index("telefono")] == "555"
+        assert ns["_REPLICA"]["pendientes"] == {}
+
+
+# ============================================================
+# TEST 25: Candados y escritura atómica de archivos locales
+# ============================================================
+
+class TestEscrituraSegura:
+    """Tests para los candados entre escritores y el reemplazo atómico"""
+
+    def test_reemplazo_atomico(self, tmp_path):
+        """Un error a mitad de escritura deja el archivo anterior intacto y sin temporales"""
+        ns = almacen_archivos()
+        ruta = tmp_path / "estatus.json"
+        ns["guardar_json"](ruta, ["NUEVO", "DISPERSADO"])
+        assert ruta.read_text(encoding="utf-8") == '[\n  "NUEVO",\n  "DISPERSADO"\n]'
+        with pytest.raises(RuntimeError):
+            with ns["archivo_atomico"](ruta) as tmp:
+                tmp.write_text("[a medias", encoding="utf-8")
+                raise RuntimeError("fallo")
+        assert "DISPERSADO" in ruta.read_text(encoding="utf-8")
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["estatus.json", "estatus.json.lock"]
+
+    def test_reemplazo_conserva_permisos(self, tmp_path):
+        """El archivo reemplazado mantiene sus permisos; uno nuevo usa el umask, no 0600"""
+        import os
+        ns = almacen_archivos()
+        ruta = tmp_path / "clientes.csv"
+        ruta.write_text("id\n", encoding="utf-8")
+        os.chmod(ruta, 0o640)
+        ns["escribir_atomico"](ruta, "id\nC1\n")
+        assert ruta.read_text(encoding="utf-8") == "id\nC1\n" and (ruta.stat().st_mode & 0o777) == 0o640
+
+        umask = os.umask(0o022)
+        try:
+            nuevo = tmp_path / "users.json"
+            ns["guardar_json"](nuevo, {"users": []})
+        finally:
+            os.umask(umask)
+        assert (nuevo.stat().st_mode & 0o777) == 0o644
+
+    def test_escritores_concurrentes_y_metrica(self, tmp_path):
+        """Los appends concurrentes no se intercalan y la espera por el candado queda medida"""
+        import threading, time
+        ns = almacen_archivos()
+        ruta = tmp_path / "historial.csv"
+
+        def escritor(k):
+            for i in range(20):
+                with ns["bloqueo_archivo"](ruta):
+                    with open(ruta, "a", encoding="utf-8") as fh:
+                        fh.write(f"{k},")
+                        time.sleep(0.0005)
+                        fh.write(f"{i}\n")
+        hilos = [threading.Thread(target=escritor, args=(k,)) for k in range(4)]
+        for h in hilos:
+            h.start()
+        for h in hilos:
+            h.join()
+        lineas = ruta.read_text(encoding="utf-8").splitlines()
+        assert len(lineas) == 80 and all(len(l.split(",")) == 2 for l in lineas)
+
+        ocupado = threading.Event()
+
+        def retener():
+            with ns["bloqueo_archivo"](ruta):
+                ocupado.set()
+                time.sleep(0.2)
+        h = threading.Thread(target=retener)
+        h.start()
+        ocupado.wait()
+        ns["escribir_atomico"](ruta, "id\n")
+        h.join()
+        m = ns["metricas_bloqueos"]()
+        assert m["adquisiciones"] == 82 and m["max_s"] >= 0.1
+        assert m["por_archivo"]["historial.csv"] >= 0.1 and ruta.read_text() == "id\n"
+
+
+# ============================================================
+# TEST 26: Diferencias del editor de clientes
+# ============================================================
+
+class TestDiffEditor:
+    """Tests para el conjunto de cambios (id, columna, anterior, nuevo) del guardado del editor"""
+
+    def _ns(self):
+        import numpy as np
+        return extraer_de_crm("COLUMNS", "CAMBIOS_COLS", "diff_clientes", "registro_historial", "historial_desde_cambios", np=np)
+
+    def test_diff_solo_celdas_editadas(self):
+        """El formato de pantalla no cuenta como cambio; `anterior` es el valor guardado"""
+        ns = self._ns()
+        cols = ns["COLUMNS"]
+        original = pd.DataFrame([{c: "" for c in cols} | {"id": str(i), "nombre": f"C{i}", "fecha_ingreso": "03/15/2025",
+                                                         "sucursal": "VIEJA", "estatus": "NUEVO"} for i in range(1000)])
+        mostrado = original.assign(fecha_ingreso="2025-03-15", sucursal="").iloc[::-1].reset_index(drop=True)
+        editado = mostrado.copy()
+        editado.loc[editado["id"] == "7", ["estatus", "observaciones"]] = ["DISPERSADO", "ok"]
+        editado.loc[editado["id"] == "9", "fecha_ingreso"] = "2025-04-01"
+
+        cambios = ns["diff_clientes"](mostrado, editado, original=original)
+        assert list(cambios.columns) == ns["CAMBIOS_COLS"]
+        assert sorted(map(tuple, cambios.to_numpy().tolist())) == [
+            ("7", "estatus", "NUEVO", "DISPERSADO"), ("7", "observaciones", "", "ok"),
+            ("9", "fecha_ingreso", "03/15/2025", "2025-04-01"),
+        ]
+        assert ns["diff_clientes"](mostrado, mostrado.copy(), original=original).empty
+
+    def test_historial_un_registro_por_cliente(self):
+        """Cada cliente modificado genera un evento con sus columnas y el estatus antes/después"""
+        ns = self._ns()
+        original = pd.DataFrame([{"id": "7", "nombre": "Ana", "estatus": "NUEVO", "segundo_estatus": "A"},
+                                 {"id": "9", "nombre": "Beto", "estatus": "NUEVO", "segundo_estatus": ""}])
+        cambios = pd.DataFrame([("7", "estatus", "NUEVO", "DISPERSADO"), ("7", "observaciones", "", "ok"),
+                                ("9", "nombre", "Beto", "Roberto")], columns=ns["CAMBIOS_COLS"])
+        regs = ns["historial_desde_cambios"](cambios, original, actor="ana")
+        assert [(r["id"], r["nombre"], r["estatus_old"], r["estatus_new"], r["segundo_new"], r["observaciones"]) for r in regs] == [
+            ("7", "Ana", "NUEVO", "DISPERSADO", "A", "Campos cambiados: estatus,observaciones"),
+            ("9", "Roberto", "NUEVO", "NUEVO", "", "Campos cambiados: nombre"),
+        ]
+
+    def test_cambios_en_replica_por_celda(self, tmp_path):
+        """Solo las filas del conjunto quedan pendientes; una celda que otro cambió se reporta"""
+        import numpy as np
+        t = TestReplicaClientes()
+        ns = t._ns(tmp_path, None)
+        ns.update(extraer_de_crm("CAMBIOS_COLS", "aplicar_cambios_replica", **{**ns, "np": np}))
+        cols = ns["COLUMNS"]
+        ns["registrar_cambios_replica"](pd.DataFrame([t._fila(cols, str(i), estatus="NUEVO") for i in range(50)], columns=cols))
+        ns["_REPLICA"]["pendientes"].clear()
+        _, leido = ns["lectura_clientes"]()
+        ns["aplicar_cambios_replica"](pd.DataFrame([("3", "estatus", "NUEVO", "PROPUESTA")], columns=["id", "columna", "anterior", "nuevo"]))
+
+        cambios = pd.DataFrame([("3", "estatus", "NUEVO", "RECHAZADO"), ("3", "telefono", "", "555"),
+                                ("8", "estatus", "NUEVO", "DISPERSADO"), ("99", "estatus", "", "X")],
+                               columns=["id", "columna", "anterior", "nuevo"])
+        aplicados, conflictos = ns["aplicar_cambios_replica"](cambios, leido)
+        assert set(ns["_REPLICA"]["pendientes"]) == {"3", "8"}
+        assert aplicados.to_numpy().tolist() == [["3", "telefono", "", "555"], ["8", "estatus", "NUEVO", "DISPERSADO"]], \
+            "los choques no cuentan como aplicados (ni van al historial)"
+        assert [(c["id"], c["columna"], c["actual"]) for c in conflictos] == [("3", "estatus", "PROPUESTA"), ("99", "estatus", "(borrado)")]
+        filas = ns["_filas_por_id"](ns["_REPLICA"]["df"])
+        assert filas["3"][cols.index("estatus")] == "PROPUESTA" and filas["3"][cols.index("telefono")] == "555"
+        assert filas["8"][cols.index("estatus")] == "DISPERSADO"
+
+    def test_formulario_guarda_contra_lo_mostrado(self, tmp_path):
+        """El clic compara contra la lectura de cuando se dibujó el formulario, no la del mismo rerun"""
+        import numpy as np
+        t = TestReplicaClientes()
+        ns = t._ns(tmp_path, None)
+        sesion = {}
+        ns.update(extraer_de_crm("CAMBIOS_COLS", "aplicar_cambios_replica", "lectura_mostrada",
+                                 **{**ns, "np": np, "st": SimpleNamespace(session_state=sesion)}))
+        cols = ns["COLUMNS"]
+        ns["registrar_cambios_replica"](pd.DataFrame([t._fila(cols, "1", estatus="NUEVO")], columns=cols))
+
+        def ejecucion():
+            ns["lectura_mostrada"].__globals__["_CLIENTES_LEIDO"] = ns["lectura_clientes"]()[1]
+            return ns["lectura_mostrada"]("_leido_form")
+
+        ejecucion()  # se dibuja el formulario con estatus NUEVO
+        ns["aplicar_cambios_replica"](pd.DataFrame([("1", "estatus", "NUEVO", "PROPUESTA")], columns=ns["CAMBIOS_COLS"]))
+        leido = ejecucion()  # el clic: esta ejecución ya lee PROPUESTA
+        assert leido["1"][1][cols.index("estatus")] == "NUEVO"
+        cambios = pd.DataFrame([("1", "estatus", "PROPUESTA", "RECHAZADO")], columns=ns["CAMBIOS_COLS"])
+        aplicados, conflictos = ns["aplicar_cambios_replica"](cambios, leido)
+        assert aplicados.empty and [c["actual"] for c in conflictos] == ["PROPUESTA"]
+
+    def test_usar_el_mio_guarda_una_celda_con_historial(self, tmp_path):
+        """«Usar el mío» guarda solo esa celda contra la lectura actual y la registra en el historial"""
+        import numpy as np
+        t = TestReplicaClientes()
+        ns = t._ns(tmp_path, None)
+        historial, guardados = [], []
+        ns.update(extraer_de_crm(
+            "CAMBIOS_COLS", "aplicar_cambios_replica", "registro_historial", "historial_desde_cambios",
+            "aplicar_conflicto_cliente", **{**ns, "np": np}, append_historial_many=historial.extend,
+            append_historial=lambda *a, **kw: historial.append({"id": a[0], "action": kw["action"]}),
+            guardar_clientes=lambda df, leido=None: guardados.append(df),
+        ))
+        g = ns["aplicar_conflicto_cliente"].__globals__
+        g["cargar_clientes"] = lambda: g.update(_CLIENTES_LEIDO=ns["lectura_clientes"]()[1]) or ns["lectura_clientes"]()[0]
+        g["guardar_cambios_clientes"] = lambda cambios, leido=None: ns["aplicar_cambios_replica"](cambios, leido)[0]
+        cols = ns["COLUMNS"]
+        ns["registrar_cambios_replica"](pd.DataFrame([t._fila(cols, "1", nombre="Ana", estatus="NUEVO"),
+                                                      t._fila(cols, "2", nombre="Beto")], columns=cols))
+        ns["_REPLICA"]["pendientes"].clear()
+
+        ns["aplicar_conflicto_cliente"]({"id": "1", "columna": "estatus", "mio": "RECHAZADO", "actual": "NUEVO", "fila": None}, actor="eva")
+        filas = ns["_filas_por_id"](ns["_REPLICA"]["df"])
+        assert filas["1"][cols.index("estatus")] == "RECHAZADO"
+        assert set(ns["_REPLICA"]["pendientes"]) == {"1"}, "solo se marca la fila del choque"
+        assert guardados == [], "no se reescribe la base completa"
+        assert [(r["id"], r["estatus_old"], r["estatus_new"], r["actor"]) for r in historial] == [("1", "NUEVO", "RECHAZADO", "eva")]
+
+        # Fila completa editada en ambos lados: solo las celdas que difieren
+        historial.clear()
+        mia = tuple(t._fila(cols, "2", nombre="Roberto", telefono="555"))
+        ns["aplicar_conflicto_cliente"]({"id": "2", "columna": "*", "mio": "(fila editada)", "actual": "(fila editada)", "fila": mia}, actor="eva")
+        assert ns["_filas_por_id"](ns["_REPLICA"]["df"])["2"] == mia
+        assert len(historial) == 1 and "nombre" in historial[0]["observaciones"] and "telefono" in historial[0]["observaciones"]
+
+        # Lo borré yo y el otro lo editó: se guarda la baja por filas
+        historial.clear()
+        ns["aplicar_conflicto_cliente"]({"id": "2", "columna": "*", "mio": "(borrado)", "actual": "(fila editada)", "fila": None}, actor="eva")
+        assert "2" not in set(guardados[-1]["id"]) and historial == [{"id": "2", "action": "CLIENTE ELIMINADO"}]
+
+
 # ===== CÓMO USAR =====
 
 """
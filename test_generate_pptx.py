@@ -1,46 +1,52 @@
 import re
+import hashlib
 from pathlib import Path
 import pandas as pd
 
 CRMPATH = Path('crm.py')
 text = CRMPATH.read_text(encoding='utf-8')
 
-# Extract función calcular_analisis_financiero
-start1 = text.find('def calcular_analisis_financiero')
+# Extract the helper for shared caches (defined near the top of crm.py)
+start0 = text.find('def _cache_guardar')
+if start0 == -1:
+    raise SystemExit('no encontrar _cache_guardar')
+cache_code = text[start0: text.find('\n# ', start0)]
+
+# Extract parse_dates_flexible (used by the KPI cube)
+start_pd = text.find('def parse_dates_flexible')
+if start_pd == -1:
+    raise SystemExit('no encontrar parse_dates_flexible')
+dates_code = text[start_pd: text.find('\ndef ', start_pd + 1)]
+
+# Extract the analytics engine, calcular_analisis_financiero, formatear_monto and
+# generar_presentacion_dashboard: everything from the engine marker up to def get_base64_image
+start1 = text.find('# === MOTOR DE ANÁLISIS FINANCIERO ===')
 if start1 == -1:
-    raise SystemExit('no encontrar calcular_analisis_financiero')
-next_def = text.find('\ndef ', start1+1)
-calc_code = text[start1: next_def]
-
-# Extract formatear_monto
-start2 = text.find('def formatear_monto', next_def)
-if start2 == -1:
-    raise SystemExit('no encontrar formatear_monto')
-next_def2 = text.find('\ndef ', start2+1)
-form_code = text[start2: next_def2]
-
-# Extract generar_presentacion_dashboard up to def get_base64_image
-start3 = text.find('def generar_presentacion_dashboard')
-if start3 == -1:
-    raise SystemExit('no encontrar generar_presentacion_dashboard')
+    raise SystemExit('no encontrar el motor de análisis financiero')
+for name in ('def calcular_analisis_financiero', 'def formatear_monto', 'def generar_presentacion_dashboard'):
+    if text.find(name, start1) == -1:
+        raise SystemExit(f'no encontrar {name}')
 end_marker = '\ndef get_base64_image'
-end3 = text.find(end_marker, start3)
-if end3 == -1:
+end1 = text.find(end_marker, start1)
+if end1 == -1:
     # fallback: take until end of file
-    gen_code = text[start3:]
+    gen_code = text[start1:]
 else:
-    gen_code = text[start3:end3]
+    gen_code = text[start1:end1]
 
 # Build a namespace and exec
 ns = {}
 # Provide imports the functions expect
 ns['pd'] = pd
 ns['Path'] = Path
+ns['hashlib'] = hashlib
 ns['__file__'] = str(CRMPATH)
+# Shared caches: plain dicts outside Streamlit
+ns['_estado_compartido'] = lambda nombre: {}
 
 # Exec the helper functions
-exec(calc_code, ns)
-exec(form_code, ns)
+exec(cache_code, ns)
+exec(dates_code, ns)
 exec(gen_code, ns)
 
 # Prepare a sample dataframe